@@ -1,30 +1,231 @@
 # app.py
 from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-from flask_socketio import SocketIO, emit, join_room, leave_room
+from flask_socketio import SocketIO
 import random
 import time
 from datetime import datetime
 import json
-from collections import deque
+from collections import OrderedDict, deque
+from engine import NIGHT_ACTIONS, NightActions, Phase, Role, VoteTally
+from replay import open_replays, read_replay, REPLAY_ID
+from store import open_store
+import codec
+import engine
+import metrics
+import argparse
+import base64
+import bisect
+import gc
+import hashlib
+import heapq
+import itertools
+import math
+import os
 import secrets
+import sys
 import threading
+import traceback
+import tracemalloc
+import zlib
+
+# Sharding: with several worker processes, each lobby code is owned by exactly
+# one of them. Workers must share the secret key so sessions carry over, and a
+# message queue (e.g. redis://, or zmq+tcp://localhost:5555+5556 with
+# zmq_broker.py) so emits reach clients connected to any worker.
+SHARD_COUNT = int(os.environ.get('MAFIA_SHARD_COUNT', 1))
+SHARD_INDEX = int(os.environ.get('MAFIA_SHARD_INDEX', 0))
+SHARD_URLS = [url.rstrip('/') for url in os.environ.get('MAFIA_SHARD_URLS', '').split(',') if url]
+if SHARD_COUNT > 1 and len(SHARD_URLS) != SHARD_COUNT:
+    raise RuntimeError('MAFIA_SHARD_URLS must list one base URL per shard')
+
+# Metrics, served in the Prometheus text format on /metrics
+HANDLER_SECONDS = metrics.Histogram('mafia_handler_seconds', 'Socket.IO handler run time.', 'handler')
+SERIALIZE_SECONDS = metrics.Histogram('mafia_serialize_seconds', 'Time spent building state payloads.', 'function')
+EMITTED_BYTES = metrics.Counter('mafia_emitted_bytes_total', 'Encoded Socket.IO payload bytes by event.', 'event')
+TIMER_LAG = metrics.Histogram('mafia_timer_lag_seconds', 'How late phase deadlines fire.')
+TIMER_TICK = metrics.Histogram('mafia_timer_tick_seconds', 'Time spent handling due phase deadlines per wakeup.')
+RATE_LIMITED = metrics.Counter('mafia_rate_limited_total', 'Socket events rejected by flood protection.', 'limit')
+ACTOR_CONTENDED = metrics.Counter('mafia_actor_contended_total', 'Lobby commands that waited for another task to run them.')
+REPLAY_BYTES = metrics.Counter('mafia_replay_bytes_total', 'Compressed replay bytes written to disk.')
+HTTP_CACHE = metrics.Counter('mafia_http_cache_total', 'Lobby and game page requests by render cache outcome.', 'result')
+
+# asgi.py sets MAFIA_SERVER=asgi and serves the same app on an asyncio
+# Socket.IO server; Flask-SocketIO then stays idle.
+ASGI_MODE = os.environ.get('MAFIA_SERVER') == 'asgi'
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = secrets.token_hex(16)
-socketio = SocketIO(app, manage_session=False, cors_allowed_origins="*")
+app.config['SECRET_KEY'] = os.environ.get('MAFIA_SECRET_KEY') or secrets.token_hex(16)
+socketio = SocketIO(app, manage_session=False, cors_allowed_origins="*",
+                    async_mode='threading' if ASGI_MODE else None,
+                    message_queue=None if ASGI_MODE else os.environ.get('MAFIA_MESSAGE_QUEUE'),
+                    json=metrics.MeteredJSON(EMITTED_BYTES, codec.fast_json))
+
+
+class FlaskTransport:
+    """The server operations lobby and game logic use, on Flask-SocketIO.
+
+    asgi.py installs an asyncio implementation with the same methods, so
+    nothing outside the transports touches a particular server.
+    """
+
+    def __init__(self, socketio):
+        self.socketio = socketio
+
+    def emit(self, event, data, room):
+        self.socketio.emit(event, data, room=room)
+
+    def enter_room(self, sid, room):
+        self.socketio.server.enter_room(sid, room, namespace='/')
+
+    def leave_room(self, sid, room):
+        self.socketio.server.leave_room(sid, room, namespace='/')
+
+    def call_later(self, delay, callback):
+        self.socketio.start_background_task(self._call_later, delay, callback)
+
+    def create_event(self):
+        return self.socketio.server.eio.create_event()
+
+    def _call_later(self, delay, callback):
+        self.socketio.sleep(delay)
+        callback()
+
+
+class CodecTransport:
+    """Wraps a transport to send each socket events in the encoding it
+    negotiated in join_lobby (see codec.py).
+
+    Binary sockets sit in a twin of every room they enter, so a broadcast
+    is still encoded once per encoding, and the binary copy only when some
+    socket in the room wants it. Sockets and their lobbies share a worker,
+    so the local membership counts are enough.
+    """
+
+    def __init__(self, inner, bytes_counter):
+        self.inner = inner
+        self.bytes_counter = bytes_counter
+        self.binary = {}  # binary sid -> rooms it entered
+        self.binary_rooms = {}  # room -> binary sockets in it
+        self.lock = threading.Lock()
+
+    def set_codec(self, sid, name):
+        """Switch a socket to `name` ('json' or 'binary') before it enters rooms."""
+        if name == 'binary' and sid not in self.binary:
+            self.inner.emit('codec', {'codec': 'binary', 'schema': codec.schema()}, sid)
+            with self.lock:
+                self.binary[sid] = set()
+
+    def forget(self, sid):
+        with self.lock:
+            for room in self.binary.pop(sid, ()):
+                self._count(room, -1)
+
+    def _count(self, room, delta):
+        count = self.binary_rooms.get(room, 0) + delta
+        if count > 0:
+            self.binary_rooms[room] = count
+        else:
+            self.binary_rooms.pop(room, None)
+
+    def emit(self, event, data, room):
+        if room in self.binary:
+            # Sent to one binary socket by its sid
+            self.emit_binary(event, data, room)
+            return
+        self.inner.emit(event, data, room)
+        if room in self.binary_rooms:
+            self.emit_binary(event, data, binary_room(room))
+
+    def emit_binary(self, event, data, room):
+        if event in codec.EVENTS:
+            data = codec.encode(event, data)
+            self.bytes_counter.inc(event, len(data))
+        self.inner.emit(event, data, room)
+
+    def enter_room(self, sid, room):
+        with self.lock:
+            rooms = self.binary.get(sid)
+            if rooms is not None and room not in rooms:
+                rooms.add(room)
+                self._count(room, 1)
+        self.inner.enter_room(sid, binary_room(room) if rooms is not None else room)
+
+    def leave_room(self, sid, room):
+        with self.lock:
+            rooms = self.binary.get(sid)
+            if rooms is not None and room in rooms:
+                rooms.discard(room)
+                self._count(room, -1)
+        self.inner.leave_room(sid, binary_room(room) if rooms is not None else room)
+
+    def call_later(self, delay, callback):
+        self.inner.call_later(delay, callback)
+
+    def create_event(self):
+        return self.inner.create_event()
+
+
+def binary_room(room):
+    return f"{room}#bin"
+
+
+class SocketClient:
+    """The socket whose event is being handled."""
+    __slots__ = ('sid', 'player_id')
+
+    def __init__(self, sid, player_id):
+        self.sid = sid
+        self.player_id = player_id
+
+    def emit(self, event, data):
+        transport.emit(event, data, self.sid)
+
+
+transport = CodecTransport(FlaskTransport(socketio), EMITTED_BYTES)
+socket_handlers = {}  # event -> handler(client, *args), for every transport
+
+
+def on_event(event):
+    """Register `handler(client, *args)` for a Socket.IO event, timed and run
+    as a command on the actor of the lobby the event is for."""
+    def decorator(handler):
+        timed = HANDLER_SECONDS.timed(handler)
+
+        def dispatch(client, *args):
+            return lobby_command(event_lobby_code(client, args), timed, client, *args)
+        socket_handlers[event] = dispatch
+
+        @socketio.on(event)
+        def flask_handler(*args):
+            return dispatch(SocketClient(request.sid, session.get('player_id')), *args)
+        return handler
+    return decorator
+
+
+def event_lobby_code(client, args):
+    """The lobby an event names, else the lobby of the player sending it."""
+    data = args[0] if args else None
+    code = data.get('lobby_code') if isinstance(data, dict) else None
+    if isinstance(code, str):
+        return code
+    player = players.get(client.player_id)
+    return player.lobby_code if player else None
 
 
 # Game state management
 class Player:
+    __slots__ = ('id', 'name', 'sid', 'role', 'alive', 'votes', 'vote_target', 'is_admin', 'lobby_code')
+
     def __init__(self, id, name, sid):
         self.id = id
         self.name = name
-        self.sid = sid
+        self.sid = sid  # None while disconnected
         self.role = None
         self.alive = True
         self.votes = 0
         self.vote_target = None
         self.is_admin = False
+        self.lobby_code = None
 
     def to_dict(self):
         return {
@@ -36,246 +237,691 @@ class Player:
             'is_admin': self.is_admin
         }
 
+    def to_record(self):
+        return dict(self.to_dict(), vote_target=self.vote_target)
+
+    @classmethod
+    def from_record(cls, record):
+        player = cls(record['id'], record['name'], None)
+        player.role = Role(record['role']) if record['role'] else None
+        player.alive = record['alive']
+        player.votes = record['votes']
+        player.vote_target = record['vote_target']
+        player.is_admin = record['is_admin']
+        return player
+
+
+class LobbySettings:
+    __slots__ = ('doctor', 'detective', 'max_players', 'min_players', 'game_time', 'night_chat')
+
+    def __init__(self):
+        self.doctor = True
+        self.detective = False
+        self.max_players = 12
+        self.min_players = 4
+        self.game_time = 120  # seconds per phase
+        self.night_chat = False  # Whether mafia can chat during night
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def update(self, settings):
+        for key, value in settings.items():
+            if key in self.__slots__:
+                setattr(self, key, value)
+
 
 class Lobby:
+    __slots__ = ('code', 'players', 'settings', 'game', 'created_at', 'messages', 'version', 'stream')
+
     def __init__(self, code, creator):
         self.code = code
         self.players = {creator.id: creator}
         creator.is_admin = True
-        self.settings = {
-            'doctor': True,
-            'detective': False,
-            'max_players': 12,
-            'min_players': 4,
-            'game_time': 120,  # seconds per phase
-            'night_chat': False  # Whether mafia can chat during night
-        }
+        creator.lobby_code = code
+        self.settings = LobbySettings()
         self.game = None
         self.created_at = datetime.now()
+        # Lobby and game chat share one ring buffer of
+        # (audience, timestamp, text) tuples; audience None means everyone
         self.messages = deque(maxlen=100)
+        # Bumped on every journaled change; with `stream`, which differs per
+        # Lobby object, it names one state of to_dict() for HTTP caching
+        self.version = 0
+        self.stream = secrets.token_hex(4)
 
+    @property
+    def etag(self):
+        return f"{self.code}-{self.stream}-{self.version}"
+
+    @SERIALIZE_SECONDS.timed
     def to_dict(self):
         return {
             'code': self.code,
-            'players': [player.to_dict() for player in self.players.values()],
+            'players': [self.game.project_player(player, "town") if self.game else player.to_dict()
+                        for player in self.players.values()],
             'player_count': len(self.players),
-            'settings': self.settings,
+            'settings': self.settings.to_dict(),
             'game_started': self.game is not None,
-            'messages': list(self.messages)
+            'replay_id': self.game and self.game.replay_id,
+            'messages': [message_dict(entry) for entry in self.messages if entry[0] is None]
         }
 
-    def add_message(self, message, player_name=None):
+    def to_record(self):
+        return {
+            'code': self.code,
+            'players': [player.to_record() for player in self.players.values()],
+            'settings': self.settings.to_dict(),
+            'created_at': self.created_at.isoformat(),
+            'messages': list(self.messages),
+            'game': self.game.to_record() if self.game else None
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        players = [Player.from_record(player) for player in record['players']]
+        lobby = cls(record['code'], players[0])
+        lobby.players = {player.id: player for player in players}
+        for player in players:
+            player.lobby_code = lobby.code
+        players[0].is_admin = record['players'][0]['is_admin']
+        lobby.settings.update(record['settings'])
+        lobby.created_at = datetime.fromisoformat(record['created_at'])
+        lobby.messages.extend(tuple(entry) for entry in record['messages'])
+        if record['game']:
+            lobby.game = Game(lobby, record['game'])
+        return lobby
+
+    def journal(self, event, data):
+        self.version += 1
+        if store.record(self.code, event, data):
+            store.snapshot(self.code, self.to_record())
+
+    def add_player(self, player):
+        self.players[player.id] = player
+        player.lobby_code = self.code
+        self.journal('join', {'id': player.id, 'name': player.name})
+
+    def remove_player(self, player_id):
+        player = self.players.pop(player_id)
+        if self.game:
+            self.game.forget_player(player)
+
+        # Assign new admin if needed
+        if self.players and not any(player.is_admin for player in self.players.values()):
+            new_admin = next(iter(self.players.values()))
+            new_admin.is_admin = True
+        self.journal('leave', {'id': player_id})
+
+    def update_settings(self, settings):
+        self.settings.update(settings)
+
+        # Ensure min_players is not greater than max_players
+        if self.settings.min_players > self.settings.max_players:
+            self.settings.min_players = self.settings.max_players
+        self.journal('settings', self.settings.to_dict())
+
+    def add_message(self, message, player_name=None, audience=None):
         if player_name:
             full_message = f"{player_name}: {message}"
         else:
             full_message = message
 
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.messages.append({
-            'timestamp': timestamp,
-            'message': full_message
-        })
+        timestamp = current_timestamp()
+        entry = (audience, timestamp, full_message)
+        self.messages.append(entry)
+        self.journal('message', {'audience': audience, 'timestamp': timestamp, 'message': full_message})
 
-        return {
-            'timestamp': timestamp,
-            'message': full_message
-        }
+        return entry
 
 
 class Game:
-    def __init__(self, lobby):
+    __slots__ = ('lobby', 'players', 'phase', 'day_number', 'deadline', 'closed_phase', 'votes',
+                 'alive_count', 'alive_by_role', 'night_actions', 'start_time', 'version', 'sent_phase', 'sent_players',
+                 'pending_messages', 'player_views', 'view_changes', 'snapshot_cache', 'stream',
+                 'patch_log', 'private_log', 'replay')
+
+    def __init__(self, lobby, record=None):
         self.lobby = lobby
         self.players = lobby.players
-        self.phase = "setup"  # setup, night, day, discussion, voting, ended
+        self.phase = Phase.SETUP  # setup, night, day, discussion, voting, ended
         self.day_number = 0
-        self.time_remaining = 0
-        self.votes = {}
-        self.night_actions = {}
-        self.communications = deque(maxlen=100)
+        self.deadline = None  # monotonic time at which the current phase ends
+        self.closed_phase = None  # (phase, day_number) already queued to end early
+        self.votes = VoteTally()
+        # Living players by role, kept up to date on deaths and departures so
+        # win checks and "everyone has acted" checks never scan the roster
+        self.alive_by_role = {role: {} for role in Role}  # role -> {player id: player}
+        self.alive_count = 0
+        self.night_actions = NightActions()
         self.start_time = time.time()
 
+        # Broadcast bookkeeping: clients hold the state at `version` and get
+        # patches against what was last sent rather than full snapshots.
+        # Each view has its own sub-room and its own copy of what was sent.
+        self.version = 0
+        self.sent_phase = None
+        self.sent_players = {view: {} for view in VIEWS}
+        self.pending_messages = []
+        self.player_views = {}  # player id -> view room the player is in
+        self.view_changes = set()  # players whose view changed since the last broadcast
+        self.snapshot_cache = {}  # view -> snapshot at self.version
+
+        # Reconnecting clients resume from these bounded logs instead of
+        # taking a full snapshot. `stream` changes whenever version numbers
+        # start over (a new Game, or one restored after a restart).
+        self.stream = secrets.token_hex(4)
+        self.patch_log = {view: deque(maxlen=PATCH_LOG_SIZE) for view in VIEWS}
+        self.private_log = {}  # player id -> deque of private messages, seq-numbered
+
+        if record:
+            # Recovering from the journal; roles were restored with the players
+            self.restore(record)
+            return
+
         # Assign roles
         self.assign_roles()
+        self.replay = replays.start(f"{lobby.code}-{secrets.token_hex(4)}", self.start_time, lobby.code,
+                                    [(p.id, p.name, p.role.value) for p in self.players.values()])
 
         # Start the first night phase
         self.start_night()
 
-    def assign_roles(self):
-        players = list(self.players.values())
-        random.shuffle(players)
-
-        # Determine number of mafia based on player count
-        num_players = len(players)
-        if num_players <= 6:
-            num_mafia = 1
-        elif num_players <= 9:
-            num_mafia = 2
-        else:
-            num_mafia = 3
+    def to_record(self):
+        return {
+            'phase': self.phase,
+            'day_number': self.day_number,
+            'ends_at': self.ends_at,
+            'closed': not self.phase_open,
+            'votes': self.votes.ballots,
+            'night_actions': self.night_actions.actions,
+            'replay': self.replay.to_record()
+        }
 
-        # Assign roles
-        for i, player in enumerate(players):
-            if i < num_mafia:
-                player.role = "mafia"
-            else:
-                player.role = "townsfolk"
-
-        # Check if doctor is enabled and assign if needed
-        if self.lobby.settings['doctor'] and num_players > 4:
-            # Replace one townsfolk with doctor
-            for player in players:
-                if player.role == "townsfolk":
-                    player.role = "doctor"
-                    break
-
-        # Check if detective is enabled and assign if needed
-        if self.lobby.settings['detective'] and num_players > 6:
-            # Replace one townsfolk with detective
-            for player in players:
-                if player.role == "townsfolk":
-                    player.role = "detective"
-                    break
+    def restore(self, record):
+        self.phase = Phase(record['phase'])
+        self.day_number = record['day_number']
+        self.closed_phase = (self.phase, self.day_number) if record['closed'] else None
+        for voter_id, target_id in record['votes'].items():
+            self.votes.cast(voter_id, target_id)
+        self.night_actions = NightActions(record['night_actions'])
+        self.index_players()
+        self.resume_timer(record['ends_at'])
+        # Events of the day in progress before the restart are lost from the replay
+        replay = record.get('replay')
+        if replay:
+            self.start_time = replay['started']
+        self.replay = replays.resume(replay, self.phase, self.day_number)
+
+    def journal(self, event, data):
+        self.lobby.journal(event, data)
+        if store.replaying:
+            return
+        # The replay keeps the same events, plus chat and private messages
+        if event == 'phase':
+            self.replay.set_phase(data['phase'], data['day_number'])
+        elif event == 'vote':
+            self.replay.vote(data['voter'], data['target'])
+        elif event == 'night_action':
+            self.replay.night_action(data['player'], data['type'], data['target'])
+        elif event == 'death':
+            self.replay.death(data['id'])
+
+    def journal_phase(self):
+        self.journal('phase', {
+            'phase': self.phase,
+            'day_number': self.day_number,
+            'ends_at': self.ends_at,
+            'closed': not self.phase_open
+        })
+
+    def assign_roles(self):
+        # A special role is in play when the lobby setting named after it is on
+        settings = self.lobby.settings
+        specials = [role for role in engine.ROLES if getattr(settings, role.value, False)]
+        roles = engine.assign_roles(self.players, specials)
+        for pid, role in roles.items():
+            self.players[pid].role = role
+        self.index_players()
+
+    def index_players(self):
+        for alive in self.alive_by_role.values():
+            alive.clear()
+        for player in self.players.values():
+            if player.alive:
+                self.alive_by_role[player.role][player.id] = player
+        self.alive_count = sum(len(alive) for alive in self.alive_by_role.values())
+
+    def drop_alive(self, player):
+        """Take a dead or departed player out of the alive counts."""
+        if self.alive_by_role[player.role].pop(player.id, None):
+            self.alive_count -= 1
+
+    def forget_player(self, player):
+        """Take a departed player out of the alive counts, tonight's actions
+        and the tally, withdrawing their ballot and every ballot cast for them."""
+        self.drop_alive(player)
+        self.night_actions.withdraw(player.id)
+        for voter_id in self.votes.withdraw(player.id):
+            voter = self.players.get(voter_id)
+            if voter is not None:
+                voter.vote_target = None
+        target = self.players.get(player.vote_target)
+        if target is not None:
+            target.votes = self.votes.counts.get(target.id, 0)
+
+    @property
+    def mafia_alive(self):
+        return len(self.alive_by_role[Role.MAFIA])
+
+    @property
+    def night_actors_alive(self):
+        """How many night actions to expect before the night can end early."""
+        return sum(len(self.alive_by_role[role]) for role in NIGHT_ACTIONS)
 
     def start_night(self):
-        self.phase = "night"
+        self.phase = Phase.NIGHT
         self.day_number += 1
-        self.time_remaining = self.lobby.settings['game_time']
-        self.night_actions = {}
+        self.night_actions = NightActions()
+        self.set_timer(self.lobby.settings.game_time)
         self.broadcast_game_state()
         self.add_communication("The night falls. Mafia, choose your target.")
 
         # Notify mafia members about each other
-        mafia_members = [p.name for p in self.players.values() if p.role == "mafia" and p.alive]
-        if len(mafia_members) > 1:
-            for player in self.players.values():
-                if player.role == "mafia" and player.alive:
-                    self.send_private_message(player, f"Your mafia teammates are: {', '.join(mafia_members)}")
+        mafia = self.alive_by_role[Role.MAFIA].values()
+        if len(mafia) > 1:
+            mafia_members = [p.name for p in mafia]
+            for player in mafia:
+                self.send_private_message(player, f"Your mafia teammates are: {', '.join(mafia_members)}")
 
     def start_day(self):
-        self.phase = "day"
-        self.time_remaining = self.lobby.settings['game_time']
+        self.phase = Phase.DAY
+        self.set_timer(self.lobby.settings.game_time)
         self.process_night_actions()
+        if self.check_game_end():
+            return
         self.broadcast_game_state()
         self.add_communication("The day begins. Discuss and find the mafia!")
 
     def start_discussion(self):
-        self.phase = "discussion"
-        self.time_remaining = self.lobby.settings['game_time'] // 2
+        self.phase = Phase.DISCUSSION
+        self.set_timer(self.lobby.settings.game_time // 2)
         self.broadcast_game_state()
         self.add_communication("Discussion phase begins. Talk about your suspicions!")
 
     def start_voting(self):
-        self.phase = "voting"
-        self.time_remaining = self.lobby.settings['game_time'] // 2
-        self.votes = {}
+        self.phase = Phase.VOTING
+        self.reset_votes()
+        self.set_timer(self.lobby.settings.game_time // 2)
+        self.broadcast_game_state()
+        self.add_communication("Voting phase begins. Vote for who you think is mafia!")
+
+    @property
+    def time_remaining(self):
+        if self.deadline is None:
+            return 0
+        return max(0, math.ceil(self.deadline - time.monotonic()))
+
+    @property
+    def ends_at(self):
+        """Wall-clock end of the current phase, for persisting across restarts."""
+        if self.deadline is None:
+            return None
+        return time.time() + self.deadline - time.monotonic()
+
+    def set_timer(self, seconds):
+        self.deadline = phase_scheduler.schedule(self.lobby.code, seconds)
+        self.journal_phase()
+
+    def stop_timer(self):
+        self.deadline = None
+        phase_scheduler.cancel(self.lobby.code)
+        self.journal_phase()
+
+    def resume_timer(self, ends_at):
+        if ends_at is None or self.phase in [Phase.SETUP, Phase.ENDED]:
+            self.deadline = None
+        else:
+            self.deadline = phase_scheduler.schedule(self.lobby.code, max(0, ends_at - time.time()))
+
+    def reset_votes(self):
+        self.votes = VoteTally()
         for player in self.players.values():
             player.votes = 0
             player.vote_target = None
-        self.broadcast_game_state()
-        self.add_communication("Voting phase begins. Vote for who you think is mafia!")
+
+    @property
+    def phase_open(self):
+        return self.closed_phase != (self.phase, self.day_number)
+
+    def close_phase(self, delay):
+        """Stop accepting actions for this phase and move on after `delay`.
+
+        Returns False if the phase was already closed, so concurrent handlers
+        trigger exactly one transition.
+        """
+        if not self.phase_open:
+            return False
+        self.closed_phase = (self.phase, self.day_number)
+        self.set_timer(delay)
+        return True
+
+    def advance_phase(self):
+        # Time's up, proceed to next phase
+        if self.phase == Phase.NIGHT:
+            self.start_day()
+        elif self.phase == Phase.DAY:
+            self.start_discussion()
+        elif self.phase == Phase.DISCUSSION:
+            self.start_voting()
+        elif self.phase == Phase.VOTING:
+            # Auto-process votes if not all are in
+            self.start_night()
+
+    def kill_player(self, player_id):
+        player = self.players[player_id]
+        if player.alive:
+            player.alive = False
+            self.drop_alive(player)
+            self.view_changes.add(player_id)
+            self.journal('death', {'id': player_id})
+
+    def cast_vote(self, player, target_id):
+        previous = self.votes.cast(player.id, target_id)
+        if previous != target_id:
+            if previous in self.players:
+                self.players[previous].votes -= 1
+            self.players[target_id].votes += 1
+        player.vote_target = target_id
+        self.journal('vote', {'voter': player.id, 'target': target_id})
+
+    def submit_night_action(self, player, action_type, target_id):
+        self.night_actions.submit(player.id, action_type, target_id)
+        self.journal('night_action', {'player': player.id, 'type': action_type, 'target': target_id})
 
     def process_night_actions(self):
-        # Process mafia kill
-        mafia_target_id = None
-        doctor_target_id = None
-        detective_target_id = None
-
-        # Find targets
-        for action in self.night_actions.values():
-            if action['type'] == 'mafia_kill':
-                mafia_target_id = action['target_id']
-            elif action['type'] == 'doctor_heal':
-                doctor_target_id = action['target_id']
-            elif action['type'] == 'detective_investigate':
-                detective_target_id = action['target_id']
+        result = self.night_actions.resolve(self.players)
 
         # Apply actions
-        if mafia_target_id and mafia_target_id in self.players:
-            if mafia_target_id != doctor_target_id:  # Doctor saves if they targeted the same person
-                self.players[mafia_target_id].alive = False
-                self.add_communication(f"{self.players[mafia_target_id].name} was killed by the mafia!")
-            else:
-                self.add_communication("The doctor saved someone from the mafia's attack!")
+        if result.killed is not None:
+            self.kill_player(result.killed)
+            self.add_communication(f"{self.players[result.killed].name} was killed by the mafia!")
+        elif result.target is not None:
+            self.add_communication("The doctor saved someone from the mafia's attack!")
         else:
             self.add_communication("The mafia did not kill anyone tonight.")
 
         # Process detective investigation
-        if detective_target_id and detective_target_id in self.players:
-            detective_id = None
-            for pid, action in self.night_actions.items():
-                if action['type'] == 'detective_investigate':
-                    detective_id = pid
-                    break
-
-            if detective_id:
-                target_role = self.players[detective_target_id].role
-                role_hint = "suspicious" if target_role == "mafia" else "trustworthy"
-                self.send_private_message(
-                    self.players[detective_id],
-                    f"Your investigation reveals that {self.players[detective_target_id].name} seems {role_hint}."
-                )
-
-    def check_game_end(self):
-        mafia_count = 0
-        town_count = 0
+        for detective_id, target_id, suspicious in result.investigations:
+            role_hint = "suspicious" if suspicious else "trustworthy"
+            self.send_private_message(
+                self.players[detective_id],
+                f"Your investigation reveals that {self.players[target_id].name} seems {role_hint}."
+            )
+
+    def resolve_votes(self):
+        if not self.votes:
+            self.add_communication("No votes were cast.")
+        elif self.votes.leader is None:
+            # Tie vote, no elimination
+            self.add_communication("It's a tie! No one is eliminated.")
+        elif self.votes.leader not in self.players:
+            # Leaving withdraws the ballots for a player, but never act on a stale tally
+            self.add_communication("The accused has left the town. No one is eliminated.")
+        else:
+            eliminated_id = self.votes.leader
+            self.kill_player(eliminated_id)
+            self.add_communication(f"{self.players[eliminated_id].name} has been eliminated!")
 
-        for player in self.players.values():
-            if player.alive:
-                if player.role == "mafia":
-                    mafia_count += 1
-                else:
-                    town_count += 1
+            # Ending the game cancels the queued night
+            self.check_game_end()
 
-        if mafia_count == 0:
-            self.phase = "ended"
+    def check_game_end(self):
+        winner = engine.winner(self.mafia_alive, self.alive_count - self.mafia_alive)
+        if winner == 'town':
+            self.phase = Phase.ENDED
+            self.stop_timer()
             self.add_communication("The townsfolk have won! All mafia members have been eliminated.")
-            return True
-        elif mafia_count >= town_count:
-            self.phase = "ended"
+        elif winner == 'mafia':
+            self.phase = Phase.ENDED
+            self.stop_timer()
             self.add_communication("The mafia have won! They outnumber the townsfolk.")
-            return True
+        else:
+            return False
 
-        return False
+        self.replay.end(winner)
 
-    def add_communication(self, message, player_name=None):
-        if player_name:
-            full_message = f"{player_name}: {message}"
-        else:
-            full_message = message
+        schedule_lobby_expiry(self.lobby)
+        return True
 
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        self.communications.append({
-            'timestamp': timestamp,
-            'message': full_message
-        })
+    @property
+    def replay_id(self):
+        """The game's replay, once it has ended; None before or if not recorded."""
+        return self.replay.id if self.phase == Phase.ENDED else None
 
-        # Broadcast to all players in the game
-        socketio.emit('new_message', {
-            'timestamp': timestamp,
-            'message': full_message
-        }, room=self.lobby.code)
+    @property
+    def communications(self):
+        return self.lobby.messages
+
+    def add_communication(self, message, player=None, audience=None, coalesce=False):
+        self.pending_messages.append(self.lobby.add_message(message, player and player.name, audience))
+        self.replay.chat(player and player.id, audience, message)
+
+        # Broadcast to every view the message is meant for. Player chat is
+        # coalesced into one patch per batch window; any broadcast before
+        # then carries it along.
+        if coalesce:
+            chat_batcher.add_game(self)
+        else:
+            self.broadcast_game_state()
 
     def send_private_message(self, player, message):
-        timestamp = datetime.now().strftime("%H:%M:%S")
-        socketio.emit('private_message', {
-            'timestamp': timestamp,
+        log = self.private_log.setdefault(player.id, deque(maxlen=PRIVATE_LOG_SIZE))
+        data = {
+            'seq': log[-1]['seq'] + 1 if log else 1,
+            'timestamp': current_timestamp(),
             'message': message
-        }, room=player.sid)
+        }
+        log.append(data)
+        self.replay.private(player.id, message)
+        # A disconnected player gets it from the log when they resume
+        if player.sid:
+            transport.emit('private_message', data, player.sid)
+
+    def missed_patches(self, view, stream, version):
+        """The patches for `view` after `version`, or None if the client
+        needs a full snapshot instead."""
+        if stream != self.stream or version is None or version > self.version:
+            return None
+        log = self.patch_log[view]
+        if version == self.version:
+            return []
+        if not log or log[0]['base'] > version:
+            return None  # Truncated
+        patches = [patch for patch in log if patch['base'] >= version]
+        # Only the newest phase change should set the client's countdown
+        for index in range(len(patches) - 1, -1, -1):
+            if 'phase' in patches[index]:
+                patches[index] = dict(patches[index], time_remaining=self.time_remaining)
+                break
+        return patches
+
+    def missed_private_messages(self, player, stream, seq):
+        if stream != self.stream:
+            seq = 0
+        return [data for data in self.private_log.get(player.id, ()) if data['seq'] > seq]
+
+    def get_view(self, player):
+        if not player.alive:
+            return "dead"
+        if player.role == Role.MAFIA:
+            return "mafia"
+        return "town"
+
+    def role_visible(self, player, view):
+        return (view == "dead" or self.phase == Phase.ENDED or not player.alive or
+                (view == "mafia" and player.role == Role.MAFIA))
+
+    def project_player(self, player, view):
+        data = player.to_dict()
+        if not self.role_visible(player, view):
+            data['role'] = None
+        return data
+
+    def project_messages(self, messages, view):
+        return [message_dict(entry) for entry in messages if entry[0] in VIEW_AUDIENCES[view]]
 
     def broadcast_game_state(self):
-        game_state = self.get_game_state()
-        socketio.emit('game_update', game_state, room=self.lobby.code)
-
-    def get_game_state(self):
-        players_data = {pid: player.to_dict() for pid, player in self.players.items()}
-
-        return {
-            'phase': self.phase,
-            'day_number': self.day_number,
-            'time_remaining': self.time_remaining,
-            'players': players_data,
-            'communications': list(self.communications)
-        }
+        patches = self.get_game_patches()
+        if patches:
+            for view, patch in patches.items():
+                transport.emit('game_update', patch, view_room(self.lobby.code, view))
+            spectator_feed.add(self.lobby.code, patches['town'])
+        self.update_view_rooms()
+
+    def update_view_rooms(self):
+        """Move players whose view changed (e.g. on death) and resync them."""
+        changed, self.view_changes = self.view_changes, set()
+        for pid in changed:
+            player = self.players.get(pid)
+            if player is None:
+                continue  # died, then left before this broadcast
+            view = self.player_views.get(pid)
+            new_view = self.get_view(player)
+            if view and player.sid and new_view != view:
+                transport.leave_room(player.sid, view_room(self.lobby.code, view))
+                transport.enter_room(player.sid, view_room(self.lobby.code, new_view))
+                self.player_views[pid] = new_view
+                transport.emit('game_update', self.get_game_state(new_view), player.sid)
+
+    def join_view_room(self, player, sid):
+        view = self.get_view(player)
+        old_view = self.player_views.get(player.id)
+        if old_view and old_view != view:
+            transport.leave_room(sid, view_room(self.lobby.code, old_view))
+        transport.enter_room(sid, view_room(self.lobby.code, view))
+        self.player_views[player.id] = view
+
+    @SERIALIZE_SECONDS.timed
+    def get_game_patches(self):
+        """Return one patch per view with the changes since the last broadcast,
+        or None if nothing changed.
+
+        Every view advances to the same version, even when its own patch is
+        empty. Clients apply a patch only on top of `base`; on a version gap
+        they ask for a full snapshot with `request_game_state`.
+        """
+        patches = {view: {} for view in VIEWS}
+
+        phase = (self.phase, self.day_number, self.deadline)
+        if phase != self.sent_phase:
+            for patch in patches.values():
+                patch['phase'] = self.phase
+                patch['day_number'] = self.day_number
+                patch['time_remaining'] = self.time_remaining
+                if self.phase == Phase.ENDED:
+                    patch['replay_id'] = self.replay_id
+            self.sent_phase = phase
+
+        for view, patch in patches.items():
+            sent_players = self.sent_players[view]
+            players_data = {}
+            for pid, player in self.players.items():
+                current = self.project_player(player, view)
+                previous = sent_players.get(pid, {})
+                changed = {key: value for key, value in current.items() if previous.get(key) != value}
+                if changed:
+                    players_data[pid] = changed
+                    sent_players[pid] = current
+            if players_data:
+                patch['players'] = players_data
+
+            if self.pending_messages:
+                messages = self.project_messages(self.pending_messages, view)
+                if messages:
+                    patch['messages'] = messages
+        self.pending_messages = []
+
+        if not any(patches.values()):
+            return None
+
+        base = self.version
+        self.version += 1
+        self.snapshot_cache = {}
+        for view, patch in patches.items():
+            patch['base'] = base
+            patch['version'] = self.version
+            self.patch_log[view].append(patch)
+        return patches
+
+    @SERIALIZE_SECONDS.timed
+    def get_game_state(self, view="town"):
+        snapshot = self.snapshot_cache.get(view)
+        if snapshot is None:
+            players_data = {pid: self.project_player(player, view) for pid, player in self.players.items()}
+            messages = self.communications
+            if self.pending_messages:
+                # These go out in the next patch, on top of this snapshot;
+                # including them here would show a resyncing client them twice
+                pending = set(map(id, self.pending_messages))
+                messages = [entry for entry in messages if id(entry) not in pending]
+
+            snapshot = {
+                'full': True,
+                'view': view,
+                'stream': self.stream,
+                'version': self.version,
+                'phase': self.phase,
+                'day_number': self.day_number,
+                'time_remaining': self.time_remaining,
+                'replay_id': self.replay_id,
+                'players': players_data,
+                'communications': self.project_messages(messages, view)
+            }
+            self.snapshot_cache[view] = snapshot
+        return dict(snapshot, time_remaining=self.time_remaining)
+
+
+VIEWS = ("town", "mafia", "dead")
+
+# Reconnect replay retention, per view and per player
+PATCH_LOG_SIZE = 64
+PRIVATE_LOG_SIZE = 32
+
+# Which message audiences each view receives; None means everyone
+VIEW_AUDIENCES = {
+    "town": {None},
+    "mafia": {None, "mafia"},
+    "dead": {None, "mafia"},
+}
+
+
+def view_room(code, view):
+    return f"{code}:{view}"
+
+
+def spectator_room(code):
+    return f"{code}:spectators"
+
+
+def current_timestamp():
+    """HH:MM:SS for now, formatted at most once per second."""
+    now = int(time.time())
+    if now != _timestamp_cache[0]:
+        _timestamp_cache[0] = now
+        _timestamp_cache[1] = time.strftime("%H:%M:%S", time.localtime(now))
+    return _timestamp_cache[1]
+
+
+_timestamp_cache = [None, None]
+
+
+def message_dict(entry):
+    audience, timestamp, message = entry
+    return {
+        'timestamp': timestamp,
+        'message': message
+    }
 
 
 # Global state (in production, use a proper database)
@@ -283,14 +929,609 @@ lobbies = {}
 players = {}
 
 
+# Per-lobby actors. Handlers, views, phase deadlines and the reaper all
+# mutate a lobby through lobby_command, never concurrently with each other.
+try:
+    from greenlet import getcurrent as current_task
+except ImportError:  # no green threads without greenlet
+    current_task = threading.get_ident
+
+
+class LobbyCommand:
+    __slots__ = ('func', 'args', 'value', 'error', 'done')
+
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.value = None
+        self.error = None
+        self.done = None  # an event, only when the submitter has to wait
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args)
+        except Exception as exc:
+            self.error = exc
+        if self.done is not None:
+            self.done.set()
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class LobbyActor:
+    """Single-consumer mailbox applying one lobby's commands in arrival order.
+
+    A task that submits to an idle actor becomes its consumer and drains the
+    mailbox itself, so an uncontended command runs inline without a handoff.
+    A task that finds another one draining leaves its command in the mailbox
+    and waits for it to be run. Actors of different lobbies share nothing, so
+    their commands run in parallel on the server's handler threads.
+    """
+    __slots__ = ('mailbox', 'lock', 'consumer')
+
+    def __init__(self):
+        self.mailbox = deque()
+        self.lock = threading.Lock()  # guards mailbox and consumer only
+        self.consumer = None
+
+    def call(self, func, *args):
+        task = current_task()
+        if self.consumer is task:
+            # Issued from inside one of this lobby's own commands
+            return func(*args)
+        command = LobbyCommand(func, args)
+        with self.lock:
+            if self.consumer is None:
+                self.consumer = task
+            else:
+                command.done = transport.create_event()
+            self.mailbox.append(command)
+        if command.done is None:
+            self.drain()
+        else:
+            ACTOR_CONTENDED.inc()
+            command.done.wait()
+        return command.result()
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.mailbox:
+                    self.consumer = None
+                    return
+                command = self.mailbox.popleft()
+            command.run()
+
+
+actors = {}  # lobby code -> LobbyActor
+
+
+def lobby_command(code, func, *args):
+    """Run `func(*args)` on the actor of lobby `code` and return its result."""
+    if code is None:
+        return func(*args)
+    actor = actors.get(code)
+    if actor is None:
+        actor = actors.setdefault(code, LobbyActor())
+    try:
+        return actor.call(func, *args)
+    finally:
+        # Closed lobbies and unknown codes don't keep an actor
+        if code not in lobbies:
+            actors.pop(code, None)
+
+
+class ChatBatcher:
+    """Coalesces outbound chat per room into one emit per batch window.
+
+    Lobby messages go out as a single `messages_batch` event per room; game
+    chat is flushed as one `game_update` patch per game. With a window of 0
+    everything is sent immediately.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.rooms = {}  # room -> [message entries]
+        self.games = set()
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def add_message(self, room, entry):
+        if self.window <= 0:
+            transport.emit('messages_batch', {'messages': [message_dict(entry)]}, room)
+            return
+        with self.lock:
+            self.rooms.setdefault(room, []).append(entry)
+            self.schedule_flush()
+
+    def add_game(self, game):
+        if self.window <= 0:
+            game.broadcast_game_state()
+            return
+        with self.lock:
+            self.games.add(game)
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            transport.call_later(self.window, self.flush)
+
+    def flush(self):
+        with self.lock:
+            rooms, self.rooms = self.rooms, {}
+            games, self.games = self.games, set()
+            self.flush_scheduled = False
+        for room, entries in rooms.items():
+            transport.emit('messages_batch', {'messages': [message_dict(entry) for entry in entries]}, room)
+        for game in games:
+            # A no-op if a phase change or vote already sent the messages
+            lobby_command(game.lobby.code, game.broadcast_game_state)
+
+
+chat_batcher = ChatBatcher(int(os.environ.get('MAFIA_CHAT_BATCH_MS', 50)) / 1000)
+
+
+class SpectatorFeed:
+    """Throttled, role-hidden game updates for spectators.
+
+    Spectators are not players: they only sit in a game's spectator room, so
+    max_players doesn't cap them and the game keeps no state per spectator.
+    Town view patches are merged per game and go out as one
+    `spectator_update` per game at most `rate` times a second, a single
+    room broadcast however many are watching. With a message queue every
+    worker delivers that broadcast to its own sockets, so spectators can be
+    pointed at separate fan-out workers (MAFIA_SPECTATOR_URL) and cost the
+    players' process one publish per update. A rate of 0 sends every patch.
+
+    Merged updates carry `base` and `version` like game patches, and their
+    messages as [version, messages] pairs, so a client that fetched a newer
+    snapshot from /api/spectate/<code> can apply just the part it lacks.
+
+    Games nobody watches are skipped. Spectators are counted per game as
+    they join and disconnect; when they may sit on another worker
+    (`remote`), every game is fed since this one can't see them.
+    """
+
+    def __init__(self, rate, remote=False):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.remote = remote
+        self.pending = {}  # lobby code -> merged update
+        self.watching = {}  # spectator sid -> lobby code
+        self.watchers = {}  # lobby code -> spectator sockets on this worker
+        self.flush_scheduled = False
+        self.lock = threading.Lock()
+
+    def watch(self, sid, code):
+        """Count `sid` as watching `code`; returns the game it watched before."""
+        with self.lock:
+            previous = self._unwatch(sid)
+            self.watching[sid] = code
+            self.watchers[code] = self.watchers.get(code, 0) + 1
+        return previous
+
+    def unwatch(self, sid):
+        with self.lock:
+            self._unwatch(sid)
+
+    def _unwatch(self, sid):
+        code = self.watching.pop(sid, None)
+        if code is not None:
+            if self.watchers[code] > 1:
+                self.watchers[code] -= 1
+            else:
+                del self.watchers[code]
+        return code
+
+    def add(self, code, patch):
+        if not self.remote and code not in self.watchers:
+            return
+        if not self.interval:
+            transport.emit('spectator_update', self.finish(self.merge(None, patch)), spectator_room(code))
+            return
+        with self.lock:
+            self.pending[code] = self.merge(self.pending.get(code), patch)
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                transport.call_later(self.interval, self.flush)
+
+    @staticmethod
+    def merge(update, patch):
+        if update is None:
+            update = {'base': patch['base'], 'players': {}, 'messages': []}
+        update['version'] = patch['version']
+        if 'phase' in patch:
+            update['phase'] = patch['phase']
+            update['day_number'] = patch['day_number']
+            update['deadline'] = time.monotonic() + patch['time_remaining']
+        for pid, changes in patch.get('players', {}).items():
+            update['players'].setdefault(pid, {}).update(changes)
+        if 'messages' in patch:
+            update['messages'].append([patch['version'], patch['messages']])
+        return update
+
+    @staticmethod
+    def finish(update):
+        # Count down from when the update is sent, not when the phase changed
+        deadline = update.pop('deadline', None)
+        if deadline is not None:
+            update['time_remaining'] = max(0, math.ceil(deadline - time.monotonic()))
+        return update
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.flush_scheduled = False
+        for code, update in pending.items():
+            transport.emit('spectator_update', self.finish(update), spectator_room(code))
+
+
+# Base URL of the workers holding spectator sockets; this one by default
+SPECTATOR_URL = os.environ.get('MAFIA_SPECTATOR_URL', '').rstrip('/')
+spectator_feed = SpectatorFeed(float(os.environ.get('MAFIA_SPECTATOR_RATE', 2)),
+                               remote=bool(SPECTATOR_URL) or SHARD_COUNT > 1)
+
+
+class RateLimiter:
+    """Token buckets refilled at `rate` tokens a second up to `burst`.
+
+    A bucket is one [tokens, last refill] pair per key (a player id or a
+    lobby code), topped up lazily when the key is next checked, so idle keys
+    cost nothing until `discard` drops them with their player or lobby. A
+    rate of 0 turns the limit off.
+    """
+
+    def __init__(self, name, rate, burst):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {}  # key -> [tokens, monotonic time of last refill]
+
+    def allow(self, key, cost=1):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < cost:
+            bucket[0] = tokens
+            RATE_LIMITED.inc(self.name)
+            return False
+        bucket[0] = tokens - cost
+        return True
+
+    def retry_after(self, key, cost=1):
+        bucket = self.buckets.get(key)
+        return max(0.0, (cost - bucket[0]) / self.rate) if bucket else 0.0
+
+    def discard(self, key):
+        self.buckets.pop(key, None)
+
+
+def env_float(name, default):
+    return float(os.environ.get(name, default))
+
+
+chat_limiter = RateLimiter('chat', env_float('MAFIA_CHAT_RATE', 1), env_float('MAFIA_CHAT_BURST', 5))
+room_chat_limiter = RateLimiter('room_chat', env_float('MAFIA_ROOM_CHAT_RATE', 10), env_float('MAFIA_ROOM_CHAT_BURST', 30))
+# Votes and night actions share one bucket per player
+action_limiter = RateLimiter('action', env_float('MAFIA_ACTION_RATE', 2), env_float('MAFIA_ACTION_BURST', 5))
+MAX_MESSAGE_LENGTH = int(os.environ.get('MAFIA_MAX_MESSAGE_LENGTH', 500))
+DUPLICATE_WINDOW = env_float('MAFIA_DUPLICATE_WINDOW', 30)  # seconds a repeated line is dropped for
+recent_messages = {}  # player id -> (last chat line, monotonic time sent)
+
+
+def is_duplicate(player_id, message):
+    """True if a player repeats their previous line within DUPLICATE_WINDOW.
+
+    Every attempt restarts the window, so a bot pasting one line on a loop
+    stays suppressed however slowly it repeats within the window.
+    """
+    now = time.monotonic()
+    previous = recent_messages.get(player_id)
+    recent_messages[player_id] = (message, now)
+    return previous is not None and previous[0] == message and now - previous[1] < DUPLICATE_WINDOW
+
+
+def forget_player(player_id):
+    """Drop a player along with their expiry and flood-protection state."""
+    players.pop(player_id, None)
+    player_expiry.discard(player_id)
+    chat_limiter.discard(player_id)
+    action_limiter.discard(player_id)
+    recent_messages.pop(player_id, None)
+
+
+def reject(client, event, message, retry_after=0.0):
+    client.emit('rate_limited', {'event': event, 'message': message, 'retry_after': round(retry_after, 1)})
+
+
+class LobbyIndex:
+    """Sorted index of joinable lobbies for the public lobby browser.
+
+    Lobbies are ordered by fewest free seats, then most players, then oldest,
+    so the ones closest to starting come first. Callers re-index a lobby
+    with `update` after anything that changes its seats, settings or game,
+    and `discard` it once it is deleted. Pages are keyed on the sort key of
+    the last lobby returned, so they stay stable while lobbies come and go.
+    """
+
+    def __init__(self):
+        self.keys = []  # sorted (free seats, -players, created, code)
+        self.entries = {}  # code -> its key in self.keys
+        self.lock = threading.Lock()  # lobby actors update it in parallel
+
+    def key(self, lobby):
+        return (lobby.settings.max_players - len(lobby.players), -len(lobby.players),
+                lobby.created_at.timestamp(), lobby.code)
+
+    def update(self, lobby):
+        with self.lock:
+            self._discard(lobby.code)
+            if lobby.game is None and len(lobby.players) < lobby.settings.max_players:
+                key = self.key(lobby)
+                bisect.insort(self.keys, key)
+                self.entries[lobby.code] = key
+
+    def discard(self, code):
+        with self.lock:
+            self._discard(code)
+
+    def _discard(self, code):
+        key = self.entries.pop(code, None)
+        if key is not None:
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def page(self, after=None, limit=20, match=None):
+        """Return up to `limit` lobbies sorted after the key `after`, and the
+        key to continue from (None on the last page)."""
+        with self.lock:
+            start = bisect.bisect_right(self.keys, after) if after else 0
+            found = []
+            for key in itertools.islice(self.keys, start, None):
+                lobby = lobbies.get(key[3])  # None while close_lobby is midway
+                if lobby is not None and (match is None or match(lobby)):
+                    found.append(lobby)
+                    if len(found) == limit:
+                        return found, key
+            return found, None
+
+
+lobby_index = LobbyIndex()
+
+
+class MatchQueue:
+    """Quick-match queue that places waiting players into lobbies in batches.
+
+    Tickets are buffered for one batch window, then placed in arrival order.
+    Players with the same preferred settings share a FIFO of quick-match
+    lobbies that still have free seats; a ticket joins the lobby at its head,
+    and a lobby leaves the FIFO once it fills or starts, so each placement
+    is amortized O(1). When the FIFO is empty a new lobby is created. At the
+    end of a batch, every touched lobby that has reached min_players starts
+    its game, so a burst fills lobbies before they start.
+
+    Only lobbies the queue created are filled: starting a game in a lobby
+    someone made by hand is left to its admin.
+    """
+
+    def __init__(self, window):
+        self.window = window
+        self.tickets = []  # (player, settings key)
+        self.open = {}  # settings key -> deque of lobby codes with free seats
+        self.matched = {}  # player id -> lobby code, until the player's socket is told
+        self.flush_scheduled = False
+        self.lock = threading.Lock()  # one flush at a time
+
+    def enqueue(self, player, settings):
+        key = tuple(sorted(settings.items()))
+        with self.lock:
+            self.tickets.append((player, key))
+            if self.window > 0 and not self.flush_scheduled:
+                self.flush_scheduled = True
+                transport.call_later(self.window, self.flush)
+        if self.window <= 0:
+            self.flush()
+
+    def place(self, player, key):
+        codes = self.open.setdefault(key, deque())
+        while codes:
+            # seat hands back the lobby itself: the reaper may close it, and
+            # drop it from `lobbies`, as soon as the seat is taken
+            lobby = lobby_command(codes[0], self.seat, codes[0], player)
+            if lobby:
+                return lobby
+            codes.popleft()
+
+        lobby = Lobby(generate_lobby_code(), player)
+        lobby.update_settings(dict(key))
+        lobbies[lobby.code] = lobby
+        schedule_lobby_expiry(lobby)
+        store.snapshot(lobby.code, lobby.to_record())
+        codes.append(lobby.code)
+        return lobby
+
+    @staticmethod
+    def seat(code, player):
+        lobby = lobbies.get(code)
+        if lobby and lobby.game is None and len(lobby.players) < lobby.settings.max_players:
+            lobby.add_player(player)
+            chat_batcher.add_message(code, lobby.add_message(f"{player.name} joined the lobby"))
+            return lobby
+        return None
+
+    @staticmethod
+    def settle(lobby):
+        if lobbies.get(lobby.code) is not lobby:
+            return  # reaped since the batch placed into it; don't re-index it
+        if len(lobby.players) >= lobby.settings.min_players:
+            start_game(lobby)
+        else:
+            lobby_index.update(lobby)
+            transport.emit('lobby_update', lobby.to_dict(), lobby.code)
+
+    def flush(self):
+        with self.lock:
+            tickets, self.tickets = self.tickets, []
+            self.flush_scheduled = False
+            touched = {}
+            for player, key in tickets:
+                lobby = self.place(player, key)
+                touched[lobby.code] = lobby
+                self.matched[player.id] = lobby.code
+
+        # url_for needs a request context, which a background task lacks
+        with app.test_request_context():
+            for lobby in touched.values():
+                lobby_command(lobby.code, self.settle, lobby)
+            # Players whose socket connects later are told on join_queue
+            for player, key in tickets:
+                if player.sid:
+                    lobby_command(player.lobby_code, self.notify, player)
+
+    def notify(self, player):
+        """Send a matched player to their lobby, or straight into its game."""
+        lobby = lobbies.get(self.matched.pop(player.id, None))
+        if lobby:
+            endpoint = 'game' if lobby.game else 'lobby'
+            transport.emit('match_found', {'redirect': url_for(endpoint, code=lobby.code)}, player.sid)
+
+
+match_queue = MatchQueue(int(os.environ.get('MAFIA_MATCH_BATCH_MS', 200)) / 1000)
+
+
 # Helper functions
 def generate_lobby_code():
     code = ''.join(random.choices('ABCDEFGHJKLMNPQRSTUVWXYZ23456789', k=6))
-    while code in lobbies:
+    while code in lobbies or shard_for(code) != SHARD_INDEX:
         code = ''.join(random.choices('ABCDEFGHJKLMNPQRSTUVWXYZ23456789', k=6))
     return code
 
 
+def shard_for(code):
+    return zlib.crc32(code.encode()) % SHARD_COUNT
+
+
+def owner_redirect(code):
+    """Redirect to the worker that owns `code`, or None if it is this one.
+
+    307 keeps the method and form body, so POST /join is replayed as-is.
+    """
+    shard = shard_for(code)
+    if shard == SHARD_INDEX:
+        return None
+    return redirect(SHARD_URLS[shard] + request.full_path.rstrip('?'), code=307)
+
+
+# HTTP caching: lobby and game pages carry strong ETags derived from the
+# lobby's version, so a client that reloads or polls an unchanged lobby gets
+# a 304, and the bodies themselves are rendered once per version.
+RENDER_CACHE_SIZE = int(os.environ.get('MAFIA_RENDER_CACHE_SIZE', 256))
+STATIC_MAX_AGE = 365 * 24 * 3600
+
+
+class RenderCache:
+    """LRU of rendered pages and serialized JSON, keyed by their ETag."""
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            body = self.entries.get(key)
+            if body is not None:
+                self.entries.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        with self.lock:
+            self.entries[key] = body
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return body
+
+
+render_cache = RenderCache(RENDER_CACHE_SIZE)
+
+
+def lobby_snapshot(lobby):
+    # On the lobby's actor, so the ETag and the data always match
+    return lobby.etag, lobby.to_dict()
+
+
+def cached_response(etag, render, mimetype='text/html'):
+    """A private, always-revalidated response for `etag`.
+
+    `render()` returns (etag, body) and only runs when the client's copy is
+    stale and the body is not cached; the ETag it returns wins, since the
+    lobby may have moved on since `etag` was read.
+    """
+    if request.if_none_match.contains(etag):
+        HTTP_CACHE.inc('not_modified')
+        response = app.response_class(status=304)
+    else:
+        body = render_cache.get(etag)
+        if body is None:
+            HTTP_CACHE.inc('miss')
+            etag, body = render()
+            render_cache.put(etag, body)
+        else:
+            HTTP_CACHE.inc('hit')
+        response = app.response_class(body, mimetype=mimetype)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+static_hashes = {}  # filename -> (mtime, content hash)
+
+
+def static_hash(filename):
+    path = os.path.join(app.static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = static_hashes.get(filename)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'rb') as f:
+            cached = static_hashes[filename] = (mtime, hashlib.blake2b(f.read(), digest_size=6).hexdigest())
+    return cached[1]
+
+
+@app.url_defaults
+def hash_static_urls(endpoint, values):
+    # static/codec.js?v=<content hash>: an edited file gets a new URL, so
+    # browsers can keep the old one for good
+    if endpoint == 'static' and 'filename' in values and 'v' not in values:
+        digest = static_hash(values['filename'])
+        if digest:
+            values['v'] = digest
+
+
+@app.after_request
+def cache_static(response):
+    if request.endpoint != 'static' or response.status_code not in (200, 304):
+        return response
+    digest = static_hash(request.view_args['filename'])
+    if digest and request.args.get('v') == digest:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+        response.cache_control.immutable = True
+    return response
+
+
 # Routes
 @app.route('/')
 def index():
@@ -310,13 +1551,21 @@ def create_lobby():
 
     # Create lobby
     lobby_code = generate_lobby_code()
-    player_obj = Player(player_id, player_name, None)
-    lobbies[lobby_code] = Lobby(lobby_code, player_obj)
-    players[player_id] = player_obj
+    lobby_command(lobby_code, open_lobby, Lobby(lobby_code, Player(player_id, player_name, None)))
 
     return redirect(url_for('lobby', code=lobby_code))
 
 
+def open_lobby(lobby):
+    creator = next(iter(lobby.players.values()))
+    lobbies[lobby.code] = lobby
+    players[creator.id] = creator
+    player_expiry.touch(creator.id, RECONNECT_GRACE)  # until their socket connects
+    lobby_index.update(lobby)
+    schedule_lobby_expiry(lobby)
+    store.snapshot(lobby.code, lobby.to_record())
+
+
 @app.route('/join', methods=['POST'])
 def join_lobby():
     player_name = request.form.get('player_name')
@@ -325,47 +1574,100 @@ def join_lobby():
     if not player_name or len(player_name.strip()) < 2:
         return redirect(url_for('index'))
 
-    if lobby_code not in lobbies:
-        return render_template('index.html', error="Lobby not found")
+    forward = owner_redirect(lobby_code)
+    if forward:
+        return forward
+
+    # Create player
+    player_obj = Player(secrets.token_hex(8), player_name, None)
+    error = lobby_command(lobby_code, seat_player, lobby_code, player_obj)
+    if error:
+        return render_template('index.html', error=error)
+
+    session['player_id'] = player_obj.id
+    session['player_name'] = player_name
+    return redirect(url_for('lobby', code=lobby_code))
 
-    lobby = lobbies[lobby_code]
-    if len(lobby.players) >= lobby.settings['max_players']:
-        return render_template('index.html', error="Lobby is full")
 
+def seat_player(lobby_code, player):
+    """Add a player to a lobby; returns why they can't join, or None."""
+    lobby = lobbies.get(lobby_code)
+    if lobby is None:
+        return "Lobby not found"
+    if len(lobby.players) >= lobby.settings.max_players:
+        return "Lobby is full"
     if lobby.game:
-        return render_template('index.html', error="Game already in progress")
+        return "Game already in progress"
+
+    lobby.add_player(player)
+    players[player.id] = player
+    player_expiry.touch(player.id, RECONNECT_GRACE)  # until their socket connects
+    lobby_index.update(lobby)
+
+    # Notify all players in the lobby
+    message = lobby.add_message(f"{player.name} joined the lobby")
+    chat_batcher.add_message(lobby_code, message)
+    transport.emit('lobby_update', lobby.to_dict(), lobby_code)
+    return None
+
+
+@app.route('/quickmatch', methods=['GET', 'POST'])
+def quickmatch():
+    """Queue for a quick match. The form takes player_name plus any lobby
+    settings as preferences, e.g. game_time=60 or night_chat=on."""
+    if request.method == 'GET':
+        return render_template('quickmatch.html')
+
+    player_name = request.form.get('player_name')
+    if not player_name or len(player_name.strip()) < 2:
+        return redirect(url_for('index'))
+
+    try:
+        settings = parse_settings(request.form)
+    except ValueError as exc:
+        return render_template('index.html', error=str(exc))
+    settings['min_players'] = max(4, settings.get('min_players', 4))
+    settings['max_players'] = min(16, max(settings['min_players'], settings.get('max_players', 12)))
 
-    # Create player
     player_id = secrets.token_hex(8)
     session['player_id'] = player_id
     session['player_name'] = player_name
 
     player_obj = Player(player_id, player_name, None)
-    lobby.players[player_id] = player_obj
     players[player_id] = player_obj
+    player_expiry.touch(player_id, RECONNECT_GRACE)  # until their socket connects
+    match_queue.enqueue(player_obj, settings)
 
-    # Notify all players in the lobby
-    message = lobby.add_message(f"{player_name} joined the lobby")
-    socketio.emit('new_message', message, room=lobby_code)
-    socketio.emit('lobby_update', lobby.to_dict(), room=lobby_code)
-
-    return redirect(url_for('lobby', code=lobby_code))
+    return redirect(url_for('quickmatch'))
 
 
 @app.route('/lobby/<code>')
 def lobby(code):
-    if code not in lobbies:
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
+    lobby = lobbies.get(code)
+    if lobby is None:
         return redirect(url_for('index'))
 
     player_id = session.get('player_id')
-    if not player_id or player_id not in lobbies[code].players:
+    if not player_id or player_id not in lobby.players:
         return redirect(url_for('index'))
 
-    return render_template('lobby.html', lobby=lobbies[code].to_dict(), player_id=player_id)
+    def render():
+        etag, data = lobby_command(code, lobby_snapshot, lobby)
+        return f"{etag}-page-{player_id}", render_template('lobby.html', lobby=data, player_id=player_id)
+
+    return cached_response(f"{lobby.etag}-page-{player_id}", render)
 
 
 @app.route('/game/<code>')
 def game(code):
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
     if code not in lobbies:
         return redirect(url_for('index'))
 
@@ -376,88 +1678,356 @@ def game(code):
     if not lobbies[code].game:
         return redirect(url_for('lobby', code=code))
 
+    # The page only shows the player's role, fixed for the whole game
+    etag = f"{code}-{lobbies[code].game.stream}-game-{player_id}"
     player = lobbies[code].players[player_id]
-    return render_template('game.html', lobby_code=code, player=player.to_dict())
+    return cached_response(etag, lambda: (etag, render_template('game.html', lobby_code=code, player=player.to_dict())))
+
+
+@app.route('/spectate')
+def spectate_form():
+    code = request.args.get('lobby_code', '').upper().strip()
+    if not code:
+        return redirect(url_for('index'))
+    return redirect(url_for('spectate', code=code))
+
+
+@app.route('/spectate/<code>')
+def spectate(code):
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
+    lobby = lobbies.get(code)
+    if lobby is None or lobby.game is None:
+        return render_template('index.html', error="No game to watch with that code")
+
+    return render_template('spectate.html', lobby_code=code, socket_url=SPECTATOR_URL)
+
+
+@app.route('/api/spectate/<code>')
+def api_spectate(code):
+    """Role-hidden snapshot a spectator starts from before applying updates."""
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
+    lobby = lobbies.get(code)
+    if lobby is None or lobby.game is None:
+        return jsonify({'error': 'Game not found'}), 404
+
+    return jsonify(lobby_command(code, lobby.game.get_game_state, "town"))
+
+
+@app.route('/api/replay/<replay_id>')
+def api_replay(replay_id):
+    """A finished game's events as JSON lines, streamed from the replay file.
+
+    ?day=N starts at night N and ?until=M stops after day M; the setup
+    events naming the players always come first.
+    """
+    if not REPLAY_ID.match(replay_id):
+        return jsonify({'error': 'Replay not found'}), 404
+    code = replay_id.split('-')[0]
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
+    # No peeking at roles while the game is still on
+    lobby = lobbies.get(code)
+    if lobby is not None and lobby.game is not None and lobby.game.phase != Phase.ENDED:
+        return jsonify({'error': 'Game still in progress'}), 403
+    if not replays.exists(replay_id):
+        return jsonify({'error': 'Replay not found'}), 404
+
+    from_day = request.args.get('day', 0, type=int)
+    until_day = request.args.get('until', None, type=int)
+
+    def generate():
+        for event in read_replay(replays.path(replay_id), from_day, until_day):
+            yield json.dumps(event) + '\n'
+
+    return app.response_class(generate(), mimetype='application/x-ndjson')
 
 
 @app.route('/api/lobby/<code>')
 def api_lobby(code):
-    if code not in lobbies:
+    forward = owner_redirect(code)
+    if forward:
+        return forward
+
+    lobby = lobbies.get(code)
+    if lobby is None:
         return jsonify({'error': 'Lobby not found'}), 404
 
-    return jsonify(lobbies[code].to_dict())
+    def render():
+        etag, data = lobby_command(code, lobby_snapshot, lobby)
+        return f"{etag}-json", codec.fast_json.dumps(data)
+
+    return cached_response(f"{lobby.etag}-json", render, 'application/json')
+
+
+def parse_settings(values):
+    """Lobby settings present in a form or query string, converted to the
+    types LobbySettings uses. Raises ValueError on a malformed number."""
+    defaults = LobbySettings()
+    settings = {}
+    for name in LobbySettings.__slots__:
+        value = values.get(name)
+        if value is None:
+            continue
+        if isinstance(getattr(defaults, name), bool):
+            settings[name] = value.lower() in ('1', 'true', 'yes', 'on')
+        elif value.isdigit():
+            settings[name] = int(value)
+        else:
+            raise ValueError(f'Invalid value for {name}')
+    return settings
+
+
+def lobby_summary(lobby):
+    return {
+        'code': lobby.code,
+        'player_count': len(lobby.players),
+        'free_seats': lobby.settings.max_players - len(lobby.players),
+        'created_at': lobby.created_at.isoformat(),
+        'settings': lobby.settings.to_dict()
+    }
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key, separators=(',', ':')).encode()).decode()
+
+
+def decode_cursor(cursor):
+    free, players_neg, created, code = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return (int(free), int(players_neg), float(created), str(code))
+
+
+@app.route('/api/lobbies')
+def api_lobbies():
+    """Joinable lobbies on this worker, closest to starting first.
+
+    Query parameters: `limit` (1-100), `cursor` from the previous page's
+    `next_cursor`, and any setting name to filter on, e.g.
+    `?night_chat=true&game_time=60`.
+    """
+    try:
+        filters = parse_settings(request.args)
+    except ValueError as exc:
+        return jsonify({'error': str(exc)}), 400
+
+    try:
+        after = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid cursor'}), 400
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+    def match(lobby):
+        return all(getattr(lobby.settings, name) == value for name, value in filters.items())
+
+    found, last = lobby_index.page(after, limit, match if filters else None)
+    return jsonify({
+        'lobbies': [lobby_summary(lobby) for lobby in found],
+        'next_cursor': encode_cursor(last) if last else None
+    })
+
+
+def games_by_phase():
+    counts = {}
+    for lobby in list(lobbies.values()):
+        if lobby.game:
+            counts[str(lobby.game.phase)] = counts.get(str(lobby.game.phase), 0) + 1
+    return counts
+
+
+metrics.Gauge('mafia_lobbies', 'Open lobbies on this worker.', lambda: len(lobbies))
+metrics.Gauge('mafia_games', 'Games on this worker by phase.', games_by_phase, label='phase')
+metrics.Gauge('mafia_players', 'Players in open lobbies.', lambda: sum(len(lobby.players) for lobby in list(lobbies.values())))
+metrics.Gauge('mafia_player_sessions', 'Tracked players, including queued ones.', lambda: len(players))
+metrics.Gauge('mafia_rate_limit_buckets', 'Live token buckets by limiter.',
+              lambda: {limiter.name: len(limiter.buckets)
+                       for limiter in (chat_limiter, room_chat_limiter, action_limiter)}, label='limiter')
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+# Sampling profiler, off unless MAFIA_PROFILER is set:
+#   curl 'localhost:5000/debug/profile?seconds=30' > app.folded && flamegraph.pl app.folded > app.svg
+@app.route('/debug/profile')
+def debug_profile():
+    if not os.environ.get('MAFIA_PROFILER'):
+        return jsonify({'error': 'Profiler disabled'}), 404
+
+    seconds = min(request.args.get('seconds', 10, type=float), 300)
+    profiler = metrics.SamplingProfiler(request.args.get('hz', 97, type=int))
+    profiler.start()
+    socketio.sleep(seconds)
+    profiler.stop()
+    return profiler.folded(), 200, {'Content-Type': 'text/plain; charset=utf-8'}
+
+
+def start_game(lobby):
+    lobby.game = Game(lobby)
+    lobby_index.discard(lobby.code)
+    store.snapshot(lobby.code, lobby.to_record())
+    transport.emit('game_started', {'redirect': url_for('game', code=lobby.code)}, lobby.code)
 
 
 # Socket events
-@socketio.on('connect')
-def handle_connect():
-    player_id = session.get('player_id')
+@on_event('connect')
+def handle_connect(client, auth=None):
+    player_id = client.player_id
     if player_id and player_id in players:
-        players[player_id].sid = request.sid
+        players[player_id].sid = client.sid
+        player_expiry.discard(player_id)
+
 
+@on_event('disconnect')
+def handle_disconnect(client, reason=None):
+    transport.forget(client.sid)
+    spectator_feed.unwatch(client.sid)
+    player = players.get(client.player_id)
+    # A page change opens the new socket before the old one closes
+    if player and player.sid == client.sid:
+        player.sid = None
+        player_expiry.touch(player.id, RECONNECT_GRACE)
+        if player.lobby_code in lobbies:
+            schedule_lobby_expiry(lobbies[player.lobby_code])
 
-@socketio.on('join_lobby')
-def handle_join_lobby(data):
+
+@on_event('join_lobby')
+def handle_join_lobby(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
 
     if lobby_code in lobbies and player_id in lobbies[lobby_code].players:
-        join_room(lobby_code)
-        emit('lobby_update', lobbies[lobby_code].to_dict(), room=lobby_code)
+        transport.set_codec(client.sid, data.get('codec'))
+        transport.enter_room(client.sid, lobby_code)
+        game = lobbies[lobby_code].game
+        if game:
+            game.join_view_room(game.players[player_id], client.sid)
+        else:
+            # Only the joiner needs it: /join already told the room, and a
+            # reconnect changes nothing for anyone else
+            client.emit('lobby_update', lobbies[lobby_code].to_dict())
+
 
+@on_event('join_queue')
+def handle_join_queue(client, data):
+    player_id = client.player_id
+    # Matched before this socket connected
+    if player_id in match_queue.matched and player_id in players:
+        match_queue.notify(players[player_id])
 
-@socketio.on('leave_lobby')
-def handle_leave_lobby(data):
+
+@on_event('spectate')
+def handle_spectate(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    # No lobby lookup: the worker holding spectator sockets needn't own the game
+    if isinstance(lobby_code, str) and len(lobby_code) == 6 and lobby_code.isalnum():
+        previous = spectator_feed.watch(client.sid, lobby_code)
+        if previous and previous != lobby_code:
+            transport.leave_room(client.sid, spectator_room(previous))
+        transport.enter_room(client.sid, spectator_room(lobby_code))
 
-    if lobby_code in lobbies and player_id in lobbies[lobby_code].players:
-        player_name = lobbies[lobby_code].players[player_id].name
-        leave_room(lobby_code)
 
-        # Remove player from lobby
-        del lobbies[lobby_code].players[player_id]
+@on_event('request_game_state')
+def handle_request_game_state(client, data):
+    lobby_code = data.get('lobby_code')
+    player_id = client.player_id
 
-        # If lobby is empty, remove it
-        if len(lobbies[lobby_code].players) == 0:
-            del lobbies[lobby_code]
+    if (lobby_code in lobbies and
+            lobbies[lobby_code].game and
+            player_id in lobbies[lobby_code].players):
+        # A reconnecting client sends what it last saw and gets only what it
+        # missed; a full snapshot is the fallback once the log is truncated
+        game = lobbies[lobby_code].game
+        player = game.players[player_id]
+        view = game.get_view(player)
+        stream = data.get('stream')
+        patches = game.missed_patches(view, stream, data.get('version')) if data.get('view') == view else None
+        if patches is None:
+            client.emit('game_update', game.get_game_state(view))
         else:
-            # Assign new admin if needed
-            admin_found = any(player.is_admin for player in lobbies[lobby_code].players.values())
-            if not admin_found:
-                new_admin = next(iter(lobbies[lobby_code].players.values()))
-                new_admin.is_admin = True
+            for patch in patches:
+                client.emit('game_update', patch)
+        for message in game.missed_private_messages(player, stream, data.get('private_seq', 0)):
+            client.emit('private_message', message)
+
+
+@on_event('leave_lobby')
+def handle_leave_lobby(client, data):
+    lobby_code = data.get('lobby_code')
+    player_id = client.player_id
+
+    if lobby_code in lobbies and player_id in lobbies[lobby_code].players:
+        transport.leave_room(client.sid, lobby_code)
+        remove_from_lobby(lobbies[lobby_code], player_id)
 
-            # Notify remaining players
-            message = lobbies[lobby_code].add_message(f"{player_name} left the lobby")
-            socketio.emit('new_message', message, room=lobby_code)
-            socketio.emit('lobby_update', lobbies[lobby_code].to_dict(), room=lobby_code)
 
+def remove_from_lobby(lobby, player_id):
+    player_name = lobby.players[player_id].name
+    forget_player(player_id)
 
-@socketio.on('start_game')
-def handle_start_game(data):
+    # Remove player from lobby, handing admin to someone else if needed
+    lobby.remove_player(player_id)
+
+    # If lobby is empty, remove it
+    if len(lobby.players) == 0:
+        close_lobby(lobby)
+    else:
+        lobby_index.update(lobby)
+        # Notify remaining players
+        message = lobby.add_message(f"{player_name} left the lobby")
+        chat_batcher.add_message(lobby.code, message)
+        transport.emit('lobby_update', lobby.to_dict(), lobby.code)
+
+
+def close_lobby(lobby):
+    """Forget a lobby and every player still in it."""
+    # Out of the index first, so the lobby browser never finds a code that
+    # is no longer in `lobbies`
+    lobby_index.discard(lobby.code)
+    if lobbies.pop(lobby.code, None) is None:
+        return  # a leave and the reaper can both get here
+    lobby_expiry.discard(lobby.code)
+    phase_scheduler.cancel(lobby.code)
+    store.drop(lobby.code)
+    room_chat_limiter.discard(lobby.code)
+    if lobby.game:
+        lobby.game.replay.close()
+    for player_id in lobby.players:
+        forget_player(player_id)
+        match_queue.matched.pop(player_id, None)
+
+
+@on_event('start_game')
+def handle_start_game(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
 
     if (lobby_code in lobbies and
             player_id in lobbies[lobby_code].players and
             not lobbies[lobby_code].game):
 
         # Check if minimum players requirement is met
-        if len(lobbies[lobby_code].players) < lobbies[lobby_code].settings['min_players']:
-            emit('error', {'message': f'Need at least {lobbies[lobby_code].settings["min_players"]} players to start'})
+        if len(lobbies[lobby_code].players) < lobbies[lobby_code].settings.min_players:
+            client.emit('error', {'message': f'Need at least {lobbies[lobby_code].settings.min_players} players to start'})
             return
 
         # Only the admin can start the game
         if lobbies[lobby_code].players[player_id].is_admin:
-            lobbies[lobby_code].game = Game(lobbies[lobby_code])
-            emit('game_started', {'redirect': url_for('game', code=lobby_code)}, room=lobby_code)
+            start_game(lobbies[lobby_code])
 
 
-@socketio.on('update_settings')
-def handle_update_settings(data):
+@on_event('update_settings')
+def handle_update_settings(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
     settings = data.get('settings', {})
 
     if (lobby_code in lobbies and
@@ -466,48 +2036,57 @@ def handle_update_settings(data):
 
         # Only the admin can change settings
         if lobbies[lobby_code].players[player_id].is_admin:
-            for key, value in settings.items():
-                if key in lobbies[lobby_code].settings:
-                    lobbies[lobby_code].settings[key] = value
-
-            # Ensure min_players is not greater than max_players
-            if lobbies[lobby_code].settings['min_players'] > lobbies[lobby_code].settings['max_players']:
-                lobbies[lobby_code].settings['min_players'] = lobbies[lobby_code].settings['max_players']
-
-            emit('lobby_update', lobbies[lobby_code].to_dict(), room=lobby_code)
+            lobbies[lobby_code].update_settings(settings)
+            lobby_index.update(lobbies[lobby_code])
+            transport.emit('lobby_update', lobbies[lobby_code].to_dict(), lobby_code)
 
 
-@socketio.on('send_message')
-def handle_send_message(data):
+@on_event('send_message')
+def handle_send_message(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
     message = data.get('message', '').strip()
 
     if not message or lobby_code not in lobbies or player_id not in lobbies[lobby_code].players:
         return
 
+    # Flood protection: length and duplicates cost nothing, then the
+    # player's own bucket, then the room's so one flooder can't drain it
+    if len(message) > MAX_MESSAGE_LENGTH:
+        RATE_LIMITED.inc('length')
+        return reject(client, 'send_message', f'Messages are limited to {MAX_MESSAGE_LENGTH} characters')
+    if not chat_limiter.allow(player_id):
+        return reject(client, 'send_message', "You're sending messages too fast",
+                      chat_limiter.retry_after(player_id))
+    if is_duplicate(player_id, message):
+        RATE_LIMITED.inc('duplicate')
+        return reject(client, 'send_message', "You already said that")
+    if not room_chat_limiter.allow(lobby_code):
+        return reject(client, 'send_message', "The chat is too busy, try again shortly",
+                      room_chat_limiter.retry_after(lobby_code))
+
     player = lobbies[lobby_code].players[player_id]
     game = lobbies[lobby_code].game
 
     if game:
         # Check if player can speak based on game phase and role
-        if game.phase == "night":
+        if game.phase == Phase.NIGHT:
             # Only mafia can talk at night if night_chat is enabled
-            if player.role == "mafia" and game.lobby.settings['night_chat']:
-                game.add_communication(message, player.name)
+            if player.role == Role.MAFIA and game.lobby.settings.night_chat:
+                game.add_communication(message, player, audience="mafia", coalesce=True)
         else:
             # Everyone can talk during day phases
-            game.add_communication(message, player.name)
+            game.add_communication(message, player, coalesce=True)
     else:
         # In lobby, everyone can talk
         message_data = lobbies[lobby_code].add_message(message, player.name)
-        socketio.emit('new_message', message_data, room=lobby_code)
+        chat_batcher.add_message(lobby_code, message_data)
 
 
-@socketio.on('night_action')
-def handle_night_action(data):
+@on_event('night_action')
+def handle_night_action(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
     target_id = data.get('target_id')
 
     if (lobby_code not in lobbies or
@@ -515,46 +2094,34 @@ def handle_night_action(data):
             player_id not in lobbies[lobby_code].players):
         return
 
+    if not action_limiter.allow(player_id):
+        return reject(client, 'night_action', "Too many actions, slow down", action_limiter.retry_after(player_id))
+
     game = lobbies[lobby_code].game
     player = game.players[player_id]
 
-    if game.phase != "night" or not player.alive:
+    if game.phase != Phase.NIGHT or not game.phase_open or not player.alive:
         return
 
     # Validate action based on role
-    action_type = None
-    if player.role == "mafia":
-        action_type = "mafia_kill"
-    elif player.role == "doctor":
-        action_type = "doctor_heal"
-    elif player.role == "detective":
-        action_type = "detective_investigate"
+    action_type = NIGHT_ACTIONS.get(player.role)
 
     if action_type and target_id in game.players:
-        game.night_actions[player_id] = {
-            'type': action_type,
-            'target_id': target_id
-        }
+        game.submit_night_action(player, action_type, target_id)
 
         # Notify player
-        emit('action_confirmed', {'action': action_type, 'target': target_id})
+        client.emit('action_confirmed', {'action': action_type, 'target': target_id})
 
         # Check if all actions are submitted
-        expected_actions = 0
-        for p in game.players.values():
-            if p.alive and p.role in ["mafia", "doctor", "detective"]:
-                expected_actions += 1
+        if len(game.night_actions) >= game.night_actors_alive:
+            # All actions submitted, proceed to day after a brief delay
+            game.close_phase(2)
 
-        if len(game.night_actions) >= expected_actions:
-            # All actions submitted, proceed to day
-            socketio.sleep(2)  # Brief delay
-            game.start_day()
 
-
-@socketio.on('cast_vote')
-def handle_cast_vote(data):
+@on_event('cast_vote')
+def handle_cast_vote(client, data):
     lobby_code = data.get('lobby_code')
-    player_id = session.get('player_id')
+    player_id = client.player_id
     target_id = data.get('target_id')
 
     if (lobby_code not in lobbies or
@@ -562,83 +2129,513 @@ def handle_cast_vote(data):
             player_id not in lobbies[lobby_code].players):
         return
 
+    if not action_limiter.allow(player_id):
+        return reject(client, 'cast_vote', "Too many votes, slow down", action_limiter.retry_after(player_id))
+
     game = lobbies[lobby_code].game
     player = game.players[player_id]
 
-    if game.phase != "voting" or not player.alive:
+    if (game.phase != Phase.VOTING or not game.phase_open or
+            not player.alive or target_id not in game.players):
         return
 
-    # Record vote
-    game.votes[player_id] = target_id
-    player.vote_target = target_id
-
-    # Update vote count for target
-    if target_id in game.players:
-        game.players[target_id].votes += 1
+    # Record vote, moving it off the previous target on a re-vote
+    game.cast_vote(player, target_id)
 
     # Broadcast updated game state
     game.broadcast_game_state()
 
     # Check if all votes are in
-    alive_players = sum(1 for p in game.players.values() if p.alive)
-    if len(game.votes) >= alive_players:
-        # Process votes
-        vote_count = {}
-        for voted_id in game.votes.values():
-            vote_count[voted_id] = vote_count.get(voted_id, 0) + 1
-
-        # Find player with most votes
-        if vote_count:
-            max_votes = max(vote_count.values())
-            candidates = [pid for pid, votes in vote_count.items() if votes == max_votes]
-
-            if len(candidates) == 1:
-                # Eliminate player
-                eliminated_id = candidates[0]
-                game.players[eliminated_id].alive = False
-                game.add_communication(f"{game.players[eliminated_id].name} has been eliminated!")
-
-                # Check if game continues
-                if not game.check_game_end():
-                    # Start next night
-                    socketio.sleep(3)  # Brief delay
-                    game.start_night()
-            else:
-                # Tie vote, no elimination
-                game.add_communication("It's a tie! No one is eliminated.")
-                socketio.sleep(3)  # Brief delay
-                game.start_night()
-        else:
-            # No votes, proceed to night
-            game.add_communication("No votes were cast.")
-            socketio.sleep(3)  # Brief delay
-            game.start_night()
+    if len(game.votes) >= game.alive_count and game.close_phase(3):
+        # Process votes; the next night starts after a brief delay
+        game.resolve_votes()
 
 
 # Game timer
-def game_timer():
+class PhaseScheduler:
+    """Fires phase transitions when their deadline is due.
+
+    Deadlines are kept in a min-heap keyed by lobby code, so the timer thread
+    sleeps until the earliest one instead of polling every lobby. Rescheduling
+    or cancelling replaces the live entry for a code; superseded heap entries
+    are skipped when they surface and compacted away if they pile up.
+    """
+
+    def __init__(self, callback, wakeup):
+        self.callback = callback
+        self._heap = []
+        self._entries = {}  # code -> (deadline, seq) of the live entry
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self.wakeup = wakeup  # an Event of the server's async mode
+
+    def schedule(self, code, delay):
+        deadline = time.monotonic() + delay
+        with self._lock:
+            entry = (deadline, next(self._seq))
+            self._entries[code] = entry
+            heapq.heappush(self._heap, (*entry, code))
+            is_earliest = self._heap[0][1] == entry[1]
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._compact()
+        if is_earliest:
+            self.wakeup.set()
+        return deadline
+
+    def cancel(self, code):
+        with self._lock:
+            self._entries.pop(code, None)
+
+    def _compact(self):
+        self._heap = [(deadline, seq, code) for code, (deadline, seq) in self._entries.items()]
+        heapq.heapify(self._heap)
+
+    def pop_due(self):
+        due = []
+        now = time.monotonic()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, code = heapq.heappop(self._heap)
+                if self._entries.get(code) == (deadline, seq):
+                    del self._entries[code]
+                    due.append((code, deadline))
+            timeout = self._heap[0][0] - now if self._heap else None
+        return due, timeout
+
+    def fire(self, due):
+        with TIMER_TICK.time():
+            for code, deadline in due:
+                TIMER_LAG.observe(time.monotonic() - deadline)
+                try:
+                    self.callback(code, deadline)
+                except Exception:
+                    # One broken game must not stop every other lobby's timer
+                    print(f'Phase timer for {code} failed:', file=sys.stderr)
+                    traceback.print_exc()
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            due, timeout = self.pop_due()
+            if due:
+                self.fire(due)
+            else:
+                self.wakeup.wait(timeout)
+
+
+def on_phase_deadline(code, deadline):
+    lobby_command(code, advance_if_due, code, deadline)
+
+
+def advance_if_due(code, deadline):
+    lobby = lobbies.get(code)
+    # A deadline that no longer matches the game's was rescheduled meanwhile
+    if (lobby and lobby.game and lobby.game.deadline == deadline and
+            lobby.game.phase not in [Phase.SETUP, Phase.ENDED]):
+        lobby.game.advance_phase()
+
+
+# The wakeup event has to match the async mode (a green event under eventlet)
+phase_scheduler = PhaseScheduler(on_phase_deadline, socketio.server.eio.create_event())
+
+
+# Garbage collection of abandoned lobbies and players
+LOBBY_IDLE_TTL = float(os.environ.get('MAFIA_LOBBY_IDLE_TTL', 1800))
+ENDED_GAME_TTL = float(os.environ.get('MAFIA_ENDED_GAME_TTL', 600))
+RECONNECT_GRACE = float(os.environ.get('MAFIA_RECONNECT_GRACE', 60))
+REAPER_INTERVAL = 5
+
+
+class ExpiryWheel:
+    """Expiry deadlines grouped into fixed-width time buckets.
+
+    `touch` moves a key into the bucket its new deadline falls in (a no-op
+    while it stays in the same bucket) and `expired` pops only the buckets
+    whose time has passed, so the reaper never scans live keys. Keys expire
+    up to one bucket width late, never early.
+    """
+
+    def __init__(self, granularity):
+        self.granularity = granularity
+        self.buckets = {}  # slot -> set of keys
+        self.slots = {}  # key -> slot holding it
+        self.next_slot = int(time.monotonic() // granularity)
+        self.lock = threading.Lock()
+
+    def touch(self, key, ttl):
+        slot = int((time.monotonic() + ttl) // self.granularity) + 1
+        with self.lock:
+            old = self.slots.get(key)
+            if old != slot:
+                if old is not None:
+                    self.buckets[old].discard(key)
+                self.slots[key] = slot
+                self.buckets.setdefault(slot, set()).add(key)
+
+    def discard(self, key):
+        with self.lock:
+            slot = self.slots.pop(key, None)
+            if slot is not None:
+                self.buckets[slot].discard(key)
+
+    def expired(self):
+        keys = []
+        now_slot = int(time.monotonic() // self.granularity)
+        with self.lock:
+            while self.next_slot <= now_slot:
+                for key in self.buckets.pop(self.next_slot, ()):
+                    del self.slots[key]
+                    keys.append(key)
+                self.next_slot += 1
+        return keys
+
+
+player_expiry = ExpiryWheel(REAPER_INTERVAL)  # disconnected players past the reconnect grace
+lobby_expiry = ExpiryWheel(REAPER_INTERVAL)
+
+
+def schedule_lobby_expiry(lobby):
+    ended = lobby.game is not None and lobby.game.phase == Phase.ENDED
+    lobby_expiry.touch(lobby.code, ENDED_GAME_TTL if ended else LOBBY_IDLE_TTL)
+
+
+def reap_player(player_id):
+    player = players.get(player_id)
+    if player is None or player.sid:
+        return
+    lobby = lobbies.get(player.lobby_code)
+    if lobby is None:
+        forget_player(player_id)
+    elif lobby.game is None:
+        remove_from_lobby(lobby, player_id)
+    # Players in a game keep their seat; the lobby is reaped once it goes idle
+
+
+def reap_lobby(code):
+    lobby = lobbies.get(code)
+    if lobby is None:
+        return
+    ended = lobby.game is not None and lobby.game.phase == Phase.ENDED
+    if not ended and any(player.sid for player in lobby.players.values()):
+        schedule_lobby_expiry(lobby)
+    else:
+        close_lobby(lobby)
+
+
+def reap_expired():
+    for player_id in player_expiry.expired():
+        player = players.get(player_id)
+        if player is not None:
+            lobby_command(player.lobby_code, reap_player, player_id)
+    for code in lobby_expiry.expired():
+        lobby_command(code, reap_lobby, code)
+
+
+def run_reaper():
     while True:
-        socketio.sleep(1)
-        for code, lobby in list(lobbies.items()):
-            if lobby.game and lobby.game.phase not in ["setup", "ended"]:
-                lobby.game.time_remaining -= 1
-
-                if lobby.game.time_remaining <= 0:
-                    # Time's up, proceed to next phase
-                    if lobby.game.phase == "night":
-                        lobby.game.start_day()
-                    elif lobby.game.phase == "day":
-                        lobby.game.start_discussion()
-                    elif lobby.game.phase == "discussion":
-                        lobby.game.start_voting()
-                    elif lobby.game.phase == "voting":
-                        # Auto-process votes if not all are in
-                        lobby.game.start_night()
-
-
-# Start timer thread
-timer_thread = threading.Thread(target=game_timer, daemon=True)
-timer_thread.start()
+        socketio.sleep(REAPER_INTERVAL)
+        reap_expired()
+
+
+# Persistence: MAFIA_STORE=sqlite:///mafia.db journals every lobby so a restart
+# resumes games where they were. Set MAFIA_SECRET_KEY too, or players lose the
+# session cookies that tie them to their lobby.
+def apply_journal_event(lobby, event, data):
+    """Re-apply one journaled event during recovery, without emitting anything."""
+    game = lobby.game
+    if event == 'join':
+        lobby.add_player(Player(data['id'], data['name'], None))
+    elif event == 'leave':
+        lobby.remove_player(data['id'])
+    elif event == 'settings':
+        lobby.settings.update(data)
+    elif event == 'message':
+        lobby.messages.append((data['audience'], data['timestamp'], data['message']))
+    elif game is None:
+        return
+    elif event == 'phase':
+        if (data['phase'], data['day_number']) != (game.phase, game.day_number):
+            if data['phase'] == Phase.NIGHT:
+                game.night_actions = NightActions()
+            elif data['phase'] == Phase.VOTING:
+                game.reset_votes()
+        game.phase = Phase(data['phase'])
+        game.day_number = data['day_number']
+        game.closed_phase = (game.phase, game.day_number) if data['closed'] else None
+        game.resume_timer(data['ends_at'])
+        game.replay.skip_to(game.phase, game.day_number)
+    elif event == 'vote':
+        game.cast_vote(game.players[data['voter']], data['target'])
+    elif event == 'night_action':
+        game.submit_night_action(game.players[data['player']], data['type'], data['target'])
+    elif event == 'death':
+        game.kill_player(data['id'])
+
+
+def restore_lobbies():
+    store.replaying = True
+    try:
+        for code, record, events in store.load():
+            lobby = Lobby.from_record(record)
+            for event, data in events:
+                apply_journal_event(lobby, event, data)
+            if lobby.players:
+                lobbies[code] = lobby
+                players.update(lobby.players)
+                lobby_index.update(lobby)
+                # Everyone starts disconnected after a restart
+                schedule_lobby_expiry(lobby)
+                for player_id in lobby.players:
+                    player_expiry.touch(player_id, RECONNECT_GRACE)
+    finally:
+        store.replaying = False
+
+
+# Replays: every game is recorded to MAFIA_REPLAY_DIR (default: replays/ next
+# to this file) and served from /api/replay/<id>; set it empty to turn them off.
+replays = open_replays(os.environ.get('MAFIA_REPLAY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'replays')),
+                       REPLAY_BYTES)
+store = open_store(os.environ.get('MAFIA_STORE'))
+restore_lobbies()
+
+# Start timer thread; a background task so its emits run on the server's event loop.
+# asgi.py runs coroutine versions of both instead.
+if not ASGI_MODE:
+    timer_thread = socketio.start_background_task(phase_scheduler.run)
+    reaper_thread = socketio.start_background_task(run_reaper)
+
+
+# Benchmarks, run in place of the server: python app.py --bench scheduler|patches|memory|alive
+def percentile(samples, pct):
+    """`pct` percentile of sorted `samples`, 0.0 if there are none."""
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * pct / 100))]
+
+
+def bench_lobby(code, num_players):
+    lobby = Lobby(code, Player(secrets.token_hex(8), 'Player 0', None))
+    for number in range(1, num_players):
+        lobby.add_player(Player(secrets.token_hex(8), f'Player {number}', None))
+    return lobby
+
+
+def benchmark_scheduler(num_lobbies, idle_seconds, transitions, seed=0):
+    """Idle CPU with `num_lobbies` games in progress, and how long after
+    their deadline `transitions` phase changes have completed."""
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for number in range(num_lobbies):
+        lobby = bench_lobby(f'B{number:05d}', 4)
+        lobby.settings.game_time = 3600  # nothing falls due while idle
+        lobbies[lobby.code] = lobby
+        lobby.game = Game(lobby)
+    setup_seconds = time.perf_counter() - start
+    socketio.sleep(1)
+
+    start_cpu = time.process_time()
+    socketio.sleep(idle_seconds)
+    idle_cpu = time.process_time() - start_cpu
+
+    # One pass of the old once-a-second poll over the same lobbies
+    start = time.perf_counter()
+    for code, lobby in list(lobbies.items()):
+        if lobby.game and lobby.game.phase not in [Phase.SETUP, Phase.ENDED]:
+            lobby.game.time_remaining
+    poll_pass = time.perf_counter() - start
+
+    lags = []
+    callback = phase_scheduler.callback
+
+    def timed(code, deadline):
+        callback(code, deadline)
+        lags.append(time.monotonic() - deadline)
+    phase_scheduler.callback = timed
+    for code in rng.sample(sorted(lobbies), transitions):
+        lobbies[code].game.set_timer(rng.uniform(0.1, 2))
+    socketio.sleep(3)
+    phase_scheduler.callback = callback
+
+    lags.sort()
+    return {
+        'lobbies': num_lobbies,
+        'setup_seconds': round(setup_seconds, 2),
+        'idle_seconds': idle_seconds,
+        'idle_cpu_percent': round(idle_cpu / idle_seconds * 100, 3),
+        'polling_pass_ms': round(poll_pass * 1000, 2),
+        'transitions': len(lags),
+        'transition_p50_ms': round(percentile(lags, 50) * 1000, 2),
+        'transition_p99_ms': round(percentile(lags, 99) * 1000, 2),
+        'transition_max_ms': round(percentile(lags, 100) * 1000, 2),
+    }
+
+
+def benchmark_patches(num_players, rounds, seed=0):
+    """Size and build-and-encode time of game_update patches against the full
+    snapshot every update used to send, per kind of update.
+
+    Bytes are what one town player receives; patch time covers all views.
+    """
+    rng = random.Random(seed)
+    lobby = bench_lobby('BENCH0', num_players)
+    for number in range(lobby.messages.maxlen):
+        lobby.add_message(f'Player {number % num_players}: a chat line of ordinary length, number {number}')
+    game = Game(lobby)
+    phase_scheduler.cancel(lobby.code)
+    game.get_game_patches()
+    ids = list(game.players)
+    totals = {kind: [0, 0, 0.0, 0, 0.0] for kind in ('phase', 'vote', 'chat')}
+
+    def measure(kind):
+        game.snapshot_cache = {}
+        start = time.perf_counter()
+        snapshot = json.dumps(game.get_game_state('town'))
+        middle = time.perf_counter()
+        patches = {view: json.dumps(patch) for view, patch in game.get_game_patches().items()}
+        end = time.perf_counter()
+        row = totals[kind]
+        row[0] += 1
+        row[1] += len(snapshot)
+        row[2] += middle - start
+        row[3] += len(patches['town'])
+        row[4] += end - middle
+
+    for _ in range(rounds):
+        game.phase = Phase.VOTING
+        game.reset_votes()
+        measure('phase')
+        for voter_id in ids:
+            game.cast_vote(game.players[voter_id], rng.choice(ids))
+            measure('vote')
+        # What add_communication queues, without its immediate broadcast
+        game.pending_messages.append(lobby.add_message('A chat line of ordinary length', f'Player {rng.randrange(num_players)}'))
+        measure('chat')
+
+    return {'players': num_players, 'messages': len(lobby.messages), 'updates': [{
+        'update': kind,
+        'snapshot_bytes': round(snapshot_bytes / count),
+        'snapshot_us': round(snapshot_seconds / count * 1e6, 1),
+        'patch_bytes': round(patch_bytes / count),
+        'patch_us': round(patch_seconds / count * 1e6, 1),
+    } for kind, (count, snapshot_bytes, snapshot_seconds, patch_bytes, patch_seconds) in totals.items()]}
+
+
+def benchmark_memory(num_lobbies, num_players):
+    """tracemalloc bytes per lobby, per player, per running game and per full
+    chat history, for lobbies registered the way create_lobby registers them."""
+    def measure(build):
+        gc.collect()
+        tracemalloc.start()
+        for number in range(num_lobbies):
+            lobby = build(f'M{number:05d}')
+            lobbies[lobby.code] = lobby
+            players.update(lobby.players)
+            lobby_index.update(lobby)
+        used = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        for lobby in list(lobbies.values()):
+            close_lobby(lobby)
+        return used / num_lobbies
+
+    def started(code):
+        lobby = bench_lobby(code, num_players)
+        lobby.game = Game(lobby)
+        return lobby
+
+    def chatty(code):
+        lobby = started(code)
+        for number in range(lobby.messages.maxlen):
+            lobby.add_message(f'Player {number % num_players}: a chat line of ordinary length, number {number}')
+        return lobby
+
+    alone = measure(lambda code: bench_lobby(code, 1))
+    waiting = measure(lambda code: bench_lobby(code, num_players))
+    playing = measure(started)
+    full = measure(chatty)
+    return {
+        'lobbies': num_lobbies,
+        'players': num_players,
+        'bytes_per_lobby': round(alone),
+        'bytes_per_player': round((waiting - alone) / (num_players - 1)),
+        'bytes_per_game': round(playing - waiting),
+        'bytes_per_chat_history': round(full - playing),
+        'bytes_per_playing_lobby': round(full),
+    }
+
+
+def benchmark_alive(num_players, calls, seed=0):
+    """Microseconds per call for the roster scans Game used to run against
+    the alive_by_role index that replaced them, with a quarter of the
+    players dead."""
+    rng = random.Random(seed)
+    lobby = bench_lobby('BENCH0', num_players)
+    game = Game(lobby)
+    phase_scheduler.cancel(lobby.code)
+    for player in rng.sample(list(game.players.values()), num_players // 4):
+        game.kill_player(player.id)
+
+    def scan_winner():
+        mafia_count = town_count = 0
+        for player in game.players.values():
+            if player.alive:
+                if player.role == Role.MAFIA:
+                    mafia_count += 1
+                else:
+                    town_count += 1
+        return engine.winner(mafia_count, town_count)
+
+    def scan_night_actors():
+        return sum(1 for player in game.players.values() if player.alive and player.role in NIGHT_ACTIONS)
+
+    def scan_mafia():
+        return [player.name for player in game.players.values() if player.role == Role.MAFIA and player.alive]
+
+    def index_winner():
+        return engine.winner(game.mafia_alive, game.alive_count - game.mafia_alive)
+
+    def index_night_actors():
+        return game.night_actors_alive
+
+    def index_mafia():
+        return [player.name for player in game.alive_by_role[Role.MAFIA].values()]
+
+    def timed(func):
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        return round((time.perf_counter() - start) / calls * 1e6, 3)
+
+    checks = {'win_check': (scan_winner, index_winner),
+              'night_actors': (scan_night_actors, index_night_actors),
+              'mafia_list': (scan_mafia, index_mafia)}
+    result = {'players': num_players, 'alive': game.alive_count}
+    for name, (scan, index) in checks.items():
+        assert scan() == index()
+        result[name] = {'scan_us': timed(scan), 'index_us': timed(index)}
+    return result
+
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the Mafia server.")
+    parser.add_argument('--bench', choices=('scheduler', 'patches', 'memory', 'alive'),
+                        help="run a benchmark instead of the server and print its results")
+    parser.add_argument('--lobbies', type=int, default=10000, help="lobbies for --bench scheduler and memory")
+    parser.add_argument('--idle', type=float, default=10, help="seconds to measure idle CPU over")
+    parser.add_argument('--transitions', type=int, default=1000, help="phase changes to time")
+    parser.add_argument('--players', type=int, default=12, help="players per game for --bench patches, memory and alive")
+    parser.add_argument('--rounds', type=int, default=200, help="voting rounds to time")
+    parser.add_argument('--calls', type=int, default=10000, help="calls per check for --bench alive")
+    args = parser.parse_args()
+    if args.bench:
+        replays = open_replays('')  # not thousands of replay files
+        if args.bench == 'scheduler':
+            result = benchmark_scheduler(args.lobbies, args.idle, args.transitions)
+        elif args.bench == 'patches':
+            result = benchmark_patches(args.players, args.rounds)
+        elif args.bench == 'memory':
+            result = benchmark_memory(args.lobbies, args.players)
+        else:
+            result = benchmark_alive(args.players, args.calls)
+        print(json.dumps(result, indent=2))
+    else:
+        socketio.run(app, port=int(os.environ.get('MAFIA_PORT', 5000)), debug=SHARD_COUNT == 1)
@@ -0,0 +1,280 @@
+# asgi.py
+# Serves the same lobby and game logic as app.py on python-socketio's asyncio
+# server, without eventlet. Needs an ASGI server:
+#   pip install uvicorn
+#
+#   python asgi.py --port 5000
+#   uvicorn asgi:application --port 5000
+#
+# Run a single worker per process; sharding works as in Flask mode, with
+# MAFIA_MESSAGE_QUEUE=redis://... shared between the shards.
+#
+# Every socket handler, HTTP view, phase deadline and reaper pass runs on the
+# event loop as one synchronous call that never awaits, so each one sees and
+# leaves a lobby consistent: mutations of a lobby are serialized by the loop
+# itself without a lock to forget. Only the outbox below awaits, and it
+# touches no game state.
+import argparse
+import asyncio
+import io
+import os
+import sys
+import threading
+from http.cookies import SimpleCookie
+from urllib.parse import parse_qs
+
+os.environ['MAFIA_SERVER'] = 'asgi'
+
+import socketio  # noqa: E402
+
+import app as mafia  # noqa: E402
+import codec  # noqa: E402
+import metrics  # noqa: E402
+
+
+def client_manager(url):
+    if not url:
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://'):
+        return socketio.AsyncRedisManager(url)
+    raise RuntimeError(f'Unsupported message queue for asgi.py: {url}')
+
+
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*',
+                           client_manager=client_manager(os.environ.get('MAFIA_MESSAGE_QUEUE')),
+                           json=metrics.MeteredJSON(mafia.EMITTED_BYTES, codec.fast_json))
+
+
+class AsyncTransport:
+    """app.py's transport on an AsyncServer.
+
+    The game logic emits from plain functions, so server calls go through an
+    outbox drained by one task. That keeps them in call order, e.g. a socket
+    joins a room before the first broadcast to it.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.outbox = asyncio.Queue()
+
+    def emit(self, event, data, room):
+        self.outbox.put_nowait((self.server.emit, (event, data), {'room': room}))
+
+    def enter_room(self, sid, room):
+        self.outbox.put_nowait((self.server.enter_room, (sid, room), {'namespace': '/'}))
+
+    def leave_room(self, sid, room):
+        self.outbox.put_nowait((self.server.leave_room, (sid, room), {'namespace': '/'}))
+
+    def call_later(self, delay, callback):
+        asyncio.get_running_loop().call_later(delay, callback)
+
+    def create_event(self):
+        # Lobby commands never await, so on the one loop thread nothing ever
+        # finds an actor busy and waits on this
+        return threading.Event()
+
+    async def run(self):
+        while True:
+            method, args, kwargs = await self.outbox.get()
+            try:
+                await method(*args, **kwargs)
+            except Exception as e:
+                print(f'Outbox {method.__name__} failed: {e!r}', file=sys.stderr)
+
+
+transport = AsyncTransport(sio)
+mafia.transport = mafia.CodecTransport(transport, mafia.EMITTED_BYTES)
+
+player_ids = {}  # sid -> player id from the session cookie at connect
+
+
+def session_player_id(environ):
+    """The player id in the Flask session cookie sent with the handshake."""
+    cookie = SimpleCookie(environ.get('HTTP_COOKIE', ''))
+    morsel = cookie.get(mafia.app.config['SESSION_COOKIE_NAME'])
+    if morsel is None:
+        return None
+    serializer = mafia.app.session_interface.get_signing_serializer(mafia.app)
+    try:
+        data = serializer.loads(morsel.value, max_age=int(mafia.app.permanent_session_lifetime.total_seconds()))
+    except Exception:
+        return None
+    return data.get('player_id')
+
+
+def dispatch(handler, sid, *args):
+    # A request context gives handlers url_for, as under Flask-SocketIO
+    with mafia.app.test_request_context():
+        return handler(mafia.SocketClient(sid, player_ids.get(sid)), *args)
+
+
+def register(event, handler):
+    if event == 'connect':
+        async def on_connect(sid, environ, auth=None):
+            player_ids[sid] = session_player_id(environ)
+            return dispatch(handler, sid, auth)
+        sio.on('connect', on_connect)
+    elif event == 'disconnect':
+        async def on_disconnect(sid, reason=None):
+            try:
+                dispatch(handler, sid, reason)
+            finally:
+                player_ids.pop(sid, None)
+        sio.on('disconnect', on_disconnect)
+    else:
+        async def on_event(sid, *args):
+            return dispatch(handler, sid, *args)
+        sio.on(event, on_event)
+
+
+for event, handler in mafia.socket_handlers.items():
+    register(event, handler)
+
+
+async def run_phase_scheduler():
+    scheduler = mafia.phase_scheduler
+    scheduler.wakeup = asyncio.Event()
+    while True:
+        scheduler.wakeup.clear()
+        due, timeout = scheduler.pop_due()
+        if due:
+            with mafia.app.test_request_context():
+                scheduler.fire(due)
+            continue
+        try:
+            await asyncio.wait_for(scheduler.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_reaper():
+    while True:
+        await asyncio.sleep(mafia.REAPER_INTERVAL)
+        with mafia.app.test_request_context():
+            mafia.reap_expired()
+
+
+background_tasks = []
+
+
+async def startup():
+    # Keep references; the loop only holds weak ones to running tasks
+    for coro in (transport.run(), run_phase_scheduler(), run_reaper()):
+        background_tasks.append(asyncio.ensure_future(coro))
+
+
+class FlaskOnLoop:
+    """Serves the Flask app to ASGI on the event loop thread.
+
+    Views then interleave with socket events the same way handlers do instead
+    of racing them from a thread pool. Nothing in app.py blocks except the
+    profiler, which is served natively below.
+    """
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return
+        if scope['path'] == '/debug/profile':
+            return await debug_profile(scope, send)
+
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        environ = self.environ(scope, bytes(body))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        # Streamed chunk by chunk, so a long body such as a replay's ndjson
+        # yields the loop between chunks instead of being built up first
+        result = self.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in result:
+                if not chunk:
+                    continue
+                if not started:
+                    await send({'type': 'http.response.start', 'status': response['status'],
+                                'headers': response['headers']})
+                    started = True
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        if not started:
+            await send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    @staticmethod
+    def environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', ''),
+            'PATH_INFO': scope['path'],
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f'HTTP/{scope.get("http_version", "1.1")}',
+            'REMOTE_ADDR': client[0],
+            'CONTENT_LENGTH': str(len(body)),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ['CONTENT_TYPE'] = value
+            elif name != 'CONTENT_LENGTH':
+                key = f'HTTP_{name}'
+                environ[key] = f'{environ[key]},{value}' if key in environ else value
+        return environ
+
+
+async def debug_profile(scope, send):
+    if not os.environ.get('MAFIA_PROFILER'):
+        status, content_type, content = 404, b'application/json', b'{"error":"Profiler disabled"}'
+    else:
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        try:
+            seconds = min(float(query.get('seconds', ['10'])[0]), 300)
+            hz = int(query.get('hz', ['97'])[0])
+        except ValueError:
+            seconds, hz = 10, 97
+        profiler = metrics.SamplingProfiler(hz)
+        profiler.start()
+        await asyncio.sleep(seconds)
+        profiler.stop()
+        status, content_type, content = 200, b'text/plain; charset=utf-8', profiler.folded().encode()
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', content_type)]})
+    await send({'type': 'http.response.body', 'body': content})
+
+
+application = socketio.ASGIApp(sio, other_asgi_app=FlaskOnLoop(mafia.app), on_startup=startup)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run the Mafia server on asyncio.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('MAFIA_PORT', 5000)))
+    args = parser.parse_args()
+    uvicorn.run(application, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,395 @@
+# codec.py
+# Wire encodings for Socket.IO events. A client picks one in join_lobby:
+#
+#   json    the default: events as JSON, encoded with orjson when installed
+#   binary  events with a record layout go out as a single MessagePack
+#           attachment; every other event stays JSON
+#
+# Binary events send records positionally as [mask, value...]. Bit i of the
+# mask is set when field i is present, so partial patches only pay for the
+# fields that changed. Roles, phases and views are sent as small integers.
+# Fields that have no slot in the layout go in one trailing map (bit
+# len(fields)), so a new key never gets lost on the way.
+#
+# The layout is sent to binary clients as a `codec` event (see schema()), so
+# static/codec.js has no copy of it to keep in sync.
+#
+#   python codec.py --bench --players 12    # encode time and wire bytes
+import argparse
+import json
+import struct
+import time
+
+import engine
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+ROLES = tuple(role.value for role in engine.Role)
+PHASES = tuple(phase.value for phase in engine.Phase)
+VIEWS = ('town', 'mafia', 'dead')
+
+# Field kinds: None is sent as-is, ('enum', values) as an index into values,
+# ('list', record) and ('map', record) as a list or {key: record} of records
+RECORDS = {
+    'player': [('id', None), ('name', None), ('role', ('enum', ROLES)), ('alive', None),
+               ('votes', None), ('is_admin', None)],
+    'message': [('timestamp', None), ('message', None), ('seq', None)],
+    'game': [('full', None), ('view', ('enum', VIEWS)), ('stream', None), ('base', None),
+             ('version', None), ('phase', ('enum', PHASES)), ('day_number', None),
+             ('time_remaining', None), ('players', ('map', 'player')),
+             ('communications', ('list', 'message')), ('messages', ('list', 'message'))],
+    'lobby': [('code', None), ('players', ('list', 'player')), ('player_count', None),
+              ('settings', None), ('game_started', None), ('messages', ('list', 'message'))],
+    'batch': [('messages', ('list', 'message'))],
+}
+
+# Events sent as a record in binary mode
+EVENTS = {
+    'game_update': 'game',
+    'lobby_update': 'lobby',
+    'messages_batch': 'batch',
+    'private_message': 'message',
+}
+
+
+def schema():
+    """The binary layout as JSON, for clients to decode with."""
+    return {
+        'events': EVENTS,
+        'records': {name: [[field, kind] for field, kind in fields] for name, fields in RECORDS.items()},
+    }
+
+
+class Layout:
+    """One record's fields, and a plan per key order seen so far saying
+    which fields to send and how to encode them."""
+    __slots__ = ('fields', 'known', 'extra_bit', 'plans')
+
+    def __init__(self, fields):
+        self.fields = [(field, kind and value_encoder(kind)) for field, kind in fields]
+        self.known = {field for field, kind in fields}
+        self.extra_bit = 1 << len(fields)
+        self.plans = {}  # tuple of keys -> (mask, [(field, encoder)], extra keys)
+
+    def plan(self, keys):
+        plan = self.plans.get(keys)
+        if plan is None:
+            mask = 0
+            steps = []
+            for bit, (field, encoder) in enumerate(self.fields):
+                if field in keys:
+                    mask |= 1 << bit
+                    steps.append((field, encoder))
+            extras = [key for key in keys if key not in self.known]
+            if extras:
+                mask |= self.extra_bit
+            plan = (mask, steps, extras)
+            if len(self.plans) < 64:
+                self.plans[keys] = plan
+        return plan
+
+
+def value_encoder(kind):
+    form, arg = kind
+    if form == 'enum':
+        # Role and Phase members hash by name, so look them up by value
+        codes = {value: code for code, value in enumerate(arg)}
+        return lambda value: codes[getattr(value, 'value', value)]
+    if form == 'list':
+        return lambda value: [encode_record(arg, item) for item in value]
+    return lambda value: {key: encode_record(arg, item) for key, item in value.items()}
+
+
+def encode_record(name, data):
+    mask, steps, extras = LAYOUTS[name].plan(tuple(data))
+    values = [mask]
+    for field, encoder in steps:
+        value = data[field]
+        values.append(encoder(value) if encoder and value is not None else value)
+    if extras:
+        values.append({key: data[key] for key in extras})
+    return values
+
+
+LAYOUTS = {name: Layout(fields) for name, fields in RECORDS.items()}
+
+
+def decode_record(name, values):
+    fields = RECORDS[name]
+    mask = values[0]
+    data = {}
+    index = 1
+    for bit, (field, kind) in enumerate(fields):
+        if mask & (1 << bit):
+            value = values[index]
+            index += 1
+            if kind is not None and value is not None:
+                value = decode_value(kind, value)
+            data[field] = value
+    if mask & (1 << len(fields)):
+        data.update(values[index])
+    return data
+
+
+def decode_value(kind, value):
+    form, arg = kind
+    if form == 'enum':
+        return arg[value]
+    if form == 'list':
+        return [decode_record(arg, item) for item in value]
+    return {key: decode_record(arg, item) for key, item in value.items()}
+
+
+def encode(event, data):
+    """`data` for `event` as MessagePack bytes."""
+    record = EVENTS.get(event)
+    if record and isinstance(data, dict):
+        data = encode_record(record, data)
+    return packb(data)
+
+
+def decode(event, payload):
+    data = unpackb(payload)
+    record = EVENTS.get(event)
+    return decode_record(record, data) if record else data
+
+
+# MessagePack, for when the msgpack package isn't installed. Covers what
+# events carry: None, bools, ints, floats, str, bytes, lists and dicts.
+def _pack(obj, buf):
+    if obj is None:
+        buf.append(0xc0)
+    elif obj is True:
+        buf.append(0xc3)
+    elif obj is False:
+        buf.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            buf.append(obj)
+        elif -0x20 <= obj < 0:
+            buf.append(obj & 0xff)
+        elif 0 <= obj <= 0xffff:
+            buf += struct.pack('>BB', 0xcc, obj) if obj <= 0xff else struct.pack('>BH', 0xcd, obj)
+        elif 0 <= obj <= 0xffffffff:
+            buf += struct.pack('>BI', 0xce, obj)
+        elif obj > 0:
+            buf += struct.pack('>BQ', 0xcf, obj)
+        elif obj >= -0x80000000:
+            buf += struct.pack('>Bi', 0xd2, obj)
+        else:
+            buf += struct.pack('>Bq', 0xd3, obj)
+    elif isinstance(obj, str):
+        data = obj.encode()
+        size = len(data)
+        if size < 0x20:
+            buf.append(0xa0 | size)
+        elif size <= 0xff:
+            buf += struct.pack('>BB', 0xd9, size)
+        elif size <= 0xffff:
+            buf += struct.pack('>BH', 0xda, size)
+        else:
+            buf += struct.pack('>BI', 0xdb, size)
+        buf += data
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 0x10:
+            buf.append(0x90 | size)
+        elif size <= 0xffff:
+            buf += struct.pack('>BH', 0xdc, size)
+        else:
+            buf += struct.pack('>BI', 0xdd, size)
+        for item in obj:
+            _pack(item, buf)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 0x10:
+            buf.append(0x80 | size)
+        elif size <= 0xffff:
+            buf += struct.pack('>BH', 0xde, size)
+        else:
+            buf += struct.pack('>BI', 0xdf, size)
+        for key, value in obj.items():
+            _pack(key, buf)
+            _pack(value, buf)
+    elif isinstance(obj, float):
+        buf += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        buf += struct.pack('>BB', 0xc4, size) if size <= 0xff else struct.pack('>BI', 0xc6, size)
+        buf += obj
+    else:
+        raise TypeError(f'Cannot pack {type(obj).__name__}')
+
+
+def _unpack(data, pos):
+    byte = data[pos]
+    pos += 1
+    if byte < 0x80:
+        return byte, pos
+    if byte >= 0xe0:
+        return byte - 0x100, pos
+    if 0xa0 <= byte <= 0xbf:
+        size = byte & 0x1f
+        return data[pos:pos + size].decode(), pos + size
+    if 0x90 <= byte <= 0x9f:
+        return _unpack_array(data, pos, byte & 0x0f)
+    if 0x80 <= byte <= 0x8f:
+        return _unpack_map(data, pos, byte & 0x0f)
+    if byte == 0xc0:
+        return None, pos
+    if byte in (0xc2, 0xc3):
+        return byte == 0xc3, pos
+    fmt, size = _FIXED.get(byte, (None, 0))
+    if fmt:
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    if byte in _SIZED:
+        fmt, kind = _SIZED[byte]
+        length = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+        if kind == 'str':
+            return data[pos:pos + length].decode(), pos + length
+        if kind == 'bin':
+            return bytes(data[pos:pos + length]), pos + length
+        if kind == 'array':
+            return _unpack_array(data, pos, length)
+        return _unpack_map(data, pos, length)
+    raise ValueError(f'Unsupported MessagePack type 0x{byte:02x}')
+
+
+_FIXED = {0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+          0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8),
+          0xca: ('>f', 4), 0xcb: ('>d', 8)}
+_SIZED = {0xd9: ('>B', 'str'), 0xda: ('>H', 'str'), 0xdb: ('>I', 'str'),
+          0xc4: ('>B', 'bin'), 0xc5: ('>H', 'bin'), 0xc6: ('>I', 'bin'),
+          0xdc: ('>H', 'array'), 0xdd: ('>I', 'array'), 0xde: ('>H', 'map'), 0xdf: ('>I', 'map')}
+
+
+def _unpack_array(data, pos, size):
+    items = []
+    for _ in range(size):
+        item, pos = _unpack(data, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(data, pos, size):
+    items = {}
+    for _ in range(size):
+        key, pos = _unpack(data, pos)
+        items[key], pos = _unpack(data, pos)
+    return items, pos
+
+
+def packb(obj):
+    if msgpack:
+        return msgpack.packb(obj)
+    buf = bytearray()
+    _pack(obj, buf)
+    return bytes(buf)
+
+
+def unpackb(data):
+    if msgpack:
+        return msgpack.unpackb(data, strict_map_key=False)
+    return _unpack(data, 0)[0]
+
+
+class FastJSON:
+    """JSON module for SocketIO(json=...) backed by orjson."""
+
+    def dumps(self, obj, *args, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, text, *args, **kwargs):
+        return orjson.loads(text)
+
+
+# The JSON encoder for Socket.IO packets: orjson if installed, else the stdlib
+fast_json = FastJSON() if orjson else json
+
+
+def wire_bytes(event, data, codec):
+    """Bytes a Socket.IO event takes on a websocket, packet framing included."""
+    from socketio import packet
+
+    if codec == 'binary':
+        data = encode(event, data)
+    encoded = packet.Packet(packet.EVENT, data=[event, data]).encode()
+    if isinstance(encoded, list):
+        return sum(len(part) for part in encoded)
+    return len(encoded.encode())
+
+
+def benchmark(num_players, rounds):
+    """Encode a game's events every way and report time and size."""
+    import app
+
+    app.replays = app.open_replays('')  # no replay file for the bench game
+    lobby = app.Lobby('BENCH0', app.Player('0' * 16, 'Player 0', None))
+    for number in range(1, num_players):
+        lobby.add_player(app.Player(f'{number:016x}', f'Player {number}', None))
+    for number in range(40):
+        lobby.add_message(f'Player {number % num_players}: a chat line of ordinary length, number {number}')
+    lobby_update = lobby.to_dict()
+
+    game = app.Game(lobby)
+    game.get_game_patches()
+    snapshot = game.get_game_state('mafia')
+    victim = next(iter(game.alive_by_role[engine.Role.TOWNSFOLK]))
+    game.kill_player(victim)
+    game.pending_messages.append(lobby.add_message('Somebody was killed by the mafia!'))
+    game.phase = engine.Phase.DAY
+    patch = game.get_game_patches()['town']
+    app.phase_scheduler.cancel(lobby.code)
+
+    events = [
+        ('game_update (snapshot)', 'game_update', snapshot),
+        ('game_update (patch)', 'game_update', patch),
+        ('lobby_update', 'lobby_update', lobby_update),
+        ('messages_batch', 'messages_batch', {'messages': [app.message_dict(entry) for entry in list(lobby.messages)[-3:]]}),
+        ('private_message', 'private_message', {'seq': 3, 'timestamp': '12:00:00', 'message': 'Your investigation reveals that Player 3 seems suspicious.'}),
+    ]
+    encoders = {
+        'json': lambda event, data: json.dumps([event, data], separators=(',', ':')),
+        'fast_json': lambda event, data: fast_json.dumps([event, data]),
+        'binary': encode,
+    }
+    results = []
+    for label, event, data in events:
+        row = {'event': label}
+        for codec, encoder in encoders.items():
+            if codec == 'fast_json' and fast_json is json:
+                continue
+            start = time.perf_counter()
+            for _ in range(rounds):
+                encoder(event, data)
+            row[f'{codec}_us'] = round((time.perf_counter() - start) / rounds * 1e6, 2)
+            if codec != 'fast_json':  # same bytes as json
+                row[f'{codec}_bytes'] = wire_bytes(event, data, codec)
+        assert decode(event, encode(event, data)) == json.loads(json.dumps(data))
+        results.append(row)
+    return {'players': num_players, 'orjson': orjson is not None, 'msgpack': msgpack is not None,
+            'events': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Socket.IO event encodings.")
+    parser.add_argument('--bench', action='store_true', help="encode sample events and report time and size")
+    parser.add_argument('--players', type=int, default=12)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+    if not args.bench:
+        parser.error('nothing to do; pass --bench')
+    print(json.dumps(benchmark(args.players, args.rounds), indent=2))
+
+
+if __name__ == '__main__':
+    main()
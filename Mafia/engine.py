@@ -0,0 +1,432 @@
+# engine.py
+# Game rules with no server attached: role assignment, night resolution, vote
+# counting and win checks. app.py drives these for live games; HeadlessGame
+# plays whole games with bots, and running this file simulates games in bulk
+# to report win rates, e.g.
+#   python engine.py --players 4-16 --games 20000 --workers 8
+import argparse
+import json
+import multiprocessing
+import random
+from collections import Counter, namedtuple
+from enum import Enum
+
+
+class Role(str, Enum):
+    MAFIA = "mafia"
+    TOWNSFOLK = "townsfolk"
+    DOCTOR = "doctor"
+    DETECTIVE = "detective"
+
+    def __str__(self):
+        return self.value
+
+
+class Phase(str, Enum):
+    SETUP = "setup"
+    NIGHT = "night"
+    DAY = "day"
+    DISCUSSION = "discussion"
+    VOTING = "voting"
+    ENDED = "ended"
+
+    def __str__(self):
+        return self.value
+
+
+class VoteTally:
+    """Running vote counts for one voting phase.
+
+    Targets are bucketed by vote count so casting, changing a vote and
+    reading the current leader are all O(1).
+    """
+    __slots__ = ('ballots', 'counts', 'buckets', 'max_votes')
+
+    def __init__(self):
+        self.ballots = {}  # voter id -> target id
+        self.counts = {}  # target id -> number of votes
+        self.buckets = {}  # number of votes -> set of target ids
+        self.max_votes = 0
+
+    def __len__(self):
+        return len(self.ballots)
+
+    def cast(self, voter_id, target_id):
+        """Record a vote and return the voter's previous target, if any."""
+        previous = self.ballots.get(voter_id)
+        if previous == target_id:
+            return previous
+        if previous is not None:
+            self._move(previous, -1)
+        self.ballots[voter_id] = target_id
+        self._move(target_id, 1)
+        return previous
+
+    def withdraw(self, player_id):
+        """Drop the ballot cast by `player_id` and every ballot cast for
+        them; returns the ids of the voters whose ballots were dropped."""
+        voters = [voter_id for voter_id, target_id in self.ballots.items()
+                  if voter_id == player_id or target_id == player_id]
+        for voter_id in voters:
+            self._move(self.ballots.pop(voter_id), -1)
+        return voters
+
+    def _move(self, target_id, delta):
+        count = self.counts.get(target_id, 0)
+        if count:
+            self.buckets[count].discard(target_id)
+        count += delta
+        if count:
+            self.counts[target_id] = count
+            self.buckets.setdefault(count, set()).add(target_id)
+        else:
+            del self.counts[target_id]
+
+        if count > self.max_votes:
+            self.max_votes = count
+        elif not self.buckets.get(self.max_votes):
+            # Only one target moved, so the next leaders are one vote behind
+            self.max_votes -= 1
+
+    @property
+    def leaders(self):
+        return self.buckets.get(self.max_votes, set()) if self.max_votes else set()
+
+    @property
+    def is_tie(self):
+        return len(self.leaders) > 1
+
+    @property
+    def leader(self):
+        """The single target with the most votes, or None on a tie or no votes."""
+        leaders = self.leaders
+        return next(iter(leaders)) if len(leaders) == 1 else None
+
+
+NightResult = namedtuple('NightResult', 'target killed investigations')
+
+
+def mafia_count(num_players):
+    if num_players <= 6:
+        return 1
+    elif num_players <= 9:
+        return 2
+    return 3
+
+
+class Night:
+    """What the night's actions have done so far; resolvers read and update it."""
+    __slots__ = ('players', 'protected', 'target', 'killed', 'investigations')
+
+    def __init__(self, players):
+        self.players = players
+        self.protected = set()
+        self.target = None  # the mafia's pick
+        self.killed = None
+        self.investigations = []  # (detective id, target id, suspicious)
+
+
+def resolve_heal(night, picks):
+    night.protected.update(picks.values())
+
+
+def resolve_kill(night, picks):
+    """The mafia kill whoever most of them picked; a tie goes to the
+    target picked first."""
+    counts = {}
+    for target_id in picks.values():
+        counts[target_id] = counts.get(target_id, 0) + 1
+    night.target = max(counts, key=counts.get)
+    if night.target not in night.protected:
+        night.killed = night.target
+
+
+def resolve_investigate(night, picks):
+    for actor_id, target_id in picks.items():
+        night.investigations.append((actor_id, target_id, night.players[target_id].role == Role.MAFIA))
+
+
+# Role registry. A role with a night action names the action, its priority
+# (lower resolves first) and a resolver that applies every submission of that
+# action at once as resolver(night, {actor id: target id}). Special roles are
+# dealt out when the lobby setting named after them is on and there are at
+# least `min_players` players.
+RoleSpec = namedtuple('RoleSpec', 'role action priority resolve min_players')
+
+ROLES = {}  # Role -> RoleSpec
+ACTIONS = {}  # night action type -> RoleSpec
+NIGHT_ACTIONS = {}  # Role -> night action type, for roles that have one
+
+
+def register_role(role, action=None, priority=0, resolve=None, min_players=0):
+    spec = RoleSpec(role, action, priority, resolve, min_players)
+    ROLES[role] = spec
+    if action:
+        ACTIONS[action] = spec
+        NIGHT_ACTIONS[role] = action
+
+
+register_role(Role.MAFIA, 'mafia_kill', 20, resolve_kill)
+register_role(Role.TOWNSFOLK)
+register_role(Role.DOCTOR, 'doctor_heal', 10, resolve_heal, min_players=5)
+register_role(Role.DETECTIVE, 'detective_investigate', 30, resolve_investigate, min_players=7)
+
+
+def assign_roles(player_ids, specials=(), rng=random):
+    """Return {player_id: Role} for a new game.
+
+    `specials` are the registered roles to deal out, each replacing one
+    townsfolk if there are enough players for it.
+    """
+    order = list(player_ids)
+    rng.shuffle(order)
+
+    num_players = len(order)
+    num_mafia = mafia_count(num_players)
+    roles = {pid: Role.MAFIA if i < num_mafia else Role.TOWNSFOLK for i, pid in enumerate(order)}
+
+    special = [role for role in specials if num_players >= ROLES[role].min_players]
+    for role, pid in zip(special, order[num_mafia:]):
+        roles[pid] = role
+    return roles
+
+
+class NightActions:
+    """One night's submitted actions, bucketed by resolution priority as
+    they arrive so that resolving them is a single ordered pass.
+
+    A player who resubmits replaces their earlier action.
+    """
+    __slots__ = ('actions', 'buckets')
+
+    def __init__(self, actions=None):
+        self.actions = {}  # actor id -> {'type', 'target_id'}, as persisted
+        self.buckets = {}  # (priority, action type) -> {actor id: target id}
+        for actor_id, action in (actions or {}).items():
+            self.submit(actor_id, action['type'], action['target_id'])
+
+    def __len__(self):
+        return len(self.actions)
+
+    def submit(self, actor_id, action_type, target_id):
+        previous = self.actions.get(actor_id)
+        if previous and previous['type'] != action_type:
+            del self.buckets[ACTIONS[previous['type']].priority, previous['type']][actor_id]
+        self.actions[actor_id] = {'type': action_type, 'target_id': target_id}
+        self.buckets.setdefault((ACTIONS[action_type].priority, action_type), {})[actor_id] = target_id
+
+    def withdraw(self, actor_id):
+        """Drop the action `actor_id` submitted, if any; returns whether there was one."""
+        action = self.actions.pop(actor_id, None)
+        if action is None:
+            return False
+        del self.buckets[ACTIONS[action['type']].priority, action['type']][actor_id]
+        return True
+
+    def resolve(self, players):
+        """Apply the actions in priority order and return a NightResult.
+
+        `players` maps id to anything with a `role`; actors and targets who
+        are no longer in it are skipped.
+        """
+        night = Night(players)
+        for key in sorted(self.buckets):
+            picks = {actor_id: target_id for actor_id, target_id in self.buckets[key].items()
+                     if actor_id in players and target_id in players}
+            if picks:
+                ACTIONS[key[1]].resolve(night, picks)
+        return NightResult(night.target, night.killed, night.investigations)
+
+
+def winner(mafia_alive, town_alive):
+    """'town', 'mafia' or None while the game goes on."""
+    if mafia_alive == 0:
+        return 'town'
+    if mafia_alive >= town_alive:
+        return 'mafia'
+    return None
+
+
+class SimPlayer:
+    __slots__ = ('id', 'role', 'alive')
+
+    def __init__(self, id, role):
+        self.id = id
+        self.role = role
+        self.alive = True
+
+
+class RandomPolicy:
+    """Bots that pick uniformly at random among sensible targets.
+
+    Mafia never target or vote for each other, and a detective votes for
+    anyone they found suspicious.
+    """
+
+    def night_target(self, game, player, rng):
+        if player.role == Role.MAFIA:
+            candidates = [p.id for p in game.alive() if p.role != Role.MAFIA]
+        elif player.role == Role.DOCTOR:
+            candidates = [p.id for p in game.alive()]
+        else:
+            candidates = [p.id for p in game.alive() if p.id != player.id and p.id not in game.findings]
+        return rng.choice(candidates) if candidates else None
+
+    def vote(self, game, player, rng):
+        if player.role == Role.DETECTIVE:
+            suspects = [p.id for p in game.alive() if game.findings.get(p.id)]
+            if suspects:
+                return suspects[0]
+        if player.role == Role.MAFIA:
+            candidates = [p.id for p in game.alive() if p.role != Role.MAFIA]
+        else:
+            candidates = [p.id for p in game.alive() if p.id != player.id and game.findings.get(p.id) is not False]
+        return rng.choice(candidates) if candidates else None
+
+
+class HeadlessGame:
+    """One game played start to finish by a bot policy, without a server.
+
+    Events go to `sink(event, data)` if one is given, e.g. to record or
+    replay games; the default discards them.
+    """
+
+    def __init__(self, num_players, doctor=True, detective=False, policy=None, rng=random, sink=None):
+        self.rng = rng
+        self.policy = policy or RandomPolicy()
+        self.sink = sink
+        self.day_number = 0
+        self.findings = {}  # player id -> suspicious, as learned by the detective
+        specials = [role for role, enabled in ((Role.DOCTOR, doctor), (Role.DETECTIVE, detective)) if enabled]
+        roles = assign_roles(range(num_players), specials, rng)
+        self.players = {pid: SimPlayer(pid, role) for pid, role in roles.items()}
+        self.emit('roles', {'roles': {pid: role.value for pid, role in roles.items()}})
+
+    def emit(self, event, data):
+        if self.sink:
+            self.sink(event, data)
+
+    def alive(self):
+        return [player for player in self.players.values() if player.alive]
+
+    def kill(self, player_id, cause):
+        self.players[player_id].alive = False
+        self.emit('death', {'id': player_id, 'cause': cause, 'day_number': self.day_number})
+
+    def winner(self):
+        mafia_alive = sum(1 for player in self.alive() if player.role == Role.MAFIA)
+        return winner(mafia_alive, len(self.alive()) - mafia_alive)
+
+    def play(self):
+        """Play until someone wins and return 'town' or 'mafia'."""
+        while True:
+            self.day_number += 1
+            self.emit('phase', {'phase': Phase.NIGHT.value, 'day_number': self.day_number})
+
+            night_actions = NightActions()
+            for player in self.alive():
+                action_type = NIGHT_ACTIONS.get(player.role)
+                if action_type:
+                    target_id = self.policy.night_target(self, player, self.rng)
+                    if target_id is not None:
+                        night_actions.submit(player.id, action_type, target_id)
+                        self.emit('night_action', {'player': player.id, 'type': action_type, 'target': target_id})
+
+            result = night_actions.resolve(self.players)
+            if result.killed is not None:
+                self.kill(result.killed, 'mafia')
+            for detective_id, target_id, suspicious in result.investigations:
+                self.findings[target_id] = suspicious
+            side = self.winner()
+            if side:
+                break
+
+            self.emit('phase', {'phase': Phase.VOTING.value, 'day_number': self.day_number})
+            tally = VoteTally()
+            for player in self.alive():
+                target_id = self.policy.vote(self, player, self.rng)
+                if target_id is not None:
+                    tally.cast(player.id, target_id)
+                    self.emit('vote', {'voter': player.id, 'target': target_id})
+            if tally.leader is not None:
+                self.kill(tally.leader, 'vote')
+            side = self.winner()
+            if side:
+                break
+
+        self.emit('end', {'winner': side, 'day_number': self.day_number})
+        return side
+
+
+def simulate_batch(task):
+    """Play `games` games for one configuration; runs in a worker process."""
+    num_players, doctor, detective, games, seed = task
+    rng = random.Random(seed)
+    wins = Counter()
+    days = 0
+    for _ in range(games):
+        game = HeadlessGame(num_players, doctor, detective, rng=rng)
+        wins[game.play()] += 1
+        days += game.day_number
+    return (num_players, doctor, detective), wins, days
+
+
+def run_simulations(player_counts, games, workers=None, chunk=1000, seed=0):
+    """Win statistics for every player count and doctor/detective setting."""
+    tasks = []
+    for num_players in player_counts:
+        for doctor in (False, True):
+            for detective in (False, True):
+                for start in range(0, games, chunk):
+                    tasks.append((num_players, doctor, detective, min(chunk, games - start), seed + len(tasks)))
+
+    results = {}
+    with multiprocessing.Pool(workers) as pool:
+        for key, wins, days in pool.imap_unordered(simulate_batch, tasks):
+            stats = results.setdefault(key, {'games': 0, 'town': 0, 'mafia': 0, 'days': 0})
+            stats['games'] += sum(wins.values())
+            stats['town'] += wins['town']
+            stats['mafia'] += wins['mafia']
+            stats['days'] += days
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate bot games and report win rates.")
+    parser.add_argument('--players', default='4-16', help="player count or range, e.g. 8 or 4-16")
+    parser.add_argument('--games', type=int, default=10000, help="games per configuration")
+    parser.add_argument('--workers', type=int, default=None, help="worker processes (default: CPU count)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help="print machine-readable results")
+    args = parser.parse_args()
+
+    low, _, high = args.players.partition('-')
+    player_counts = range(int(low), int(high or low) + 1)
+    results = run_simulations(player_counts, args.games, args.workers, seed=args.seed)
+
+    rows = []
+    for (num_players, doctor, detective), stats in sorted(results.items()):
+        rows.append({
+            'players': num_players,
+            'mafia': mafia_count(num_players),
+            'doctor': doctor,
+            'detective': detective,
+            'games': stats['games'],
+            'town_win_rate': stats['town'] / stats['games'],
+            'mafia_win_rate': stats['mafia'] / stats['games'],
+            'average_days': stats['days'] / stats['games'],
+        })
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+
+    print(f"{'players':>7} {'mafia':>5} {'doctor':>6} {'detect':>6} {'games':>8} {'town%':>7} {'mafia%':>7} {'days':>5}")
+    for row in rows:
+        print(f"{row['players']:>7} {row['mafia']:>5} {'yes' if row['doctor'] else 'no':>6} "
+              f"{'yes' if row['detective'] else 'no':>6} {row['games']:>8} "
+              f"{row['town_win_rate']:>7.1%} {row['mafia_win_rate']:>7.1%} {row['average_days']:>5.2f}")
+
+
+if __name__ == '__main__':
+    main()
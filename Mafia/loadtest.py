@@ -0,0 +1,829 @@
+# loadtest.py
+# Drives many concurrent bot clients through complete games against a local
+# server and reports capacity numbers. Needs the asyncio Socket.IO client:
+#   pip install "python-socketio[asyncio_client]"
+#
+#   python loadtest.py --spawn --lobbies 200 --duration 120 --report report.json
+#
+# Each bot registers through POST /create or /join with its own cookie jar,
+# opens a socket, emits join_lobby and then plays: night actions, votes and
+# chat with random think times. Every emit waits for the server's ack, so the
+# latency numbers cover the full handler round trip.
+#
+#   python loadtest.py --spawn --quickmatch 10 100 1000 --duration 20
+#
+# benchmarks the quick-match queue instead: clients arrive at each given rate
+# (per second), POST /quickmatch and wait for match_found, and the report
+# gives time-to-match percentiles per arrival rate.
+#
+# For a soak test, run for hours with some bots abandoning games mid-way and
+# short server TTLs; the report's server.rss_series shows whether memory
+# levels off:
+#
+#   MAFIA_LOBBY_IDLE_TTL=60 MAFIA_ENDED_GAME_TTL=30 \
+#       python loadtest.py --spawn --duration 10800 --abandon 0.05 --report soak.json
+#
+# To hammer one lobby from many clients and check game invariants (phase
+# order, dead players acting, vote counts) under contention:
+#
+#   python loadtest.py --spawn --stress --lobbies 1 --players 16 --think 0 0.01
+#
+# To measure what spectators cost the players, run the same games with
+# growing audiences; each count gets its own report under "spectators", with
+# player latencies, spectator updates received and server CPU side by side:
+#
+#   python loadtest.py --spawn --lobbies 10 --spectators 0 100 1000
+#
+# To compare the Flask-SocketIO server with asgi.py on the same workload, give
+# both; the report then has one section per server under "servers":
+#
+#   python loadtest.py --spawn --server flask asgi --lobbies 200 --duration 60
+#
+# To measure HTTP polling instead, fill one lobby with --players members and
+# have each given number of clients fetch /api/lobby/<code> and /lobby/<code>
+# back to back, once always downloading and once revalidating with the last
+# ETag; the lobby host chats once a second so versions keep moving:
+#
+#   python loadtest.py --spawn --poll 1 10 50 --players 8 --duration 10
+#
+# To see throughput scale with sharded workers, run the same games against
+# 1, 2, ... app.py workers sharing a zmq_broker.py message queue (pip install
+# pyzmq). Workers listen on consecutive ports from --url's, the broker on the
+# two after them, and each lobby is played on the worker that owns its code:
+#
+#   python loadtest.py --spawn --shards 1 2 4 --lobbies 100 --duration 60
+#
+# To measure chat fan-out, fill one lobby with --players members who all chat
+# nonstop, once per given MAFIA_CHAT_BATCH_MS window (flood limits raised out
+# of the way), and report delivery latency and frames received per second:
+#
+#   python loadtest.py --spawn --chat-storm 0 50 --players 20 --think 0 0.05 --duration 10
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import secrets
+import subprocess
+import sys
+import time
+
+import aiohttp
+import socketio
+
+ROLE_PATTERN = re.compile(r'const playerRole = "(\w+)"')
+NIGHT_ROLES = ('mafia', 'doctor', 'detective')
+
+
+class Stats:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.latencies = {}  # event -> [seconds]
+        self.sent = 0
+        self.received = 0
+        self.connected = 0
+        self.max_connected = 0
+        self.games_started = 0
+        self.games_finished = 0
+        self.errors = {}
+        self.violations = {}  # broken game invariants seen by --stress bots
+        self.spectators = 0
+        self.spectator_updates = 0
+
+    def connect(self):
+        self.connected += 1
+        self.max_connected = max(self.max_connected, self.connected)
+
+    def disconnect(self):
+        self.connected -= 1
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def violation(self, kind):
+        self.violations[kind] = self.violations.get(kind, 0) + 1
+
+    def report(self, server):
+        elapsed = time.monotonic() - self.started
+        latency = {}
+        for event, samples in sorted(self.latencies.items()):
+            samples = sorted(samples)
+            latency[event] = {
+                'count': len(samples),
+                'p50_ms': percentile(samples, 50) * 1000,
+                'p90_ms': percentile(samples, 90) * 1000,
+                'p99_ms': percentile(samples, 99) * 1000,
+                'max_ms': samples[-1] * 1000,
+            }
+        return {
+            'elapsed_s': elapsed,
+            'max_connections': self.max_connected,
+            'games_started': self.games_started,
+            'games_finished': self.games_finished,
+            'events_sent': self.sent,
+            'events_received': self.received,
+            'sent_per_s': self.sent / elapsed,
+            'received_per_s': self.received / elapsed,
+            'latency': latency,
+            'errors': self.errors,
+            'violations': self.violations,
+            'max_spectators': self.spectators,
+            'spectator_updates': self.spectator_updates,
+            'spectator_updates_per_s': self.spectator_updates / elapsed,
+            'server': server,
+        }
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0.0
+    index = min(len(samples) - 1, int(len(samples) * pct / 100))
+    return samples[index]
+
+
+class ServerProbe:
+    """Samples RSS and CPU time of the server process from /proc (Linux only)."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.max_rss = 0
+        self.rss_series = []  # [seconds since start, rss bytes], every SERIES_INTERVAL
+        self.cpu_start = self.cpu_seconds()
+        self.wall_start = time.monotonic()
+
+    def cpu_seconds(self):
+        with open(f'/proc/{self.pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / self.ticks
+
+    def rss_bytes(self):
+        with open(f'/proc/{self.pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    SERIES_INTERVAL = 10
+
+    def sample(self):
+        rss = self.rss_bytes()
+        self.max_rss = max(self.max_rss, rss)
+        elapsed = time.monotonic() - self.wall_start
+        if not self.rss_series or elapsed - self.rss_series[-1][0] >= self.SERIES_INTERVAL:
+            self.rss_series.append([round(elapsed, 1), rss])
+
+    def summary(self):
+        cpu = self.cpu_seconds() - self.cpu_start
+        return {
+            'pid': self.pid,
+            'rss_bytes': self.rss_bytes(),
+            'max_rss_bytes': self.max_rss,
+            'cpu_seconds': cpu,
+            'cpu_utilization': cpu / (time.monotonic() - self.wall_start),
+            'rss_series': self.rss_series,
+        }
+
+
+class ProbeGroup:
+    """ServerProbe over several worker processes, with the totals summed."""
+
+    def __init__(self, pids):
+        self.probes = [ServerProbe(pid) for pid in pids]
+
+    def sample(self):
+        for probe in self.probes:
+            probe.sample()
+
+    def summary(self):
+        workers = [probe.summary() for probe in self.probes]
+        totals = {key: sum(worker[key] for worker in workers)
+                  for key in ('rss_bytes', 'max_rss_bytes', 'cpu_seconds', 'cpu_utilization')}
+        return dict(totals, workers=workers)
+
+
+class Bot:
+    """One browser-equivalent client: cookie session, socket and game state."""
+
+    def __init__(self, args, stats, name, url=None):
+        self.args = args
+        self.stats = stats
+        self.name = name
+        self.url = url or args.url  # the worker that owns the bot's lobby
+        self.http = None
+        self.sio = None
+        self.code = None
+        self.player_id = None
+        self.role = None
+        self.state = None
+        self.phase_seen = None
+        self.done = asyncio.Event()
+
+    async def register(self, code=None):
+        self.http = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+        if code is None:
+            path, form = '/create', {'player_name': self.name}
+        else:
+            path, form = '/join', {'player_name': self.name, 'lobby_code': code}
+        async with self.http.post(self.url + path, data=form, allow_redirects=False) as response:
+            location = response.headers.get('Location', '')
+        if '/lobby/' not in location:
+            raise RuntimeError(f'{path} was refused')
+        self.code = location.rstrip('/').rsplit('/', 1)[1]
+
+    async def connect(self):
+        self.sio = socketio.AsyncClient(http_session=self.http, reconnection=False)
+        self.sio.on('game_update', self.on_game_update)
+        self.sio.on('game_started', self.on_game_started)
+        for event in ('lobby_update', 'messages_batch', 'private_message', 'action_confirmed', 'error', 'rate_limited'):
+            self.sio.on(event, self.on_other)
+        self.sio.on('disconnect', self.on_disconnect)
+        await self.sio.connect(self.url, transports=['websocket'])
+        self.stats.connect()
+        await self.emit('join_lobby', {})
+
+    async def close(self):
+        if self.sio and self.sio.connected:
+            await self.sio.disconnect()
+        if self.http:
+            await self.http.close()
+
+    async def emit(self, event, data):
+        data['lobby_code'] = self.code
+        self.stats.sent += 1
+        start = time.monotonic()
+        try:
+            await self.sio.call(event, data, timeout=self.args.timeout)
+        except socketio.exceptions.TimeoutError:
+            if self.sio.connected:  # not a bot that abandoned meanwhile
+                self.stats.error(f'{event}_timeout')
+            return
+        except socketio.exceptions.BadNamespaceError:
+            return  # disconnected while this phase was being played
+        self.stats.latencies.setdefault(event, []).append(time.monotonic() - start)
+
+    async def think(self):
+        await asyncio.sleep(random.uniform(*self.args.think))
+
+    async def on_other(self, *args):
+        self.stats.received += 1
+
+    async def on_disconnect(self, *args):
+        self.stats.disconnect()
+        self.done.set()
+
+    async def on_game_started(self, data):
+        self.stats.received += 1
+        # The game page renders our role; read it the way the browser does
+        async with self.http.get(self.url + data['redirect']) as response:
+            match = ROLE_PATTERN.search(await response.text())
+        self.role = match.group(1) if match else None
+        await self.emit('join_lobby', {})
+        await self.emit('request_game_state', {})
+
+    async def on_game_update(self, data):
+        self.stats.received += 1
+        if data.get('full'):
+            self.state = data
+        elif self.state is None or data['base'] > self.state['version']:
+            await self.emit('request_game_state', {})
+            return
+        elif data['base'] < self.state['version']:
+            return
+        else:
+            self.state['version'] = data['version']
+            if 'phase' in data:
+                self.state['phase'] = data['phase']
+                self.state['day_number'] = data['day_number']
+            for pid, changes in data.get('players', {}).items():
+                self.state['players'].setdefault(pid, {}).update(changes)
+
+        phase = (self.state['phase'], self.state['day_number'])
+        if phase != self.phase_seen:
+            self.phase_seen = phase
+            asyncio.ensure_future(self.play(phase))
+
+    async def play(self, phase):
+        name, day_number = phase
+        me = self.state['players'].get(self.player_id, {})
+        if name == 'ended':
+            self.done.set()
+            return
+        if not me.get('alive', True):
+            return
+        if random.random() < self.args.abandon:
+            # Drop out like a closed tab: no leave_lobby
+            self.done.set()
+            await self.sio.disconnect()
+            return
+
+        others = [pid for pid, player in self.state['players'].items()
+                  if player.get('alive') and pid != self.player_id]
+        if not others:
+            return
+        await self.think()
+        if self.phase_seen != phase:
+            return
+
+        if name == 'night' and self.role in NIGHT_ROLES:
+            if self.role == 'mafia':
+                others = [pid for pid in others if self.state['players'][pid].get('role') != 'mafia'] or others
+            await self.emit('night_action', {'target_id': random.choice(others)})
+        elif name in ('day', 'discussion'):
+            for _ in range(random.randint(0, self.args.chat)):
+                await self.emit('send_message', {'message': f'I think it is {random.choice(others)[:4]}'})
+                await self.think()
+        elif name == 'voting':
+            await self.emit('cast_vote', {'target_id': random.choice(others)})
+
+
+NEXT_PHASE = {'night': 'day', 'day': 'discussion', 'discussion': 'voting', 'voting': 'night'}
+
+
+class StressBot(Bot):
+    """Hammers its lobby with every kind of action, in any phase and after
+    dying, and checks the updates it gets back for broken invariants:
+
+    - phases only ever advance to their successor, each exactly once
+    - no action is confirmed to a dead player
+    - a vote count never exceeds the players alive when voting opened
+    """
+
+    def __init__(self, args, stats, name, url=None):
+        super().__init__(args, stats, name, url)
+        self.phases = set()
+        self.voters = None
+
+    async def connect(self):
+        await super().connect()
+        self.sio.on('action_confirmed', self.on_action_confirmed)
+
+    async def on_action_confirmed(self, data):
+        self.stats.received += 1
+        if self.state and not self.state['players'].get(self.player_id, {}).get('alive', True):
+            self.stats.violation('dead_player_acted')
+
+    async def on_game_update(self, data):
+        previous = self.phase_seen
+        await super().on_game_update(data)
+        if self.state is None or self.phase_seen is None:
+            return
+        phase, day_number = self.phase_seen
+        if self.phase_seen != previous:
+            if self.phase_seen in self.phases:
+                self.stats.violation('phase_repeated')
+            self.phases.add(self.phase_seen)
+            # A snapshot may legitimately skip what this bot missed
+            if previous and not data.get('full') and phase != 'ended':
+                expected = NEXT_PHASE[previous[0]]
+                expected_day = previous[1] + 1 if expected == 'night' else previous[1]
+                if (phase, day_number) != (expected, expected_day):
+                    self.stats.violation('phase_skipped')
+            if phase == 'voting':
+                self.voters = sum(1 for player in self.state['players'].values() if player.get('alive'))
+        if phase == 'voting' and self.voters is not None:
+            if sum(player.get('votes', 0) for player in self.state['players'].values()) > self.voters:
+                self.stats.violation('votes_exceed_voters')
+
+    async def play(self, phase):
+        if phase[0] == 'ended':
+            self.done.set()
+            return
+        while self.phase_seen == phase and self.sio.connected:
+            target = random.choice(list(self.state['players']))
+            event = random.choice(('night_action', 'cast_vote', 'send_message'))
+            if event == 'send_message':
+                await self.emit(event, {'message': f'hammer {target[:4]}'})
+            else:
+                await self.emit(event, {'target_id': target})
+            await self.think()
+
+
+class Spectator:
+    """A read-only viewer: one socket in a game's spectator room."""
+
+    def __init__(self, args, stats, code, url=None):
+        self.args = args
+        self.stats = stats
+        self.code = code
+        self.url = url or args.url
+        self.sio = None
+
+    async def watch(self):
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.sio.on('spectator_update', self.on_update)
+        try:
+            await self.sio.connect(self.url, transports=['websocket'])
+            await self.sio.emit('spectate', {'lobby_code': self.code})
+            self.stats.spectators += 1
+        except Exception as exc:
+            self.stats.error(f'spectator_{type(exc).__name__}')
+
+    async def on_update(self, data):
+        self.stats.spectator_updates += 1
+
+    async def close(self):
+        if self.sio and self.sio.connected:
+            await self.sio.disconnect()
+
+
+class StormBot(Bot):
+    """Lobby member that chats nonstop and times every chat line it sees
+    arrive against when its sender sent it."""
+
+    def __init__(self, args, stats, name, sent, delays, url=None):
+        super().__init__(args, stats, name, url)
+        self.sent = sent  # message text -> send time, shared by the lobby
+        self.delays = delays
+        self.frames = 0
+
+    async def connect(self):
+        await super().connect()
+        self.sio.on('messages_batch', self.on_messages_batch)
+
+    async def on_messages_batch(self, data):
+        now = time.monotonic()
+        self.stats.received += 1
+        self.frames += 1
+        for message in data['messages']:
+            sent = self.sent.get(message['message'])
+            if sent is not None:
+                self.delays.append(now - sent)
+
+    async def storm(self, deadline):
+        number = 0
+        while time.monotonic() < deadline:
+            number += 1
+            text = f'storm {number}'
+            self.sent[f'{self.name}: {text}'] = time.monotonic()
+            await self.emit('send_message', {'message': text})
+            await self.think()
+
+
+async def run_lobby(args, stats, lobby_index, deadline, spectators=0):
+    """Create lobbies and play games in them one after another until the deadline."""
+    bot_class = StressBot if args.stress else Bot
+    # With --shards, lobbies are spread over the workers round-robin
+    url = args.urls[lobby_index % len(args.urls)]
+    while time.monotonic() < deadline:
+        bots = [bot_class(args, stats, f'bot{lobby_index}-{i}', url) for i in range(args.players)]
+        watchers = []
+        try:
+            host = bots[0]
+            await host.register()
+            await host.connect()
+            # Before anyone joins, so --players can exceed the default seats
+            await host.emit('update_settings', {'settings': {'game_time': args.phase_time,
+                                                             'max_players': args.players}})
+            for bot in bots[1:]:
+                await bot.register(host.code)
+                await bot.connect()
+            async with host.http.get(f'{url}/api/lobby/{host.code}') as response:
+                lobby = await response.json()
+            names = {player['name']: player['id'] for player in lobby['players']}
+            for bot in bots:
+                bot.player_id = names.get(bot.name)
+
+            await host.emit('start_game', {})
+            stats.games_started += 1
+            watchers = [Spectator(args, stats, host.code, url) for _ in range(spectators)]
+            await asyncio.gather(*(watcher.watch() for watcher in watchers))
+
+            remaining = deadline - time.monotonic() + args.phase_time * 4
+            await asyncio.wait_for(asyncio.gather(*(bot.done.wait() for bot in bots)), remaining)
+            stats.games_finished += 1
+        except asyncio.TimeoutError:
+            stats.error('game_timeout')
+        except Exception as exc:  # keep the rest of the run going
+            stats.error(type(exc).__name__)
+            await asyncio.sleep(1)
+        finally:
+            await asyncio.gather(*(bot.close() for bot in bots + watchers), return_exceptions=True)
+
+
+async def quickmatch_client(args, stats, name, times):
+    start = time.monotonic()
+    http = aiohttp.ClientSession(cookie_jar=aiohttp.CookieJar(unsafe=True))
+    sio = socketio.AsyncClient(http_session=http, reconnection=False)
+    matched = asyncio.Event()
+    sio.on('match_found', lambda data: matched.set())
+    try:
+        async with http.post(args.url + '/quickmatch', data={'player_name': name},
+                             allow_redirects=False) as response:
+            if response.status != 302:
+                raise RuntimeError('/quickmatch was refused')
+        await sio.connect(args.url, transports=['websocket'])
+        stats.connect()
+        await sio.emit('join_queue', {})
+        await asyncio.wait_for(matched.wait(), args.timeout)
+        times.append(time.monotonic() - start)
+    except asyncio.TimeoutError:
+        stats.error('match_timeout')
+    except Exception as exc:
+        stats.error(type(exc).__name__)
+    finally:
+        if sio.connected:
+            await sio.disconnect()
+            stats.disconnect()
+        await http.close()
+
+
+async def run_quickmatch(args, probe):
+    """Time-to-match at each arrival rate, with Poisson arrivals."""
+    stats = Stats()
+    results = {}
+    for rate in args.quickmatch:
+        times = []
+        clients = []
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            name = f'qm{rate}-{len(clients)}'
+            clients.append(asyncio.ensure_future(quickmatch_client(args, stats, name, times)))
+            await asyncio.sleep(random.expovariate(rate))
+            if probe:
+                probe.sample()
+        await asyncio.gather(*clients)
+        times.sort()
+        results[str(rate)] = {
+            'clients': len(clients),
+            'matched': len(times),
+            'p50_ms': percentile(times, 50) * 1000,
+            'p90_ms': percentile(times, 90) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'max_ms': times[-1] * 1000 if times else 0.0,
+        }
+    report = stats.report(probe.summary() if probe else None)
+    report['time_to_match'] = results
+    return report
+
+
+async def run(args, probe, spectators=0):
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    lobbies = []
+    for index in range(args.lobbies):
+        lobbies.append(asyncio.ensure_future(run_lobby(args, stats, index, deadline, spectators)))
+        await asyncio.sleep(args.ramp / max(1, args.lobbies))
+
+    while not all(task.done() for task in lobbies):
+        if probe:
+            probe.sample()
+        await asyncio.sleep(1)
+    return stats.report(probe.summary() if probe else None)
+
+
+async def poll_client(http, url, conditional, deadline, results):
+    etag = None
+    while time.monotonic() < deadline:
+        headers = {'If-None-Match': etag} if conditional and etag else {}
+        start = time.monotonic()
+        async with http.get(url, headers=headers, allow_redirects=False) as response:
+            body = await response.read()
+            etag = response.headers.get('ETag', etag)
+        results.append((response.status, time.monotonic() - start, len(body)))
+
+
+async def chatter(host, deadline):
+    while time.monotonic() < deadline:
+        await host.emit('send_message', {'message': f'still waiting {time.monotonic():.0f}'})
+        await asyncio.sleep(1)
+
+
+async def run_poll(args, probe):
+    """Requests/second for clients repeatedly polling one lobby."""
+    stats = Stats()
+    bots = [Bot(args, stats, f'poll{i}') for i in range(args.players)]
+    host = bots[0]
+    await host.register()
+    await host.connect()
+    await host.emit('update_settings', {'settings': {'max_players': args.players}})
+    for bot in bots[1:]:
+        await bot.register(host.code)
+    results = {}
+    try:
+        for count in args.poll:
+            for name, path in (('api', f'/api/lobby/{host.code}'), ('page', f'/lobby/{host.code}')):
+                for conditional in (False, True):
+                    samples = []
+                    cpu = probe.cpu_seconds() if probe else 0.0
+                    deadline = time.monotonic() + args.duration
+                    chat = asyncio.ensure_future(chatter(host, deadline))
+                    await asyncio.gather(*(poll_client(bots[i % len(bots)].http, args.url + path, conditional,
+                                                       deadline, samples) for i in range(count)))
+                    await chat
+                    if probe:
+                        probe.sample()
+                        cpu = probe.cpu_seconds() - cpu
+                    latencies = sorted(latency for _, latency, _ in samples)
+                    mode = 'conditional' if conditional else 'plain'
+                    results.setdefault(str(count), {})[f'{name}_{mode}'] = {
+                        'requests': len(samples),
+                        'per_second': len(samples) / args.duration,
+                        'not_modified': sum(status == 304 for status, _, _ in samples),
+                        'errors': sum(status not in (200, 304) for status, _, _ in samples),
+                        'body_bytes_per_request': sum(size for _, _, size in samples) / max(1, len(samples)),
+                        'p50_ms': percentile(latencies, 50) * 1000,
+                        'p99_ms': percentile(latencies, 99) * 1000,
+                        'server_cpu_ms_per_request': cpu * 1000 / max(1, len(samples)),
+                    }
+    finally:
+        await asyncio.gather(*(bot.close() for bot in bots), return_exceptions=True)
+    report = stats.report(probe.summary() if probe else None)
+    report['polling'] = results
+    return report
+
+
+async def run_chat_storm(args, probe):
+    """Chat delivery latency and frame rate with every member of one lobby chatting."""
+    stats = Stats()
+    sent = {}
+    delays = []
+    bots = [StormBot(args, stats, f'storm{i}', sent, delays) for i in range(args.players)]
+    try:
+        host = bots[0]
+        await host.register()
+        await host.connect()
+        await host.emit('update_settings', {'settings': {'max_players': args.players}})
+        for bot in bots[1:]:
+            await bot.register(host.code)
+            await bot.connect()
+        await asyncio.sleep(1)  # let the join announcements go by
+        for bot in bots:
+            bot.frames = 0
+        if probe:
+            probe = ProbeGroup([probe.pid])  # count CPU from here on
+        await asyncio.gather(*(bot.storm(time.monotonic() + args.duration) for bot in bots))
+        await asyncio.sleep(1)  # the last batch window
+    finally:
+        await asyncio.gather(*(bot.close() for bot in bots), return_exceptions=True)
+    report = stats.report(probe.summary() if probe else None)
+    delays.sort()
+    frames = sum(bot.frames for bot in bots)
+    report['chat_storm'] = {
+        'messages_sent': len(sent),
+        'deliveries': len(delays),
+        'delivered_fraction': len(delays) / max(1, len(sent) * len(bots)),
+        'frames': frames,
+        'frames_per_s': frames / args.duration,
+        'messages_per_frame': len(delays) / max(1, frames),
+        'p50_ms': percentile(delays, 50) * 1000,
+        'p99_ms': percentile(delays, 99) * 1000,
+        'max_ms': percentile(delays, 100) * 1000,
+    }
+    return report
+
+
+def wait_for_server(url, process, timeout=30):
+    import urllib.request
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited during startup')
+        try:
+            urllib.request.urlopen(url + '/', timeout=1)
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def spawn_server(url, mode, env=None):
+    """Start app.py under Flask-SocketIO or asgi.py under uvicorn on the URL's port."""
+    port = int(url.rsplit(':', 1)[1])
+    if mode == 'asgi':
+        command = [sys.executable, 'asgi.py', '--host', '127.0.0.1', '--port', str(port)]
+    else:
+        # Run without the debug reloader so the pid we sample is the server itself
+        command = [sys.executable, '-c', f'import app; app.socketio.run(app.app, host="127.0.0.1", port={port})']
+    server = subprocess.Popen(command, cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_server(url, server)
+    return server
+
+
+def spawn_shards(url, count):
+    """Start zmq_broker.py and `count` sharded Flask-SocketIO workers.
+
+    Returns the worker URLs and every process started, broker first.
+    """
+    base, port = url.rsplit(':', 1)
+    port = int(port)
+    urls = [f'{base}:{port + index}' for index in range(count)]
+    push_port, pub_port = port + count, port + count + 1
+    broker = subprocess.Popen([sys.executable, 'zmq_broker.py', str(push_port), str(pub_port)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processes = [broker]
+    env = dict(os.environ, MAFIA_SHARD_COUNT=str(count), MAFIA_SHARD_URLS=','.join(urls),
+               MAFIA_SECRET_KEY=secrets.token_hex(16),
+               MAFIA_MESSAGE_QUEUE=f'zmq+tcp://127.0.0.1:{push_port}+{pub_port}')
+    try:
+        for index, worker_url in enumerate(urls):
+            processes.append(spawn_server(worker_url, 'flask', dict(env, MAFIA_SHARD_INDEX=str(index))))
+    except Exception:
+        stop(processes)
+        raise
+    return urls, processes
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+def run_once(args, pid):
+    if args.spectators:
+        # The same games once per audience size, each with a fresh CPU probe
+        return {'spectators': {str(count): asyncio.run(run(args, ServerProbe(pid) if pid else None, count))
+                               for count in args.spectators}}
+    runner = run_poll if args.poll else run_quickmatch if args.quickmatch else run
+    return asyncio.run(runner(args, ServerProbe(pid) if pid else None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the Mafia server with bot clients.")
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--spawn', action='store_true', help="start the server locally for the run")
+    parser.add_argument('--server', nargs='+', choices=('flask', 'asgi'), default=['flask'],
+                        help="with --spawn, run once against each of these servers in turn")
+    parser.add_argument('--server-pid', type=int, help="sample RSS/CPU of an already running server")
+    parser.add_argument('--lobbies', type=int, default=50, help="concurrent lobbies")
+    parser.add_argument('--players', type=int, default=8, help="bots per lobby")
+    parser.add_argument('--duration', type=float, default=60, help="seconds to keep starting games")
+    parser.add_argument('--ramp', type=float, default=10, help="seconds over which lobbies are started")
+    parser.add_argument('--phase-time', type=int, default=10, help="game_time setting for each lobby")
+    parser.add_argument('--think', type=float, nargs=2, default=(0.5, 2.0), metavar=('MIN', 'MAX'))
+    parser.add_argument('--chat', type=int, default=2, help="max chat messages per bot per day phase")
+    parser.add_argument('--timeout', type=float, default=10, help="ack timeout per emit")
+    parser.add_argument('--abandon', type=float, default=0.0,
+                        help="chance per phase that a bot closes its socket without leaving")
+    parser.add_argument('--report', help="write the JSON report here")
+    parser.add_argument('--stress', action='store_true',
+                        help="bots act nonstop in every phase, dead or alive, and report invariant violations")
+    parser.add_argument('--spectators', type=int, nargs='+', metavar='COUNT',
+                        help="rerun the games with this many spectators per game, for each count")
+    parser.add_argument('--quickmatch', type=float, nargs='+', metavar='RATE',
+                        help="benchmark quick-match time-to-match at these arrivals/second")
+    parser.add_argument('--shards', type=int, nargs='+', metavar='WORKERS',
+                        help="with --spawn, rerun the games against this many sharded workers, for each count")
+    parser.add_argument('--chat-storm', type=int, nargs='+', metavar='WINDOW_MS',
+                        help="with --spawn, time chat delivery in one busy lobby for each chat batch window")
+    parser.add_argument('--poll', type=int, nargs='+', metavar='CLIENTS',
+                        help="benchmark HTTP polling of one lobby with this many concurrent clients, for each count")
+    args = parser.parse_args()
+    args.url = args.url.rstrip('/')
+    args.urls = [args.url]
+    if args.shards and not args.spawn:
+        parser.error('--shards needs --spawn')
+    if args.chat_storm and not args.spawn:
+        parser.error('--chat-storm needs --spawn')
+
+    if args.chat_storm:
+        reports = {}
+        for window in args.chat_storm:
+            # Flood protection would turn a storm into rejections
+            env = dict(os.environ, MAFIA_CHAT_BATCH_MS=str(window), MAFIA_CHAT_RATE='1000',
+                       MAFIA_CHAT_BURST='1000', MAFIA_ROOM_CHAT_RATE='100000', MAFIA_ROOM_CHAT_BURST='100000')
+            server = spawn_server(args.url, args.server[0], env)
+            try:
+                reports[str(window)] = asyncio.run(run_chat_storm(args, ServerProbe(server.pid)))
+            finally:
+                stop([server])
+        report = {'chat_storm': reports}
+    elif args.shards:
+        reports = {}
+        for count in args.shards:
+            args.urls, processes = spawn_shards(args.url, count)
+            try:
+                reports[str(count)] = asyncio.run(run(args, ProbeGroup([process.pid for process in processes[1:]])))
+            finally:
+                stop(processes)
+        args.urls = [args.url]
+        report = {'shards': reports}
+    elif args.spawn:
+        reports = {}
+        for mode in args.server:
+            server = spawn_server(args.url, mode)
+            try:
+                reports[mode] = run_once(args, server.pid)
+            finally:
+                server.terminate()
+                server.wait()
+        # One server keeps the single-report layout; several are side by side
+        report = reports[args.server[0]] if len(reports) == 1 else {'servers': reports}
+    else:
+        report = run_once(args, args.server_pid)
+
+    report['config'] = {key: value for key, value in vars(args).items() if key != 'report'}
+    output = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
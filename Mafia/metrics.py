@@ -0,0 +1,209 @@
+# metrics.py
+import bisect
+import json
+import sys
+import threading
+import time
+from collections import Counter as _Counts
+from functools import wraps
+
+# Seconds; covers sub-millisecond handlers up to a badly stalled event loop
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+_registry = []
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    """A monotonically increasing value, optionally split by one label."""
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = {}  # label value (None without a label) -> total
+        _registry.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] = self.values.get(label_value, 0) + amount
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} counter'
+        for value, total in sorted(self.values.items(), key=lambda item: str(item[0])):
+            labels = [(self.label, value)] if self.label else []
+            yield f'{self.name}{format_labels(labels)} {total}'
+
+
+class Gauge:
+    """A value read at scrape time from `func`, which returns a number or a
+    {label value: number} dict when the gauge has a label."""
+
+    def __init__(self, name, help, func, label=None):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label = label
+        _registry.append(self)
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} gauge'
+        value = self.func()
+        if self.label:
+            for label_value, number in sorted(value.items()):
+                yield f'{self.name}{format_labels([(self.label, label_value)])} {number}'
+        else:
+            yield f'{self.name} {value}'
+
+
+class Histogram:
+    """Cumulative-bucket histogram, optionally split by one label.
+
+    Observations only bump a bucket slot, a sum and a count; the cumulative
+    counts Prometheus expects are built when the metric is rendered.
+    """
+
+    def __init__(self, name, help, label=None, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.series = {}  # label value -> [bucket counts..., +Inf count, sum]
+        _registry.append(self)
+
+    def observe(self, value, label_value=None):
+        series = self.series.get(label_value)
+        if series is None:
+            series = self.series[label_value] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def time(self, label_value=None):
+        return _Timer(self, label_value)
+
+    def timed(self, func):
+        """Decorator observing each call's duration, labelled with the function name."""
+        name = func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(time.perf_counter() - start, name)
+        return wrapper
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        for label_value, series in sorted(self.series.items(), key=lambda item: str(item[0])):
+            labels = [(self.label, label_value)] if self.label else []
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                yield f'{self.name}_bucket{format_labels(labels + [("le", bound)])} {cumulative}'
+            yield f'{self.name}_sum{format_labels(labels)} {series[-1]}'
+            yield f'{self.name}_count{format_labels(labels)} {cumulative}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_value', 'start')
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.label_value)
+
+
+def render():
+    """Every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MeteredJSON:
+    """JSON module for SocketIO(json=...) that counts encoded bytes per event.
+
+    Socket.IO encodes an event packet as [event, *args] once per emit (a room
+    broadcast is encoded once), so this sees every outbound event without
+    touching the emit call sites. Acks are counted under 'ack'.
+    """
+
+    def __init__(self, counter, json_module=json):
+        self.counter = counter
+        self.json = json_module
+
+    def dumps(self, obj, *args, **kwargs):
+        text = self.json.dumps(obj, *args, **kwargs)
+        if isinstance(obj, list):
+            # Characters are bytes with the stdlib's default ensure_ascii;
+            # orjson writes UTF-8, so non-ASCII text counts slightly low
+            self.counter.inc(obj[0] if obj and isinstance(obj[0], str) else 'ack', len(text))
+        return text
+
+    def loads(self, *args, **kwargs):
+        return self.json.loads(*args, **kwargs)
+
+
+class SamplingProfiler:
+    """Samples every other thread's Python stack `hz` times a second.
+
+    Stacks are counted in the folded format ("outer;inner;leaf count") read
+    by flamegraph.pl and speedscope. The sampler is a plain OS thread, so it
+    keeps sampling while the event loop is busy. Under eventlet the main
+    thread's stack is whichever green thread is running at that moment.
+    """
+
+    def __init__(self, hz=97):
+        self.interval = 1.0 / hz
+        self.stacks = _Counts()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename.rsplit("/", 1)[-1]}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def folded(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
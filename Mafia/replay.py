@@ -0,0 +1,466 @@
+# replay.py
+# Compact recordings of whole games: roles, phase changes, night actions,
+# votes, chat, private results and deaths.
+#
+# A replay file is b'MRP1' followed by one frame per game day. Frame 0 holds
+# the setup (lobby code, start time and the roster with roles); frame N holds
+# night N through voting N:
+#
+#     varint day | varint compressed length | zlib(events)
+#
+# Events in a frame are length-prefixed:
+#
+#     varint length | kind byte | varint ms since game start | fields
+#
+# Integers are varints and strings are a varint byte length plus UTF-8.
+# Phases, chat audiences and winners are one-byte codes; roles and night
+# actions stay strings since each appears only a few times a day. Player ids
+# are interned: the Nth PLAYER event names player N, and later events refer
+# to players by that number. Reading from day N skips earlier
+# frames by their length without decompressing them.
+#
+# Recording only appends to an in-memory buffer; when a day ends its frame is
+# handed to a writer thread that compresses it and appends it to the file.
+#
+#   python replay.py replays/ABC123-1f2e3d4c.mrp --day 3    # print as JSON lines
+#   python replay.py --bench --games 2000 --players 10      # overhead and size
+import argparse
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import tempfile
+import threading
+import time
+import zlib
+
+import engine
+
+MAGIC = b'MRP1'
+
+START, PLAYER, PHASE, NIGHT_ACTION, VOTE, CHAT, PRIVATE, DEATH, END = range(9)
+PHASES = tuple(phase.value for phase in engine.Phase)
+AUDIENCES = (None, 'mafia')
+WINNERS = ('town', 'mafia')
+
+REPLAY_ID = re.compile(r'^[A-Z0-9]{6}-[0-9a-f]{8}$')
+
+
+def put_varint(buf, value):
+    while value >= 0x80:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def put_str(buf, text):
+    data = text.encode()
+    put_varint(buf, len(data))
+    buf += data
+
+
+def get_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def get_str(data, pos):
+    length, pos = get_varint(data, pos)
+    return data[pos:pos + length].decode(), pos + length
+
+
+class Recording:
+    """The events of one game, encoded as they happen.
+
+    Each day's events collect in `buffer`; the day's frame goes to the
+    writer when the next night starts, and the last one on `close`.
+    """
+
+    def __init__(self, store, replay_id, started, player_ids=()):
+        self.store = store
+        self.id = replay_id
+        self.started = started  # wall-clock seconds
+        self.index = {pid: i for i, pid in enumerate(player_ids)}
+        self.day = 0
+        self.phase = None
+        self.buffer = bytearray()
+        self.closed = False
+
+    def event(self, kind, body):
+        buf = self.buffer
+        put_varint(buf, len(body) + 1)
+        buf.append(kind)
+        buf += body
+
+    def stamp(self):
+        """A new event body starting with the time since the game started."""
+        body = bytearray()
+        put_varint(body, max(0, int((time.time() - self.started) * 1000)))
+        return body
+
+    def start(self, code):
+        body = self.stamp()
+        put_str(body, code)
+        put_varint(body, int(self.started * 1000))
+        self.event(START, body)
+
+    def player(self, player_id, name, role):
+        self.index[player_id] = len(self.index)
+        body = self.stamp()
+        put_str(body, player_id)
+        put_str(body, name)
+        put_str(body, role)
+        self.event(PLAYER, body)
+
+    def set_phase(self, phase, day_number):
+        if (phase, day_number) == self.phase:
+            return  # e.g. a phase closed early, only its deadline moved
+        self.phase = (phase, day_number)
+        if day_number != self.day:
+            self.flush()
+            self.day = day_number
+        body = self.stamp()
+        body.append(PHASES.index(phase))
+        put_varint(body, day_number)
+        self.event(PHASE, body)
+
+    def skip_to(self, phase, day_number):
+        """Continue from `phase` without recording it, e.g. when recovering."""
+        self.phase = (phase, day_number)
+        self.day = day_number
+
+    def night_action(self, player_id, action, target_id):
+        body = self.stamp()
+        put_varint(body, self.index[player_id])
+        put_str(body, action)
+        put_varint(body, self.index[target_id])
+        self.event(NIGHT_ACTION, body)
+
+    def vote(self, voter_id, target_id):
+        body = self.stamp()
+        put_varint(body, self.index[voter_id])
+        put_varint(body, self.index[target_id])
+        self.event(VOTE, body)
+
+    def chat(self, player_id, audience, message):
+        """A chat line, or a system announcement when `player_id` is None."""
+        body = self.stamp()
+        put_varint(body, 0 if player_id is None else self.index[player_id] + 1)
+        body.append(AUDIENCES.index(audience))
+        put_str(body, message)
+        self.event(CHAT, body)
+
+    def private(self, player_id, message):
+        body = self.stamp()
+        put_varint(body, self.index[player_id])
+        put_str(body, message)
+        self.event(PRIVATE, body)
+
+    def death(self, player_id):
+        body = self.stamp()
+        put_varint(body, self.index[player_id])
+        self.event(DEATH, body)
+
+    def end(self, winner):
+        body = self.stamp()
+        body.append(WINNERS.index(winner))
+        self.event(END, body)
+        self.close()
+
+    def to_record(self):
+        return {'id': self.id, 'started': self.started, 'players': list(self.index)}
+
+    def flush(self):
+        if self.buffer and not self.closed:
+            self.store.append(self.id, self.day, bytes(self.buffer))
+            self.buffer.clear()
+
+    def close(self):
+        self.flush()
+        self.closed = True
+
+
+class NullRecording:
+    """Stands in for a Recording when replays are turned off."""
+
+    id = None
+
+    def __getattr__(self, name):
+        return self.ignore
+
+    def ignore(self, *args):
+        pass
+
+    def to_record(self):
+        return None
+
+
+class ReplayStore:
+    """Replay files in `directory`, appended to by one writer thread.
+
+    The writer is a plain OS thread, so compression and disk writes never
+    hold up the event loop. `bytes_counter`, a metrics.Counter, counts the
+    compressed bytes written.
+    """
+
+    def __init__(self, directory, bytes_counter=None):
+        self.directory = directory
+        self.bytes_counter = bytes_counter
+        self.queue = queue.Queue()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def path(self, replay_id):
+        return os.path.join(self.directory, replay_id + '.mrp')
+
+    def start(self, replay_id, started, code, players):
+        """A new recording; `players` are (id, name, role) in roster order."""
+        recording = Recording(self, replay_id, started)
+        recording.start(code)
+        for player_id, name, role in players:
+            recording.player(player_id, name, role)
+        return recording
+
+    def resume(self, record, phase, day_number):
+        """Continue a recording after a restart from Recording.to_record()."""
+        if not record:
+            return NullRecording()
+        if phase == 'ended':
+            finished = NullRecording()  # nothing left to record, but keep the id
+            finished.id = record['id']
+            return finished
+        recording = Recording(self, record['id'], record['started'], record['players'])
+        recording.skip_to(phase, day_number)
+        return recording
+
+    def append(self, replay_id, day, events):
+        self.queue.put((replay_id, day, events))
+
+    def run(self):
+        while True:
+            replay_id, day, events = self.queue.get()
+            try:
+                self.write_frame(replay_id, day, events)
+            except OSError as exc:
+                print(f'Replay {replay_id}: {exc}')
+            finally:
+                self.queue.task_done()
+
+    def write_frame(self, replay_id, day, events):
+        frame = bytearray()
+        path = self.path(replay_id)
+        if not os.path.exists(path):
+            frame += MAGIC
+        data = zlib.compress(events, 6)
+        put_varint(frame, day)
+        put_varint(frame, len(data))
+        frame += data
+        with open(path, 'ab') as f:
+            f.write(frame)
+        if self.bytes_counter:
+            self.bytes_counter.inc(amount=len(frame))
+
+    def wait(self):
+        """Block until every queued frame is on disk."""
+        self.queue.join()
+
+    def exists(self, replay_id):
+        return bool(REPLAY_ID.match(replay_id)) and os.path.exists(self.path(replay_id))
+
+
+class NullReplayStore:
+    """Records nothing; used when the replay directory is set empty."""
+
+    def start(self, *args):
+        return NullRecording()
+
+    resume = start
+
+    def exists(self, replay_id):
+        return False
+
+
+def open_replays(directory, bytes_counter=None):
+    """A ReplayStore in `directory`, or a store recording nothing if it's empty."""
+    return ReplayStore(directory, bytes_counter) if directory else NullReplayStore()
+
+
+def read_frames(f, from_day=0, until_day=None):
+    """Yield (day, event bytes) per frame. The setup frame (day 0) always
+    comes first since the roster it carries is needed to name players."""
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a replay file')
+    while True:
+        head = f.read(20)
+        if not head:
+            return
+        try:
+            day, pos = get_varint(head, 0)
+            length, pos = get_varint(head, pos)
+        except IndexError:
+            return  # a frame still being written
+        f.seek(pos - len(head), os.SEEK_CUR)
+        if until_day is not None and day > until_day:
+            return
+        if day and day < from_day:
+            f.seek(length, os.SEEK_CUR)
+            continue
+        data = f.read(length)
+        if len(data) < length:
+            return
+        yield day, zlib.decompress(data)
+
+
+def decode_events(data, roster):
+    """Yield event dicts from one frame; PLAYER events extend `roster`."""
+    pos = 0
+    while pos < len(data):
+        length, pos = get_varint(data, pos)
+        end = pos + length
+        kind = data[pos]
+        t, at = get_varint(data, pos + 1)
+        event = {'t': t}
+        if kind == START:
+            event['type'] = 'start'
+            event['lobby_code'], at = get_str(data, at)
+            event['started'], at = get_varint(data, at)
+        elif kind == PLAYER:
+            event['type'] = 'player'
+            event['id'], at = get_str(data, at)
+            event['name'], at = get_str(data, at)
+            event['role'], at = get_str(data, at)
+            roster.append(event['id'])
+        elif kind == PHASE:
+            event['type'] = 'phase'
+            event['phase'] = PHASES[data[at]]
+            event['day_number'], at = get_varint(data, at + 1)
+        elif kind == NIGHT_ACTION:
+            event['type'] = 'night_action'
+            actor, at = get_varint(data, at)
+            event['player'] = roster[actor]
+            event['action'], at = get_str(data, at)
+            target, at = get_varint(data, at)
+            event['target'] = roster[target]
+        elif kind == VOTE:
+            event['type'] = 'vote'
+            voter, at = get_varint(data, at)
+            target, at = get_varint(data, at)
+            event['voter'] = roster[voter]
+            event['target'] = roster[target]
+        elif kind == CHAT:
+            event['type'] = 'chat'
+            sender, at = get_varint(data, at)
+            event['player'] = roster[sender - 1] if sender else None
+            event['audience'] = AUDIENCES[data[at]]
+            event['message'], at = get_str(data, at + 1)
+        elif kind == PRIVATE:
+            event['type'] = 'private'
+            player, at = get_varint(data, at)
+            event['player'] = roster[player]
+            event['message'], at = get_str(data, at)
+        elif kind == DEATH:
+            event['type'] = 'death'
+            player, at = get_varint(data, at)
+            event['id'] = roster[player]
+        elif kind == END:
+            event['type'] = 'end'
+            event['winner'] = WINNERS[data[at]]
+        pos = end
+        yield event
+
+
+def read_replay(path, from_day=0, until_day=None):
+    """Yield the events of a replay file, optionally only some days'
+    (the setup frame with the roster is always included)."""
+    roster = []
+    with open(path, 'rb') as f:
+        for day, data in read_frames(f, from_day, until_day):
+            yield from decode_events(data, roster)
+
+
+def benchmark(games, num_players, chat_lines, seed=0):
+    """Record headless bot games and report recording cost and file size.
+
+    Bots don't talk, so each day also gets `chat_lines` lines per living
+    player and the system announcements a live game would add.
+    """
+    rng = random.Random(seed)
+    seconds = 0.0
+    events = 0
+    with tempfile.TemporaryDirectory() as directory:
+        store = ReplayStore(directory)
+        for number in range(games):
+            game = engine.HeadlessGame(num_players, rng=rng)
+            ids = {pid: secrets.token_hex(8) for pid in game.players}
+            calls = []
+
+            def sink(event, data):
+                if event == 'phase':
+                    calls.append(('set_phase', data['phase'], data['day_number']))
+                    calls.append(('chat', None, None, f"The {data['phase']} phase begins."))
+                    if data['phase'] == engine.Phase.VOTING:
+                        for player in game.alive():
+                            for _ in range(chat_lines):
+                                calls.append(('chat', ids[player.id], None, f'I think it is player{rng.choice(list(ids))}'))
+                elif event == 'night_action':
+                    calls.append(('night_action', ids[data['player']], data['type'], ids[data['target']]))
+                elif event == 'vote':
+                    calls.append(('vote', ids[data['voter']], ids[data['target']]))
+                elif event == 'death':
+                    calls.append(('death', ids[data['id']]))
+                elif event == 'end':
+                    calls.append(('end', data['winner']))
+
+            game.sink = sink
+            game.play()
+
+            # Only the recording itself is timed, not the bots
+            start = time.perf_counter()
+            recording = store.start(f'BENCH{number % 10}-{number:08x}', time.time(), 'BENCH0',
+                                    [(ids[pid], f'player{pid}', player.role.value)
+                                     for pid, player in game.players.items()])
+            for name, *args in calls:
+                getattr(recording, name)(*args)
+            seconds += time.perf_counter() - start
+            events += len(calls) + 1 + len(game.players)
+        store.wait()
+        sizes = [os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)]
+    return {
+        'games': games,
+        'players': num_players,
+        'events_per_game': round(events / games, 1),
+        'recording_us_per_event': round(seconds / events * 1e6, 2),
+        'bytes_per_game': round(sum(sizes) / len(sizes)),
+        'bytes_per_event': round(sum(sizes) / events, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Print a replay file, or benchmark recording.")
+    parser.add_argument('path', nargs='?', help="replay file to print as JSON lines")
+    parser.add_argument('--day', type=int, default=0, help="start from this day")
+    parser.add_argument('--bench', action='store_true', help="record headless games and report the cost")
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--chat', type=int, default=3, help="chat lines per player per day in --bench")
+    args = parser.parse_args()
+
+    if args.bench:
+        print(json.dumps(benchmark(args.games, args.players, args.chat), indent=2))
+    elif args.path:
+        for event in read_replay(args.path, args.day):
+            print(json.dumps(event))
+    else:
+        parser.error('give a replay file or --bench')
+
+
+if __name__ == '__main__':
+    main()
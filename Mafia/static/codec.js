@@ -0,0 +1,112 @@
+// static/codec.js
+// Client side of the binary event encoding in codec.py. Pages ask for it in
+// join_lobby with `codec: MafiaCodec.mode`; events then arrive either as JSON
+// or as one MessagePack ArrayBuffer, which `on` turns back into the same
+// objects JSON would have given. Pages use JSON, matching the server's
+// default; add ?codec=binary to a page URL to opt in.
+const MafiaCodec = (function () {
+    const mode = new URLSearchParams(window.location.search).get('codec') || 'json';
+    let schema = null;
+
+    function unpack(buffer) {
+        const view = new DataView(buffer);
+        const bytes = new Uint8Array(buffer);
+        const text = new TextDecoder();
+        let pos = 0;
+
+        function str(length) {
+            const value = text.decode(bytes.subarray(pos, pos + length));
+            pos += length;
+            return value;
+        }
+        function array(length) {
+            const items = new Array(length);
+            for (let i = 0; i < length; i++) items[i] = read();
+            return items;
+        }
+        function map(length) {
+            const items = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                items[key] = read();
+            }
+            return items;
+        }
+        function fixed(size, get) {
+            const value = get.call(view, pos);
+            pos += size;
+            return value;
+        }
+        function read() {
+            const byte = bytes[pos++];
+            if (byte < 0x80) return byte;
+            if (byte >= 0xe0) return byte - 0x100;
+            if (byte >= 0xa0 && byte <= 0xbf) return str(byte & 0x1f);
+            if (byte >= 0x90 && byte <= 0x9f) return array(byte & 0x0f);
+            if (byte >= 0x80 && byte <= 0x8f) return map(byte & 0x0f);
+            switch (byte) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xcc: return fixed(1, view.getUint8);
+                case 0xcd: return fixed(2, view.getUint16);
+                case 0xce: return fixed(4, view.getUint32);
+                case 0xcf: return Number(fixed(8, view.getBigUint64));
+                case 0xd0: return fixed(1, view.getInt8);
+                case 0xd1: return fixed(2, view.getInt16);
+                case 0xd2: return fixed(4, view.getInt32);
+                case 0xd3: return Number(fixed(8, view.getBigInt64));
+                case 0xca: return fixed(4, view.getFloat32);
+                case 0xcb: return fixed(8, view.getFloat64);
+                case 0xd9: return str(fixed(1, view.getUint8));
+                case 0xda: return str(fixed(2, view.getUint16));
+                case 0xdb: return str(fixed(4, view.getUint32));
+                case 0xdc: return array(fixed(2, view.getUint16));
+                case 0xdd: return array(fixed(4, view.getUint32));
+                case 0xde: return map(fixed(2, view.getUint16));
+                case 0xdf: return map(fixed(4, view.getUint32));
+            }
+            throw new Error('Unsupported MessagePack type ' + byte);
+        }
+        return read();
+    }
+
+    // Records are [mask, value...]; bit i of mask says field i was sent
+    function record(name, values) {
+        const fields = schema.records[name];
+        const mask = values[0];
+        const data = {};
+        let index = 1;
+        fields.forEach(([field, kind], bit) => {
+            if (mask & (1 << bit)) data[field] = value(kind, values[index++]);
+        });
+        if (mask & (1 << fields.length)) Object.assign(data, values[index]);
+        return data;
+    }
+
+    function value(kind, raw) {
+        if (kind === null || raw === null) return raw;
+        const [form, arg] = kind;
+        if (form === 'enum') return arg[raw];
+        if (form === 'list') return raw.map(item => record(arg, item));
+        const items = {};
+        for (const [key, item] of Object.entries(raw)) items[key] = record(arg, item);
+        return items;
+    }
+
+    function decode(event, buffer) {
+        const data = unpack(buffer);
+        const name = schema.events[event];
+        return name ? record(name, data) : data;
+    }
+
+    return {
+        mode: mode,
+        // Wraps socket.on so handlers always get plain objects
+        attach(socket) {
+            socket.on('codec', data => { schema = data.schema; });
+            return (event, handler) => socket.on(event, data =>
+                handler(data instanceof ArrayBuffer ? decode(event, data) : data));
+        }
+    };
+})();
@@ -0,0 +1,244 @@
+# store.py
+#
+#   python store.py --bench --games 10000    # write amplification and recovery time
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class MemoryStore:
+    """Keeps nothing beyond the in-process `lobbies` and `players` dicts."""
+
+    def __init__(self):
+        self.replaying = False
+
+    def record(self, code, event, data):
+        return False
+
+    def snapshot(self, code, record):
+        pass
+
+    def drop(self, code):
+        pass
+
+    def load(self):
+        return []
+
+
+class JournalStore:
+    """Append-only journal of lobby events with periodic compact snapshots.
+
+    Every lobby has a snapshot row plus the journal entries written after it.
+    Once a lobby has `snapshot_every` entries the caller writes a fresh
+    snapshot, which also deletes the entries it covers, so recovery replays
+    at most that many events per lobby.
+    """
+
+    def __init__(self, path, snapshot_every=200):
+        self.snapshot_every = snapshot_every
+        self.pending = {}  # code -> journal entries since the last snapshot
+        self.replaying = False
+        self.lock = threading.Lock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                        '(code TEXT PRIMARY KEY, seq INTEGER NOT NULL, data TEXT NOT NULL)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS journal '
+                        '(seq INTEGER PRIMARY KEY AUTOINCREMENT, code TEXT NOT NULL, '
+                        'event TEXT NOT NULL, data TEXT NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS journal_code ON journal (code, seq)')
+
+    def record(self, code, event, data):
+        """Append an event; returns True once the lobby is due a snapshot."""
+        if self.replaying:
+            return False
+        with self.lock:
+            self.db.execute('INSERT INTO journal (code, event, data) VALUES (?, ?, ?)',
+                            (code, event, json.dumps(data, separators=(',', ':'))))
+            count = self.pending.get(code, 0) + 1
+            self.pending[code] = count
+        return count >= self.snapshot_every
+
+    def snapshot(self, code, record):
+        if self.replaying:
+            return
+        data = json.dumps(record, separators=(',', ':'))
+        with self.lock:
+            self.db.execute('BEGIN')
+            seq = self.db.execute('SELECT COALESCE(MAX(seq), 0) FROM journal').fetchone()[0]
+            self.db.execute('INSERT OR REPLACE INTO snapshots (code, seq, data) VALUES (?, ?, ?)',
+                            (code, seq, data))
+            self.db.execute('DELETE FROM journal WHERE code = ? AND seq <= ?', (code, seq))
+            self.db.execute('COMMIT')
+            self.pending[code] = 0
+
+    def drop(self, code):
+        with self.lock:
+            self.db.execute('BEGIN')
+            self.db.execute('DELETE FROM snapshots WHERE code = ?', (code,))
+            self.db.execute('DELETE FROM journal WHERE code = ?', (code,))
+            self.db.execute('COMMIT')
+            self.pending.pop(code, None)
+
+    def load(self):
+        """Return (code, snapshot record, [(event, data), ...]) for every saved lobby."""
+        with self.lock:
+            snapshots = {code: json.loads(data) for code, data in
+                         self.db.execute('SELECT code, data FROM snapshots')}
+            events = {code: [] for code in snapshots}
+            for code, event, data in self.db.execute('SELECT code, event, data FROM journal ORDER BY seq'):
+                if code in events:
+                    events[code].append((event, json.loads(data)))
+            self.pending = {code: len(entries) for code, entries in events.items()}
+        return [(code, snapshots[code], events[code]) for code in snapshots]
+
+
+def open_store(url):
+    """Build a store from a URL: unset/'memory://' or 'sqlite:///path/to/file.db'."""
+    if not url or url == 'memory://':
+        return MemoryStore()
+    if url.startswith('sqlite:///'):
+        return JournalStore(url[len('sqlite:///'):])
+    raise ValueError(f'Unsupported store URL: {url}')
+
+
+def play(app, code, num_players, actions, rng):
+    """Create a lobby the way create_lobby does, start its game and journal
+    `actions` player actions through the game's own methods."""
+    lobby = app.Lobby(code, app.Player(f'{rng.getrandbits(64):016x}', 'Player 0', None))
+    app.store.snapshot(code, lobby.to_record())
+    for number in range(1, num_players):
+        lobby.add_player(app.Player(f'{rng.getrandbits(64):016x}', f'Player {number}', None))
+    game = lobby.game = app.Game(lobby)
+    app.phase_scheduler.cancel(code)
+    ids = list(game.players)
+    actors = [player for player in game.players.values() if player.role in app.NIGHT_ACTIONS]
+    cycle = [app.Phase.DAY, app.Phase.DISCUSSION, app.Phase.VOTING, app.Phase.NIGHT]
+
+    for _ in range(actions):
+        kind = rng.random()
+        if kind < 0.6:
+            lobby.add_message(f'I think it is Player {rng.randrange(num_players)}', f'Player {rng.randrange(num_players)}')
+        elif kind < 0.8:
+            game.cast_vote(game.players[rng.choice(ids)], rng.choice(ids))
+        elif kind < 0.95:
+            actor = rng.choice(actors)
+            game.submit_night_action(actor, app.NIGHT_ACTIONS[actor.role], rng.choice(ids))
+        else:
+            # A phase change without its deaths, so the game never ends
+            game.phase = cycle[(cycle.index(game.phase) + 1) % len(cycle)]
+            if game.phase == app.Phase.NIGHT:
+                game.day_number += 1
+                game.night_actions = app.NightActions()
+            elif game.phase == app.Phase.VOTING:
+                game.reset_votes()
+            game.journal_phase()
+
+
+def bytes_written():
+    """Bytes this process has handed to write(2) so far, or None off Linux."""
+    try:
+        with open('/proc/self/io') as io:
+            for line in io:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+
+
+def benchmark(games, num_players, actions, sample, seed=0):
+    """Report journal write amplification per action and recovery time.
+
+    `sample` lobbies play `actions` actions each through app.py's own
+    Lobby and Game methods, which journal and snapshot as they would live.
+    Then `games` lobbies are left with a random backlog of up to
+    `snapshot_every` actions past their last snapshot, and restore_lobbies
+    rebuilds them all from a fresh store, as after a restart.
+    """
+    import app
+
+    app.replays = app.open_replays('')  # no replay files for the bench games
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.db')
+        store = app.store = JournalStore(path)
+        totals = {'logical': 0, 'snapshots': 0, 'snapshot_bytes': 0}
+        record, snapshot = store.record, store.snapshot
+
+        def counted_record(code, event, data):
+            totals['logical'] += len(json.dumps(data, separators=(',', ':')))
+            return record(code, event, data)
+
+        def counted_snapshot(code, lobby_record):
+            totals['snapshots'] += 1
+            totals['snapshot_bytes'] += len(json.dumps(lobby_record, separators=(',', ':')))
+            snapshot(code, lobby_record)
+
+        store.record, store.snapshot = counted_record, counted_snapshot
+        before = bytes_written()
+        start = time.perf_counter()
+        for number in range(sample):
+            play(app, f'S{number:05d}', num_players, actions, rng)
+        seconds = time.perf_counter() - start
+        written = bytes_written()
+        store.record, store.snapshot = record, snapshot
+        for number in range(sample):
+            store.drop(f'S{number:05d}')
+
+        total = sample * actions
+        report = {
+            'actions': total,
+            'record_us_per_action': round(seconds / total * 1e6, 2),
+            'logical_bytes_per_action': round(totals['logical'] / total, 1),
+            'snapshot_bytes_per_action': round(totals['snapshot_bytes'] / total, 1),
+            'snapshots_per_1000_actions': round(totals['snapshots'] / total * 1000, 2),
+        }
+        if before is not None:
+            report['bytes_written_per_action'] = round((written - before) / total, 1)
+            report['write_amplification'] = round((written - before) / totals['logical'], 2)
+
+        start = time.perf_counter()
+        for number in range(games):
+            play(app, f'G{number:05d}', num_players, rng.randrange(store.snapshot_every), rng)
+        populate_seconds = time.perf_counter() - start
+        backlog = store.db.execute('SELECT COUNT(*) FROM journal').fetchone()[0]
+        store.db.close()
+
+        app.store = JournalStore(path)
+        start = time.perf_counter()
+        app.restore_lobbies()
+        report['recovery'] = {
+            'games': len(app.lobbies),
+            'players': len(app.players),
+            'journal_entries': backlog,
+            'db_bytes': os.path.getsize(path),
+            'populate_seconds': round(populate_seconds, 1),
+            'restore_seconds': round(time.perf_counter() - start, 3),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the lobby journal.")
+    parser.add_argument('--bench', action='store_true', help="report write amplification and recovery time")
+    parser.add_argument('--games', type=int, default=10000, help="lobbies to recover")
+    parser.add_argument('--players', type=int, default=10)
+    parser.add_argument('--actions', type=int, default=1000, help="actions per sampled game")
+    parser.add_argument('--sample', type=int, default=50, help="games played for the write figures")
+    args = parser.parse_args()
+
+    if args.bench:
+        print(json.dumps(benchmark(args.games, args.players, args.actions, args.sample), indent=2))
+    else:
+        parser.error('nothing to do without --bench')
+
+
+if __name__ == '__main__':
+    main()
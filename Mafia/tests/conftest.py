@@ -0,0 +1,41 @@
+# tests/conftest.py
+# Run with `python -m pytest` from the repository root or from Mafia/.
+import os
+import secrets
+import sys
+
+import pytest
+
+# Threading mode, as under asgi.py: handlers really run concurrently, and no
+# phase timer or reaper task moves games along behind a test's back
+os.environ['MAFIA_SERVER'] = 'asgi'
+os.environ['MAFIA_REPLAY_DIR'] = ''
+os.environ.pop('MAFIA_STORE', None)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def make_lobby():
+    """Factory for a registered lobby of `num_players`; closed afterwards."""
+    made = []
+
+    def make(num_players, start=False, **settings):
+        code = app.generate_lobby_code()
+        lobby = app.Lobby(code, app.Player(secrets.token_hex(8), 'Player 0', None))
+        for number in range(1, num_players):
+            lobby.add_player(app.Player(secrets.token_hex(8), f'Player {number}', None))
+        lobby.settings.update(settings)
+        app.lobbies[code] = lobby
+        app.players.update(lobby.players)
+        app.lobby_index.update(lobby)
+        if start:
+            lobby.game = app.Game(lobby)
+        made.append(lobby)
+        return lobby
+
+    yield make
+    for lobby in made:
+        if lobby.code in app.lobbies:
+            app.close_lobby(lobby)
@@ -0,0 +1,70 @@
+# tests/test_alive_index.py
+import random
+from collections import Counter
+
+import pytest
+
+from engine import NIGHT_ACTIONS, Phase, Role
+
+
+def check(game):
+    """The incremental alive counts and tally against a full scan."""
+    alive = [player for player in game.players.values() if player.alive]
+    for role in Role:
+        assert set(game.alive_by_role[role]) == {player.id for player in alive if player.role == role}
+    assert game.alive_count == len(alive)
+    assert game.mafia_alive == sum(player.role == Role.MAFIA for player in alive)
+    assert game.night_actors_alive == sum(player.role in NIGHT_ACTIONS for player in alive)
+
+    ballots = game.votes.ballots
+    assert set(ballots) <= {player.id for player in alive}
+    assert set(ballots.values()) <= set(game.players)
+    assert len(game.votes) <= game.alive_count
+    counts = Counter(ballots.values())
+    for pid, player in game.players.items():
+        assert player.votes == counts.get(pid, 0)
+        assert player.vote_target == ballots.get(pid)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_alive_index_matches_scan(make_lobby, seed):
+    rng = random.Random(seed)
+    lobby = make_lobby(rng.randint(5, 16), start=True)
+    game = lobby.game
+    game.phase = Phase.VOTING
+    game.reset_votes()
+    check(game)
+
+    for _ in range(rng.randint(10, 60)):
+        alive = [player for player in game.players.values() if player.alive]
+        step = rng.random()
+        if step < 0.6 and alive:
+            game.cast_vote(rng.choice(alive), rng.choice(list(game.players)))
+        elif step < 0.9 and len(game.players) > 2:
+            lobby.remove_player(rng.choice(list(game.players)))
+        else:
+            # Deaths happen between votes: the verdict, then a night kill
+            game.resolve_votes()
+            if alive and rng.random() < 0.5:
+                game.kill_player(rng.choice(alive).id)
+            if game.phase == Phase.ENDED:
+                break
+            game.phase = Phase.VOTING
+            game.reset_votes()
+        check(game)
+
+
+def test_departed_leader_is_not_eliminated(make_lobby):
+    lobby = make_lobby(6, start=True)
+    game = lobby.game
+    game.phase = Phase.VOTING
+    game.reset_votes()
+    voters = list(game.players.values())
+    accused = voters[0]
+    for voter in voters[1:4]:
+        game.cast_vote(voter, accused.id)
+
+    lobby.remove_player(accused.id)
+    alive = game.alive_count
+    game.resolve_votes()  # raised KeyError while the tally still named them
+    assert game.alive_count == alive
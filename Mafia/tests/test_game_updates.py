@@ -0,0 +1,47 @@
+# tests/test_game_updates.py
+import app
+
+
+def apply(state, patch):
+    """What the game page does with a game_update patch."""
+    assert patch['base'] == state['version']
+    state['version'] = patch['version']
+    for pid, changes in patch.get('players', {}).items():
+        state['players'].setdefault(pid, {}).update(changes)
+    state['communications'].extend(patch.get('messages', []))
+
+
+def test_resync_with_queued_chat_sees_each_message_once(make_lobby):
+    lobby = make_lobby(5, start=True)
+    game = lobby.game
+    game.get_game_patches()
+    speaker = next(iter(game.players.values()))
+
+    # Queued for the next batch window, not sent yet
+    game.pending_messages.append(lobby.add_message('hello', speaker.name))
+    state = game.get_game_state('town')
+    apply(state, game.get_game_patches()['town'])
+
+    lines = [entry['message'] for entry in state['communications']]
+    assert lines.count(f'{speaker.name}: hello') == 1
+    assert state['communications'] == game.get_game_state('town')['communications']
+
+
+def test_replay_id_is_published_once_the_game_ends(make_lobby, monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'replays', app.open_replays(str(tmp_path)))
+    lobby = make_lobby(5, start=True)
+    game = lobby.game
+    game.get_game_patches()
+    assert game.get_game_state()['replay_id'] is None
+    assert lobby.to_dict()['replay_id'] is None
+
+    sent = []
+    monkeypatch.setattr(app.transport, 'emit', lambda event, data, room=None: sent.append((event, data)))
+    for player in list(game.players.values()):
+        if player.role == app.Role.MAFIA:
+            game.kill_player(player.id)
+    assert game.check_game_end()
+
+    assert [data['replay_id'] for event, data in sent if event == 'game_update'] == [game.replay.id] * len(app.VIEWS)
+    assert game.get_game_state()['replay_id'] == game.replay.id
+    assert lobby.to_dict()['replay_id'] == game.replay.id
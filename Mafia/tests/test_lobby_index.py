@@ -0,0 +1,40 @@
+# tests/test_lobby_index.py
+import app
+
+
+def test_page_skips_lobbies_being_closed(make_lobby):
+    kept, closing = make_lobby(2), make_lobby(2)
+    index = app.LobbyIndex()
+    index.update(kept)
+    index.update(closing)
+
+    # close_lobby on another thread, caught between its two steps
+    del app.lobbies[closing.code]
+    try:
+        found, last = index.page()
+    finally:
+        app.lobbies[closing.code] = closing
+    assert found == [kept]
+    assert last is None
+
+
+def test_closed_lobby_leaves_the_index(make_lobby):
+    lobby = make_lobby(2)
+    app.close_lobby(lobby)
+    assert lobby.code not in app.lobby_index.entries
+    assert lobby not in app.lobby_index.page(limit=1000)[0]
+
+
+def test_closing_twice_is_harmless(make_lobby):
+    lobby = make_lobby(2)
+    app.close_lobby(lobby)
+    app.close_lobby(lobby)  # the reaper after a leave emptied it
+    assert lobby.code not in app.lobbies
+
+
+def test_reaped_quickmatch_lobby_is_not_reindexed(make_lobby):
+    lobby = make_lobby(1)
+    app.reap_lobby(lobby.code)  # nobody connected
+    app.MatchQueue.settle(lobby)
+    assert lobby.code not in app.lobby_index.entries
+    assert lobby.code not in app.lobbies
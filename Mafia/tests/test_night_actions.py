@@ -0,0 +1,36 @@
+# tests/test_night_actions.py
+from engine import Phase, Role
+
+
+def by_role(game, role):
+    return [player for player in game.players.values() if player.role == role]
+
+
+def test_detective_who_leaves_after_acting(make_lobby):
+    lobby = make_lobby(10, start=True, detective=True)
+    game = lobby.game
+    assert game.phase == Phase.NIGHT
+    detective = by_role(game, Role.DETECTIVE)[0]
+    suspect = by_role(game, Role.MAFIA)[0]
+    game.submit_night_action(detective, 'detective_investigate', suspect.id)
+
+    lobby.remove_player(detective.id)
+    assert len(game.night_actions) == 0
+    game.process_night_actions()  # raised KeyError looking up the detective
+
+
+def test_mafia_member_who_leaves_after_acting(make_lobby):
+    lobby = make_lobby(10, start=True)
+    game = lobby.game
+    first, second, *_ = by_role(game, Role.MAFIA)
+    town = [player for player in game.players.values() if player.role != Role.MAFIA]
+    game.submit_night_action(first, 'mafia_kill', town[0].id)
+
+    lobby.remove_player(first.id)
+    # The departed pick no longer counts towards ending the night early
+    assert len(game.night_actions) < game.night_actors_alive
+
+    game.submit_night_action(second, 'mafia_kill', town[1].id)
+    game.process_night_actions()
+    assert town[0].alive
+    assert not town[1].alive
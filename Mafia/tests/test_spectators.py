@@ -0,0 +1,45 @@
+# tests/test_spectators.py
+import app
+
+
+def spectator_updates(monkeypatch):
+    sent = []
+    monkeypatch.setattr(app, 'spectator_feed', app.SpectatorFeed(0))
+    monkeypatch.setattr(app.transport, 'emit',
+                        lambda event, data, room=None: sent.append(room) if event == 'spectator_update' else None)
+    return sent
+
+
+def test_unwatched_games_are_not_fed(make_lobby, monkeypatch):
+    sent = spectator_updates(monkeypatch)
+    game = make_lobby(5, start=True).game
+    game.add_communication('Nobody is watching')
+    assert sent == []
+
+
+def test_feed_follows_spectators(make_lobby, monkeypatch):
+    sent = spectator_updates(monkeypatch)
+    game = make_lobby(5, start=True).game
+    code = game.lobby.code
+    app.spectator_feed.watch('sid1', code)
+    app.spectator_feed.watch('sid2', code)
+    game.add_communication('Two are watching')
+    assert sent == [app.spectator_room(code)]
+
+    app.spectator_feed.unwatch('sid1')
+    game.add_communication('One is watching')
+    assert len(sent) == 2
+
+    assert app.spectator_feed.watch('sid2', 'OTHER1') == code
+    game.add_communication('They went elsewhere')
+    assert len(sent) == 2
+    assert app.spectator_feed.watchers == {'OTHER1': 1}
+
+
+def test_remote_spectators_are_always_fed(make_lobby, monkeypatch):
+    sent = spectator_updates(monkeypatch)
+    app.spectator_feed.remote = True
+    game = make_lobby(5, start=True).game
+    sent.clear()  # the game's first broadcast
+    game.add_communication('Maybe someone on another worker')
+    assert sent == [app.spectator_room(game.lobby.code)]
@@ -0,0 +1,84 @@
+# tests/test_transitions.py
+import threading
+
+import app
+from engine import Phase, Role
+
+
+def run_at_once(calls):
+    """Run every call on its own thread, released together by a barrier."""
+    barrier = threading.Barrier(len(calls))
+    results = [None] * len(calls)
+
+    def worker(index, func, args):
+        barrier.wait()
+        results[index] = func(*args)
+    threads = [threading.Thread(target=worker, args=(index, func, args))
+               for index, (func, *args) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+def counting(monkeypatch, name):
+    calls = []
+    original = getattr(app.Game, name)
+
+    def wrapper(self, *args):
+        calls.append(self.lobby.code)
+        return original(self, *args)
+    monkeypatch.setattr(app.Game, name, wrapper)
+    return calls
+
+
+def test_close_phase_only_once(make_lobby):
+    game = make_lobby(8, start=True).game
+    results = run_at_once([(app.lobby_command, game.lobby.code, game.close_phase, 3)] * 16)
+    assert results.count(True) == 1
+    assert not game.phase_open
+    assert game.close_phase(3) is False
+
+
+def test_final_votes_at_once_make_one_transition(make_lobby, monkeypatch):
+    game = make_lobby(8, start=True).game
+    game.start_voting()
+    code = game.lobby.code
+    day = game.day_number
+    resolved = counting(monkeypatch, 'resolve_votes')
+    nights = counting(monkeypatch, 'start_night')
+
+    # Everyone votes for one townsperson at the same moment, who votes elsewhere
+    target = next(iter(game.alive_by_role[Role.TOWNSFOLK].values()))
+    other = next(player for player in game.players.values() if player is not target)
+    handler = app.socket_handlers['cast_vote']
+    run_at_once([(handler, app.SocketClient(None, player.id),
+                  {'lobby_code': code, 'target_id': other.id if player is target else target.id})
+                 for player in game.players.values()])
+
+    assert resolved == [code]
+    assert not target.alive
+    assert game.phase == Phase.VOTING and not game.phase_open
+
+    # The queued night firing on several threads at once still starts one night
+    deadline = game.deadline
+    run_at_once([(app.on_phase_deadline, code, deadline)] * 8)
+    assert nights == [code]
+    assert game.phase == Phase.NIGHT and game.day_number == day + 1
+
+
+def test_failing_lobby_does_not_stop_the_timer(make_lobby, monkeypatch, capsys):
+    broken, healthy = make_lobby(6, start=True).game, make_lobby(6, start=True).game
+    original = app.Game.advance_phase
+
+    def advance_phase(self):
+        if self is broken:
+            raise KeyError('gone')
+        return original(self)
+    monkeypatch.setattr(app.Game, 'advance_phase', advance_phase)
+
+    app.phase_scheduler.fire([(broken.lobby.code, broken.deadline), (healthy.lobby.code, healthy.deadline)])
+    assert healthy.phase == Phase.DAY
+    assert broken.phase == Phase.NIGHT
+    assert f'Phase timer for {broken.lobby.code} failed' in capsys.readouterr().err
@@ -0,0 +1,87 @@
+# tests/test_votes.py
+import random
+from collections import Counter
+
+import pytest
+
+import app
+from engine import Phase, VoteTally
+
+
+def recount(ballots):
+    """Leaders and their vote count, the slow way."""
+    counts = Counter(ballots.values())
+    top = max(counts.values(), default=0)
+    return {target for target, count in counts.items() if count == top}, top, counts
+
+
+def check(tally):
+    leaders, top, counts = recount(tally.ballots)
+    assert dict(tally.counts) == dict(counts)
+    assert tally.max_votes == top
+    assert tally.leaders == leaders
+    assert tally.is_tie == (len(leaders) > 1)
+    assert tally.leader == (next(iter(leaders)) if len(leaders) == 1 else None)
+    assert len(tally) == len(tally.ballots)
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_tally_matches_recount(seed):
+    rng = random.Random(seed)
+    ids = [f'p{number}' for number in range(rng.randint(2, 12))]
+    tally = VoteTally()
+    for _ in range(rng.randint(1, 80)):
+        if rng.random() < 0.1:
+            gone = rng.choice(ids)
+            withdrawn = tally.withdraw(gone)
+            assert gone not in tally.ballots
+            assert gone not in tally.ballots.values()
+            assert len(withdrawn) == len(set(withdrawn))
+        else:
+            voter, target = rng.choice(ids), rng.choice(ids)
+            previous = tally.ballots.get(voter)
+            assert tally.cast(voter, target) == previous
+            assert tally.ballots[voter] == target
+        check(tally)
+
+
+def voting_game(make_lobby, num_players):
+    game = make_lobby(num_players, start=True).game
+    game.start_voting()
+    return game, list(game.players.values())
+
+
+def test_revote_after_target_left(make_lobby):
+    game, (voter, gone, other, *_) = voting_game(make_lobby, 6)
+    game.cast_vote(voter, gone.id)
+    game.lobby.remove_player(gone.id)
+    game.cast_vote(voter, other.id)
+    assert other.votes == 1
+    assert game.votes.ballots == {voter.id: other.id}
+
+
+def test_leaving_withdraws_ballots_by_and_for_the_player(make_lobby):
+    game, (a, b, gone, target, *_) = voting_game(make_lobby, 6)
+    game.cast_vote(a, gone.id)
+    game.cast_vote(b, gone.id)
+    game.cast_vote(gone, target.id)
+    game.lobby.remove_player(gone.id)
+    assert len(game.votes) == 0
+    assert target.votes == 0
+    assert a.vote_target is None and b.vote_target is None
+    assert game.phase == Phase.VOTING
+
+
+def test_player_votes_match_tally(make_lobby):
+    rng = random.Random(4)
+    game, players = voting_game(make_lobby, 8)
+    for _ in range(200):
+        present = list(game.players.values())
+        if rng.random() < 0.05 and len(present) > 4:
+            game.lobby.remove_player(rng.choice(present).id)
+        else:
+            game.cast_vote(rng.choice(present), rng.choice(present).id)
+        for player in game.players.values():
+            assert player.votes == game.votes.counts.get(player.id, 0)
+            assert player.vote_target == game.votes.ballots.get(player.id)
+    assert app.lobbies[game.lobby.code] is game.lobby
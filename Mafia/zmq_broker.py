@@ -0,0 +1,20 @@
+# zmq_broker.py
+# Stand-in message broker for running sharded workers locally, e.g.
+#   python zmq_broker.py &
+#   MAFIA_MESSAGE_QUEUE=zmq+tcp://localhost:5555+5556 MAFIA_SHARD_COUNT=2 ... python app.py
+# Workers push emits to the first port and receive them on the second.
+import sys
+
+import zmq
+
+push_port = int(sys.argv[1]) if len(sys.argv) > 1 else 5555
+pub_port = int(sys.argv[2]) if len(sys.argv) > 2 else 5556
+
+context = zmq.Context()
+receiver = context.socket(zmq.PULL)
+receiver.bind(f"tcp://*:{push_port}")
+publisher = context.socket(zmq.PUB)
+publisher.bind(f"tcp://*:{pub_port}")
+
+while True:
+    publisher.send(receiver.recv())